@@ -0,0 +1,3 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
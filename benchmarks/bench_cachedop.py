@@ -0,0 +1,314 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""
+benchmarks.bench_cachedop - latency of dhlibs.cachedop in common scenarios
+
+Run it on two revisions and compare the results:
+
+    python -m benchmarks.bench_cachedop -o base.json
+    python -m benchmarks.bench_cachedop -o head.json
+    python -m benchmarks.bench_cachedop --compare base.json head.json
+
+Only the standard library is used and nothing is fetched, timings are the best
+nanoseconds per operation over the repeats, which is the least noisy estimate.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import operator
+import platform
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timezone
+from pathlib import Path
+from statistics import median
+from threading import Barrier, Thread
+
+from typing_extensions import Any, Callable, NamedTuple, Optional, Sequence, TypeAlias, cast
+
+from dhlibs.cachedop import Auditer, AuditEvent, cached_opfunc
+
+_pairs = [(i, i + 1) for i in range(1000)]
+_operands = list(range(1, 1025))
+
+
+# builds the cache and returns the timed callable, which runs `ops` operations
+_Setup: TypeAlias = Callable[[], Callable[[], object]]
+
+
+class Scenario(NamedTuple):
+    name: str
+    setup: _Setup
+    ops: int
+
+
+_scenarios: list[Scenario] = []
+
+
+def _scenario(name: str, ops: int) -> Callable[[_Setup], _Setup]:
+    def register(setup: _Setup) -> _Setup:
+        _scenarios.append(Scenario(name, setup, ops))
+        return setup
+
+    return register
+
+
+def _cached(**options: Any) -> Any:
+    # a private auditer, so listeners registered elsewhere do not slow the scenarios down
+    options.setdefault("auditer", Auditer())
+    return cast(Any, cached_opfunc(operator.add, **options))
+
+
+def _hits(**options: Any) -> Callable[[], object]:
+    cached = _cached(**options)
+    pairs = _pairs
+    for x, y in pairs:
+        cached(x, y)
+
+    def run() -> None:
+        for x, y in pairs:
+            cached(x, y)
+
+    return run
+
+
+def _misses(**options: Any) -> Callable[[], object]:
+    cached = _cached(**options)
+    pairs = _pairs
+
+    def run() -> None:
+        cached.cache_clear()
+        for x, y in pairs:
+            cached(x, y)
+
+    return run
+
+
+def _cycle(maxsize: int, policy: str) -> Callable[[], object]:
+    # every key once per run, in the same order, against a cache of `maxsize` entries
+    cached = _cached(maxsize=maxsize, policy=policy)
+    pairs = _pairs
+    for x, y in pairs:
+        cached(x, y)
+
+    def run() -> None:
+        for x, y in pairs:
+            cached(x, y)
+
+    return run
+
+
+def _nary(**options: Any) -> Callable[[], object]:
+    cached = _cached(**options)
+    operands = _operands
+
+    def run() -> None:
+        cached.cache_clear()
+        cached(*operands)
+
+    return run
+
+
+def _contended(threads: int, **options: Any) -> Callable[[], object]:
+    cached = _cached(**options)
+    pairs = _pairs * 5
+    for x, y in _pairs:
+        cached(x, y)
+
+    def work(barrier: Barrier) -> None:
+        barrier.wait()
+        for x, y in pairs:
+            cached(x, y)
+
+    def run() -> None:
+        barrier = Barrier(threads)
+        workers = [Thread(target=work, args=(barrier,)) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    return run
+
+
+_scenario("hit/fast", len(_pairs))(_hits)
+_scenario("hit/lru", len(_pairs))(lambda: _hits(policy="lru"))
+_scenario("hit/tinylfu", len(_pairs))(lambda: _hits(policy="tinylfu"))
+_scenario("hit/sharded", len(_pairs))(lambda: _hits(policy="lru", concurrency="sharded"))
+_scenario("hit/thread_cache", len(_pairs))(lambda: _hits(policy="lru", thread_cache=2048))
+_scenario("hit/domain", len(_pairs))(lambda: _hits(domain=(0, 1024)))
+_scenario("miss/fast", len(_pairs))(_misses)
+_scenario("miss/lru", len(_pairs))(lambda: _misses(policy="lru"))
+_scenario("miss/single_flight", len(_pairs))(lambda: _misses(single_flight=True))
+for _policy in ("random", "lru", "tinylfu"):
+    # full caches holding every key, then caches half the size of the working set
+    _scenario(f"maxsize/at/{_policy}", len(_pairs))(lambda policy=_policy: _cycle(len(_pairs), policy))
+    _scenario(f"maxsize/past/{_policy}", len(_pairs))(lambda policy=_policy: _cycle(len(_pairs) // 2, policy))
+_scenario("nary/recursive", 1)(lambda: _nary(nary=False))
+_scenario("nary/reduce", 1)(lambda: _nary(nary=False, recursive=False))
+_scenario("nary/builtin", 1)(lambda: _nary(nary=True))
+
+
+@_scenario("audit/off", len(_pairs))
+def _audit_off() -> Callable[[], object]:
+    return _hits(policy="lru")
+
+
+@_scenario("audit/on", len(_pairs))
+def _audit_on() -> Callable[[], object]:
+    auditer = Auditer()
+    auditer.register(lambda _event, _args: None, [AuditEvent.HIT, AuditEvent.MISS])
+    return _hits(policy="lru", auditer=auditer)
+
+
+for _threads in (1, 4):
+    _ops = _threads * len(_pairs) * 5
+    _scenario(f"contention/{_threads}/fast", _ops)(lambda threads=_threads: _contended(threads))
+    _scenario(f"contention/{_threads}/lru", _ops)(lambda threads=_threads: _contended(threads, policy="lru"))
+    _scenario(f"contention/{_threads}/sharded", _ops)(
+        lambda threads=_threads: _contended(threads, policy="lru", concurrency="sharded")
+    )
+    _scenario(f"contention/{_threads}/thread_cache", _ops)(
+        lambda threads=_threads: _contended(threads, policy="lru", thread_cache=2048)
+    )
+
+
+def scenarios() -> list[Scenario]:
+    """Return every scenario, in the order they run."""
+    return list(_scenarios)
+
+
+def measure(scenario: Scenario, repeat: int = 5, min_time: float = 0.05) -> dict[str, Any]:
+    """
+    Time `scenario`, in nanoseconds per operation.
+
+    The number of runs per repeat doubles until a repeat lasts `min_time` seconds.
+    """
+    if repeat <= 0 or min_time < 0:
+        raise ValueError("repeat must be positive and min_time not negative")
+    timer = timeit.Timer(scenario.setup())
+    number = 1
+    while (elapsed := timer.timeit(number)) < min_time:
+        number *= 2
+    timings = [elapsed, *timer.repeat(repeat - 1, number)]
+    scale = 1e9 / (number * scenario.ops)
+    return {
+        "ns_per_op": min(timings) * scale,
+        "median_ns_per_op": median(timings) * scale,
+        "ops": number * scenario.ops,
+        "repeat": repeat,
+    }
+
+
+def _revision() -> Optional[str]:
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return process.stdout.strip()
+
+
+def run(
+    selected: Optional[Sequence[Scenario]] = None,
+    repeat: int = 5,
+    min_time: float = 0.05,
+    progress: Optional[Callable[[str, dict[str, Any]], None]] = None,
+) -> dict[str, Any]:
+    """Measure the selected scenarios (all by default), return the results with the environment."""
+    results: dict[str, Any] = {}
+    for scenario in _scenarios if selected is None else selected:
+        results[scenario.name] = measure(scenario, repeat, min_time)
+        if progress is not None:
+            progress(scenario.name, results[scenario.name])
+    return {
+        "meta": {
+            "revision": _revision(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare(base: dict[str, Any], head: dict[str, Any], threshold: float = 0.1) -> tuple[str, list[str]]:
+    """
+    Compare two results of `run`.
+
+    Return a text table of both timings of every common scenario, and the names of
+    the scenarios that got slower by more than `threshold` (relative).
+    """
+    lines = [f"{'scenario':<28}{'base ns/op':>12}{'head ns/op':>12}{'change':>9}"]
+    regressions: list[str] = []
+    for name, result in head["results"].items():
+        old = base["results"].get(name)
+        if old is None:
+            continue
+        change = result["ns_per_op"] / old["ns_per_op"] - 1
+        mark = ""
+        if change > threshold:
+            regressions.append(name)
+            mark = "  slower"
+        elif change < -threshold:
+            mark = "  faster"
+        lines.append(f"{name:<28}{old['ns_per_op']:>12.1f}{result['ns_per_op']:>12.1f}{change:>+9.1%}{mark}")
+    return "\n".join(lines), regressions
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.bench_cachedop",
+        description="benchmark dhlibs.cachedop, or compare two benchmark results",
+    )
+    parser.add_argument("-o", "--output", type=Path, default=None, help="write the results to this JSON file")
+    parser.add_argument("-k", "--filter", default="", help="only run the scenarios whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timings per scenario, the best one is kept")
+    parser.add_argument("--min-time", type=float, default=0.05, help="minimum duration of a timing in seconds")
+    parser.add_argument("--list", action="store_true", help="list the scenarios and exit")
+    parser.add_argument(
+        "--compare", nargs=2, type=Path, default=None, metavar=("BASE", "HEAD"), help="compare two JSON results"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative slowdown reported as a regression by --compare"
+    )
+    args = parser.parse_args(argv)
+    if args.compare is not None:
+        base, head = (json.loads(path.read_text()) for path in args.compare)
+        table, regressions = compare(base, head, args.threshold)
+        print(table)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        return 0
+    selected = [scenario for scenario in _scenarios if args.filter in scenario.name]
+    if args.list:
+        print("\n".join(scenario.name for scenario in selected))
+        return 0
+    results = run(
+        selected,
+        args.repeat,
+        args.min_time,
+        lambda name, result: print(f"{name:<28}{result['ns_per_op']:>12.1f} ns/op", flush=True),
+    )
+    if args.output is not None:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+__all__ = ["Scenario", "scenarios", "measure", "run", "compare", "main"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,8 +6,36 @@
 
 from __future__ import annotations
 
-from dhlibs.cachedop._typings import AuditEvent
-from dhlibs.cachedop.audit import Auditer, register_audit_callback
+from dhlibs.cachedop._typings import AuditEvent, AuditRecord
+from dhlibs.cachedop.algebra import Algebra
+from dhlibs.cachedop.audit import Auditer, BatchedAuditer, JSONLFileSink, register_audit_callback
+from dhlibs.cachedop.backends import SharedMemoryBackend, SQLiteBackend
 from dhlibs.cachedop.core import cached_opfunc
+from dhlibs.cachedop.metrics import metrics_snapshot, render_prometheus
+from dhlibs.cachedop.policies import EvictionPolicy, LFUPolicy, LRUPolicy, RandomPolicy, TinyLFUPolicy
+from dhlibs.cachedop.reducer import SegmentTreeReducer
+from dhlibs.cachedop.tracing import TraceRecorder, read_trace, simulate
 
-__all__ = ["Auditer", "register_audit_callback", "cached_opfunc", "AuditEvent"]
+__all__ = [
+    "Auditer",
+    "BatchedAuditer",
+    "JSONLFileSink",
+    "register_audit_callback",
+    "cached_opfunc",
+    "AuditEvent",
+    "AuditRecord",
+    "EvictionPolicy",
+    "RandomPolicy",
+    "LRUPolicy",
+    "LFUPolicy",
+    "TinyLFUPolicy",
+    "SQLiteBackend",
+    "SharedMemoryBackend",
+    "SegmentTreeReducer",
+    "Algebra",
+    "TraceRecorder",
+    "read_trace",
+    "simulate",
+    "metrics_snapshot",
+    "render_prometheus",
+]
@@ -0,0 +1,11 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""python -m dhlibs.cachedop - print the hit-rate curves of a trace"""
+
+from __future__ import annotations
+
+from dhlibs.cachedop.tracing import main
+
+main()
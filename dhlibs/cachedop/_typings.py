@@ -7,7 +7,20 @@ from __future__ import annotations
 from collections import defaultdict
 from enum import Enum, auto
 
-from typing_extensions import Any, Callable, Hashable, NamedTuple, Optional, Sequence, TypeAlias, Union
+from typing_extensions import (
+    Any,
+    Awaitable,
+    Callable,
+    Final,
+    Hashable,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TypeAlias,
+    TypeVar,
+    Union,
+)
 
 
 class AuditEvent(Enum):
@@ -16,16 +29,38 @@ class AuditEvent(Enum):
     CALL = auto()
     CLEAN = auto()
     REMOVE_KEY = auto()
+    TUNE = auto()
+
+    # members are singletons, the default Enum hash (of the member name) is much slower
+    __hash__ = object.__hash__
+
 
+class _missingtype(Enum):
+    MISSING = auto()
+
+
+# returned by cache lookups on a miss, so that every result (even 0) is a hit
+MISSING: Final = _missingtype.MISSING
+MissingType: TypeAlias = Literal[_missingtype.MISSING]
 
 CacheInfo = NamedTuple(
     "cachedop_cacheinfo",
-    [("size", int), ("hits", int), ("misses", int), ("cleanup_count", int)],
+    [("size", int), ("hits", int), ("misses", int), ("cleanup_count", int), ("coalesced", int), ("bytes", int)],
 )
-OperatorCallableType: TypeAlias = Callable[[int, int], int]
-KeyCallableType: TypeAlias = Callable[[tuple[int, ...]], Hashable]
+# the operands and results of a cached operation, results become operands of n-ary calls
+OperandT = TypeVar("OperandT", bound=Hashable)
+OperatorCallableType: TypeAlias = Callable[[OperandT, OperandT], OperandT]
+AsyncOperatorCallableType: TypeAlias = Callable[[OperandT, OperandT], Awaitable[OperandT]]
+KeyCallableType: TypeAlias = Callable[[tuple[OperandT, ...]], Hashable]
+SizerCallableType: TypeAlias = Callable[[OperandT], int]
 
 
+AuditRecord = NamedTuple(
+    "cachedop_auditrecord",
+    [("event", AuditEvent), ("args", dict[str, Any]), ("time", float)],
+)
 AuditCallableType: TypeAlias = Callable[[AuditEvent, dict[str, Any]], None]
+AuditSinkType: TypeAlias = Callable[[list[AuditRecord]], None]
 AuditDefaultDict: TypeAlias = defaultdict[AuditEvent, list[AuditCallableType]]
+AuditSinkDefaultDict: TypeAlias = defaultdict[AuditEvent, list[AuditSinkType]]
 AuditEvents: TypeAlias = Optional[Union[AuditEvent, Sequence[AuditEvent]]]
@@ -4,26 +4,231 @@
 
 from __future__ import annotations
 
-from typing_extensions import Hashable, Optional
+from array import array
+from threading import Event, Lock, get_ident, local
+from types import TracebackType
+from weakref import ReferenceType, finalize, ref
 
-from dhlibs.cachedop._typings import KeyCallableType
+from typing_extensions import Any, Callable, Hashable, Optional, TypeVar, Union, cast
+
+from dhlibs._typing import T
+from dhlibs.cachedop._typings import MISSING, KeyCallableType, MissingType
+
+_H = TypeVar("_H", bound=Hashable)
+
+
+def sortedargs(args: tuple[_H, ...]) -> tuple[_H, ...]:
+    """Sort operands, by hash if they cannot be compared to each other."""
+    try:
+        return tuple(sorted(cast("tuple[Any, ...]", args)))
+    except TypeError:
+        return tuple(sorted(args, key=hash))
 
 
 class keymaker:
-    def __init__(self, key: Optional[KeyCallableType] = None, order_matters: bool = True) -> None:
+    """
+    Turn argument tuples into cache keys.
+
+    Custom `key` callables are memoized per argument tuple. The memo holds
+    at most `memo_size` tuples, the oldest are dropped first, and the cache
+    calls `forget()` for every key it evicts. The default `hash` key is not
+    memoized: looking a tuple up in a memo hashes it anyway.
+    """
+
+    def __init__(
+        self,
+        key: Optional[KeyCallableType[Hashable]] = None,
+        order_matters: bool = True,
+        memo_size: Optional[int] = None,
+    ) -> None:
         self._key = key if key is not None else hash
         self._order_matters = order_matters
-        self._cache: dict[tuple[int, ...], Hashable] = {}
+        # stays empty for the default `hash` key
+        self._memo: dict[tuple[Hashable, ...], Hashable] = {}
+        # key -> the args tuple memoized for it, so evicted keys can be forgotten
+        self._args: dict[Hashable, tuple[Hashable, ...]] = {}
+        self._memo_size = memo_size if memo_size else 1 << 16
+        self._lock = Lock()
+        self.make_key: Callable[[tuple[Hashable, ...]], Hashable]
+        if key is not None:
+            self.make_key = self._memoized_key
+        elif order_matters:
+            self.make_key = hash
+        else:
+            self.make_key = self._sorted_hash
 
-    def make_key(self, args: tuple[int, ...]) -> Hashable:
+    def _sorted_hash(self, args: tuple[Hashable, ...]) -> Hashable:
+        if len(args) == 2:
+            x, y = cast("tuple[Any, Any]", args)
+            try:
+                return hash(args) if x <= y else hash((y, x))
+            except TypeError:
+                return hash(args) if hash(x) <= hash(y) else hash((y, x))
+        return hash(sortedargs(args))
+
+    def _memoized_key(self, args: tuple[Hashable, ...]) -> Hashable:
         if not self._order_matters:
-            args = tuple(sorted(args))
-        if key := self._cache.get(args):
+            args = sortedargs(args)
+        memo = self._memo
+        key = memo.get(args, MISSING)
+        if key is not MISSING:
             return key
         key = self._key(args)
-        self._cache[args] = key
+        with self._lock:
+            if len(memo) >= self._memo_size:
+                oldest = next(iter(memo))
+                okey = memo.pop(oldest)
+                if self._args.get(okey) == oldest:
+                    del self._args[okey]
+            memo[args] = key
+            self._args[key] = args
         return key
 
+    def forget(self, key: Hashable) -> None:
+        """Drop the memo of `key` once it left the cache."""
+        if not self._memo:
+            return
+        with self._lock:
+            args = self._args.pop(key, None)
+            if args is not None:
+                self._memo.pop(args, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memo.clear()
+            self._args.clear()
+
+
+class densetable:
+    """
+    Results of a binary operation over the int operands `lo..hi` (inclusive), in a flat int64 array.
+
+    A cell holds `missing` until its result is computed. Results that are not ints fitting
+    in int64 (or equal `missing`) are kept in a small overflow dict instead.
+    Reads of a cell do not lock: racing threads may compute the same cell twice. Writes lock
+    to keep the count of filled cells, so `size()` does not scan the table.
+    """
+
+    missing = -(1 << 63)
+
+    def __init__(self, lo: int, hi: int, symmetric: bool) -> None:
+        if hi < lo:
+            raise ValueError("domain upper bound is lower than its lower bound")
+        self.lo = lo
+        self.hi = hi
+        self.width = width = hi - lo + 1
+        self.symmetric = symmetric
+        self.table = array("q", [self.missing]) * (width * width)
+        self.overflow: dict[int, Hashable] = {}
+        self.filled = 0
+        self._lock = Lock()
+        self.hits = counter()
+        self.misses = counter()
+
+    def index(self, x: Hashable, y: Hashable) -> int:
+        """Return the cell of `(x, y)`, or -1 if they are not ints of the domain."""
+        lo, hi = self.lo, self.hi
+        if type(x) is int and type(y) is int and lo <= x <= hi and lo <= y <= hi:
+            return (x - lo) * self.width + (y - lo)
+        return -1
+
+    def get(self, index: int) -> Union[Hashable, MissingType]:
+        value = self.table[index]
+        if value == self.missing:
+            if not self.overflow:
+                return MISSING
+            return self.overflow.get(index, MISSING)
+        return value
+
+    def store(self, index: int, value: Hashable) -> None:
+        indexes = [index]
+        if self.symmetric:
+            x, y = divmod(index, self.width)
+            indexes.append(y * self.width + x)
+        table, missing = self.table, self.missing
+        with self._lock:
+            for cell in indexes:
+                if table[cell] == missing and cell not in self.overflow:
+                    self.filled += 1
+                if type(value) is int and -(1 << 63) < value < (1 << 63):
+                    table[cell] = value
+                else:
+                    self.overflow[cell] = value
+
+    def fill(self, op: Callable[[int, int], Hashable]) -> None:
+        """Compute every missing cell with `op`."""
+        lo = self.lo
+        for x in range(self.width):
+            for y in range(x if self.symmetric else 0, self.width):
+                index = x * self.width + y
+                if self.get(index) is MISSING:
+                    self.store(index, op(x + lo, y + lo))
+
+    def size(self) -> int:
+        return self.filled
+
+    def clear(self) -> None:
+        with self._lock:
+            self.table = array("q", [self.missing]) * len(self.table)
+            self.overflow.clear()
+            self.filled = 0
+        self.hits.reset()
+        self.misses.reset()
+
+
+class errorcache:
+    """
+    Exceptions raised for cache keys, so failing operands are not computed again.
+
+    At most `maxsize` exceptions are kept, the oldest are dropped first.
+    With a `ttl`, an exception is forgotten `ttl` seconds after it was raised.
+    """
+
+    def __init__(
+        self,
+        types: tuple[type[BaseException], ...],
+        maxsize: Optional[int],
+        ttl: Optional[float],
+        timer: Callable[[], float],
+    ) -> None:
+        self.types = types
+        self._maxsize = maxsize if maxsize else 1 << 16
+        self._ttl = ttl
+        self._timer = timer
+        # key -> (exception, its traceback when it was raised, expiry)
+        self._errors: dict[Hashable, tuple[BaseException, Optional[TracebackType], float]] = {}
+        self._lock = Lock()
+
+    def check(self, key: Hashable) -> None:
+        """Raise the exception cached for `key`, if any."""
+        entry = self._errors.get(key)
+        if entry is None:
+            return
+        error, traceback, expiry = entry
+        if self._ttl is not None and expiry <= self._timer():
+            with self._lock:
+                if self._errors.get(key) is entry:
+                    del self._errors[key]
+            return
+        # restore the original traceback, so it does not grow every time the exception is raised again
+        raise error.with_traceback(traceback)
+
+    def add(self, key: Hashable, error: BaseException) -> None:
+        if not isinstance(error, self.types):
+            return
+        expiry = self._timer() + self._ttl if self._ttl is not None else 0.0
+        with self._lock:
+            if key not in self._errors and len(self._errors) >= self._maxsize:
+                del self._errors[next(iter(self._errors))]
+            self._errors[key] = (error, error.__traceback__, expiry)
+
+    def __len__(self) -> int:
+        return len(self._errors)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._errors.clear()
+
 
 def determine_maxsize_args(maxsize: Optional[int], removal_limit: Optional[int]):
     if maxsize is None:
@@ -35,3 +240,180 @@ def determine_maxsize_args(maxsize: Optional[int], removal_limit: Optional[int])
     if removal_limit < 0 or removal_limit > maxsize:
         raise ValueError("removal limit cannot be zero, negative or higher than maxsize")
     return (maxsize, removal_limit)
+
+
+class _token:
+    # only held by a thread-local, so it dies with its thread
+    __slots__ = ("__weakref__",)
+
+
+class counter:
+    """
+    A counter that can be incremented from many threads without a shared lock.
+
+    Each thread increments its own cell, the total is summed up when read. The cell of a
+    finished thread is folded into a base total, so threads that come and go do not pile up.
+    """
+
+    def __init__(self) -> None:
+        self._local = local()
+        self._cells: dict[int, list[int]] = {}
+        self._base = 0
+        self._lock = Lock()
+
+    def _newcell(self) -> list[int]:
+        cell = [0]
+        token = _token()
+        with self._lock:
+            self._cells[id(cell)] = cell
+        self._local.cell = cell
+        self._local.token = token
+        finalize(token, counter._retire, ref(self), cell).atexit = False
+        return cell
+
+    @staticmethod
+    def _retire(owner: ReferenceType[counter], cell: list[int]) -> None:
+        self = owner()
+        if self is None:
+            return
+        with self._lock:
+            self._base += cell[0]
+            del self._cells[id(cell)]
+
+    def cell(self) -> list[int]:
+        """Return the cell of the calling thread, for callers that increment it themselves."""
+        try:
+            return self._local.cell
+        except AttributeError:
+            return self._newcell()
+
+    def add(self, value: int = 1) -> None:
+        try:
+            cell: list[int] = self._local.cell
+        except AttributeError:
+            cell = self._newcell()
+        cell[0] += value
+
+    def value(self) -> int:
+        with self._lock:
+            return self._base + sum(cell[0] for cell in self._cells.values())
+
+    def reset(self) -> None:
+        with self._lock:
+            self._base = 0
+            for cell in self._cells.values():
+                cell[0] = 0
+
+
+class threadcache:
+    """
+    Small per-thread caches in front of a shared cache.
+
+    Each thread reads and writes its own dict without any lock, the oldest entry is dropped
+    once it holds `maxsize` entries. `invalidate()` bumps a generation number, every thread
+    drops its entries the next time it sees that number changed. The entries only live in
+    thread-local storage, so they go away with their thread.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        if maxsize <= 0:
+            raise ValueError("thread cache size cannot be zero or negative")
+        self._maxsize = maxsize
+        self._generation = 0
+        self._local = local()
+        self._hits = counter()
+        self._lock = Lock()
+
+    def _slot(self) -> list[Any]:
+        try:
+            slot: list[Any] = self._local.slot
+        except AttributeError:
+            # [generation, entries, hit cell]
+            slot = [self._generation, {}, self._hits.cell()]
+            self._local.slot = slot
+        if slot[0] != self._generation:
+            slot[0], slot[1] = self._generation, {}
+        return slot
+
+    def get(self, key: Hashable) -> Union[Hashable, MissingType]:
+        slot = self._slot()
+        cached = slot[1].get(key, MISSING)
+        if cached is not MISSING:
+            slot[2][0] += 1
+        return cached
+
+    def put(self, key: Hashable, value: Hashable) -> None:
+        entries: dict[Hashable, Hashable] = self._slot()[1]
+        if len(entries) >= self._maxsize:
+            del entries[next(iter(entries))]
+        entries[key] = value
+
+    def hits(self) -> int:
+        return self._hits.value()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._hits.reset()
+
+
+class _flight:
+    __slots__ = ("done", "error", "owner", "value")
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.owner = get_ident()
+        self.value: object = None
+        self.error: Optional[BaseException] = None
+
+
+class singleflight:
+    """
+    Coalesce concurrent calls for the same key.
+
+    The first caller of a key runs the callable, other threads calling
+    the same key meanwhile wait for and share its result (or its exception).
+    A thread that re-enters its own in-flight key runs the callable directly.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._flights: dict[Hashable, _flight] = {}
+        self._coalesced = 0
+
+    @property
+    def coalesced(self) -> int:
+        return self._coalesced
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _flight()
+                leader = True
+            elif flight.owner == get_ident():
+                leader = None
+            else:
+                self._coalesced += 1
+                leader = False
+        if leader is None:
+            return func()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value  # type: ignore[return-value]
+        try:
+            flight.value = value = func()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._coalesced = 0
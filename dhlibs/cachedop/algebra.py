@@ -0,0 +1,118 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.algebra - algebraic properties of cached operations"""
+
+from __future__ import annotations
+
+import math
+import operator
+from functools import partial, reduce
+
+from typing_extensions import Any, Callable, Hashable, NamedTuple, Optional, Sequence, TypeVar, cast
+
+from dhlibs.cachedop._utils import sortedargs
+
+_H = TypeVar("_H", bound=Hashable)
+
+
+class Algebra(NamedTuple):
+    """
+    The algebraic properties of a binary operation.
+
+    They let the cache rewrite the operands of a call into a canonical form,
+    so every call with the same result shares a single cache entry:
+
+    - `identity` operands are dropped (`add(x, 0, y)` is `add(x, y)`),
+    - operands of a `commutative` operation are sorted (by hash if they cannot be compared),
+      so an n-ary call is keyed by its multiset,
+    - duplicates are collapsed for `idempotent` operations (`max(x, x)` is `x`).
+
+    Calls with more than two operands are only rewritten if the operation is `associative`,
+    since regrouping their operands could change the result otherwise.
+    """
+
+    associative: bool = False
+    commutative: bool = False
+    identity: Optional[Hashable] = None
+    idempotent: bool = False
+
+    def canonicalize(self, args: tuple[_H, ...]) -> tuple[_H, ...]:
+        """Return the canonical operands of `args`, always at least one."""
+        if len(args) > 2 and not self.associative:
+            return args
+        identity = self.identity
+        if identity is not None:
+            args = tuple(arg for arg in args if arg != identity) or args[:1]
+        if self.commutative:
+            return sortedargs(tuple(set(args)) if self.idempotent else args)
+        if self.idempotent:
+            return tuple(arg for index, arg in enumerate(args) if not index or arg != args[index - 1])
+        return args
+
+
+NaryCallableType = Callable[[Sequence[Any]], Any]
+
+
+def _sum(args: Sequence[Any]) -> Any:
+    # sum() refuses strings and bytes, joining them is what it would recommend
+    first = args[0]
+    if type(first) in (str, bytes) and all(type(arg) is type(first) for arg in args):
+        return first[:0].join(args)
+    # starting from the first operand, so non-numbers (e.g. tuples) can be added as well
+    return sum(args[1:], args[0])
+
+
+def _prod(args: Sequence[Any]) -> Any:
+    return math.prod(args[1:], start=args[0])
+
+
+def _gcd(args: Sequence[int]) -> int:
+    return math.gcd(*args)
+
+
+def _lcm(args: Sequence[int]) -> int:
+    return math.lcm(*args)
+
+
+# untyped in typeshed
+_xor = cast("Callable[[Any, Any], Any]", operator.xor)  # pyright: ignore[reportUnknownMemberType]
+_or = cast("Callable[[Any, Any], Any]", operator.or_)  # pyright: ignore[reportUnknownMemberType]
+_and = cast("Callable[[Any, Any], Any]", operator.and_)  # pyright: ignore[reportUnknownMemberType]
+
+# builtin operations and their n-ary equivalents implemented in C
+_known: dict[Callable[..., Any], NaryCallableType] = {
+    operator.add: _sum,
+    operator.mul: _prod,
+    max: max,
+    min: min,
+    math.gcd: _gcd,
+    math.lcm: _lcm,
+    _xor: partial(reduce, _xor),
+    _or: partial(reduce, _or),
+    _and: partial(reduce, _and),
+}
+
+
+def nary_equivalent(op: Callable[..., Any]) -> Optional[NaryCallableType]:
+    """
+    Return a callable reducing a whole sequence of operands like folding `op` over them, if `op` is known.
+
+    Known operations are `operator.add`, `operator.mul`, `max`, `min`, `math.gcd`, `math.lcm`,
+    `operator.xor`, `operator.or_`, `operator.and_` and binary NumPy ufuncs (reduced by `ufunc.reduce`).
+    """
+    try:
+        nary = _known.get(op)
+    except TypeError:
+        # unhashable callables
+        return None
+    if nary is not None:
+        return nary
+    # NumPy ufuncs, without importing NumPy
+    if type(op).__name__ == "ufunc" and getattr(op, "nin", None) == 2 and getattr(op, "nout", None) == 1:
+        return getattr(op, "reduce", None)
+    return None
+
+
+__all__ = ["Algebra", "nary_equivalent"]
@@ -4,10 +4,27 @@
 
 from __future__ import annotations
 
-from typing_extensions import Any, Mapping
+import asyncio
+import json
+import traceback
+from collections import deque
+from pathlib import Path
+from random import random
+from threading import Condition, Lock, Thread
+from time import time
+
+from typing_extensions import Any, Literal, Mapping, Optional, Union
 
 from dhlibs.alias_callable import alias_callable
-from dhlibs.cachedop._typings import AuditCallableType, AuditDefaultDict, AuditEvent, AuditEvents
+from dhlibs.cachedop._typings import (
+    AuditCallableType,
+    AuditDefaultDict,
+    AuditEvent,
+    AuditEvents,
+    AuditRecord,
+    AuditSinkDefaultDict,
+    AuditSinkType,
+)
 
 
 def _resolve_events(events: AuditEvents) -> list[AuditEvent]:
@@ -24,20 +41,220 @@ def _resolve_events(events: AuditEvents) -> list[AuditEvent]:
 class Auditer:
     def __init__(self) -> None:
         self._events = AuditDefaultDict(list)
+        self._rates: dict[AuditEvent, float] = {}
+        # the events that have listeners, the set is updated in place so callers may keep it
+        self.active: set[AuditEvent] = set()
 
     def register(self, callback: AuditCallableType, on_events: AuditEvents = None) -> None:
         for event in _resolve_events(on_events):
             self._events[event].append(callback)
+            self.active.add(event)
 
     def clear(self, events: AuditEvents) -> None:
         for event in _resolve_events(events):
             self._events[event].clear()
+            self.active.discard(event)
+
+    def set_sample_rate(self, rate: float, on_events: AuditEvents = None) -> None:
+        """
+        Only audit a `rate` fraction of the given events, e.g. `0.01` audits 1% of them.
+        A rate of `1` audits every event again.
+        """
+        if not 0 <= rate <= 1:
+            raise ValueError("sample rate must be between 0 and 1")
+        for event in _resolve_events(on_events):
+            if rate == 1:
+                self._rates.pop(event, None)
+            else:
+                self._rates[event] = rate
+
+    def enabled(self, event: AuditEvent) -> bool:
+        """
+        Tell if `event` should be audited now.
+        Callers check this before building the event arguments,
+        so events without callbacks cost a single dict lookup.
+        """
+        if event not in self.active:
+            return False
+        rate = self._rates.get(event)
+        return rate is None or random() < rate
 
     def audit(self, event: AuditEvent, args: Mapping[str, Any]):
+        callbacks = self._events.get(event)
+        if not callbacks:
+            return
         args = dict(args)
-        for callback in self._events[event]:
+        for callback in callbacks:
             callback(event, args)
 
 
+class BatchedAuditer(Auditer):
+    """
+    An auditer that queues events instead of running callbacks in the audited thread.
+
+    Events are pushed onto a bounded queue and delivered in batches by a background
+    thread (`start()`) or an asyncio task (`start_task()`). Registered callbacks
+    receive events one by one, sinks added by `add_sink()` receive whole batches.
+    When the queue is full, new events are dropped (and counted in `dropped`)
+    if `overflow` is "drop", or the audited thread waits for room if it is "block".
+    Exceptions of callbacks and sinks are printed to stderr and counted in `failed`,
+    delivery goes on with the next ones.
+    """
+
+    def __init__(
+        self,
+        maxlen: int = 65536,
+        batch_size: int = 512,
+        overflow: Literal["drop", "block"] = "drop",
+        flush_interval: float = 0.5,
+    ) -> None:
+        super().__init__()
+        if maxlen <= 0 or batch_size <= 0:
+            raise ValueError("maxlen and batch_size must be positive")
+        if overflow not in ("drop", "block"):
+            raise ValueError(f"unknown overflow policy: {overflow!r}")
+        self._maxlen = maxlen
+        self._batch_size = batch_size
+        self._overflow = overflow
+        self._flush_interval = flush_interval
+        self._queue: deque[AuditRecord] = deque()
+        self._cond = Condition(Lock())
+        self._sinks = AuditSinkDefaultDict(list)
+        self._thread: Optional[Thread] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._closed = False
+        self.dropped = 0
+        self.failed = 0
+
+    def add_sink(self, sink: AuditSinkType, on_events: AuditEvents = None) -> None:
+        for event in _resolve_events(on_events):
+            self._sinks[event].append(sink)
+            self.active.add(event)
+
+    def clear(self, events: AuditEvents) -> None:
+        super().clear(events)
+        for event in _resolve_events(events):
+            self._sinks[event].clear()
+
+    def audit(self, event: AuditEvent, args: Mapping[str, Any]):
+        if not self._events.get(event) and not self._sinks.get(event):
+            return
+        record = AuditRecord(event, dict(args), time())
+        with self._cond:
+            while len(self._queue) >= self._maxlen:
+                if self._overflow == "drop" or self._closed:
+                    self.dropped += 1
+                    return
+                self._cond.wait()
+            self._queue.append(record)
+            if len(self._queue) >= self._batch_size:
+                self._cond.notify_all()
+
+    def _take(self) -> list[AuditRecord]:
+        # must be called with the condition held
+        queue = self._queue
+        batch = [queue.popleft() for _ in range(min(self._batch_size, len(queue)))]
+        if batch:
+            self._cond.notify_all()
+        return batch
+
+    def _report(self) -> None:
+        # like an uncaught exception in a thread, but the delivery must go on
+        self.failed += 1
+        traceback.print_exc()
+
+    def _deliver(self, batch: list[AuditRecord]) -> None:
+        sinks: dict[int, tuple[AuditSinkType, list[AuditRecord]]] = {}
+        for record in batch:
+            for callback in self._events.get(record.event, ()):
+                try:
+                    callback(record.event, record.args)
+                except Exception:
+                    self._report()
+            for sink in self._sinks.get(record.event, ()):
+                sinks.setdefault(id(sink), (sink, []))[1].append(record)
+        for sink, records in sinks.values():
+            try:
+                sink(records)
+            except Exception:
+                self._report()
+
+    def flush(self) -> None:
+        """Deliver every queued event in the calling thread."""
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self._deliver(batch)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closed and len(self._queue) < self._batch_size:
+                    self._cond.wait(self._flush_interval)
+                batch = self._take()
+                if not batch and self._closed:
+                    return
+            if batch:
+                self._deliver(batch)
+
+    def start(self) -> None:
+        """Deliver events from a background daemon thread."""
+        if self._thread is not None or self._task is not None:
+            raise RuntimeError("auditer is already started")
+        self._closed = False
+        self._thread = Thread(target=self._run, name="cachedop-audit", daemon=True)
+        self._thread.start()
+
+    async def _run_async(self) -> None:
+        try:
+            while not self._closed:
+                await asyncio.sleep(self._flush_interval)
+                self.flush()
+        finally:
+            self.flush()
+
+    def start_task(self) -> asyncio.Task[None]:
+        """
+        Deliver events from an asyncio task of the running event loop.
+        Use the "drop" overflow policy if events are also audited from the loop thread.
+        """
+        if self._thread is not None or self._task is not None:
+            raise RuntimeError("auditer is already started")
+        self._closed = False
+        self._task = asyncio.get_running_loop().create_task(self._run_async())
+        return self._task
+
+    def stop(self) -> None:
+        """Stop the background thread or task, delivering every queued event first."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+
+
+class JSONLFileSink:
+    """A batch sink that appends every audit record as a JSON line to `path`."""
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self._path = Path(path)
+        self._lock = Lock()
+
+    def __call__(self, records: list[AuditRecord]) -> None:
+        lines = [
+            json.dumps({"event": record.event.name, "time": record.time, "args": record.args}, default=repr)
+            for record in records
+        ]
+        with self._lock, self._path.open("a", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+
 audit = Auditer()
 register_audit_callback = alias_callable(audit.register, "register_audit_callback", qualname="register_audit_callback")
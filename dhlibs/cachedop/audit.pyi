@@ -22,15 +22,43 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing_extensions import Any, Mapping
+import asyncio
+from pathlib import Path
 
-from dhlibs.cachedop._typings import AuditCallableType, AuditEvent, AuditEvents
+from typing_extensions import Any, Literal, Mapping, Union
+
+from dhlibs.cachedop._typings import AuditCallableType, AuditEvent, AuditEvents, AuditRecord, AuditSinkType
 
 class Auditer:
+    active: set[AuditEvent]
+
     def register(self, callback: AuditCallableType, on_events: AuditEvents = None) -> None: ...
     def clear(self, events: AuditEvents) -> None: ...
+    def set_sample_rate(self, rate: float, on_events: AuditEvents = None) -> None: ...
+    def enabled(self, event: AuditEvent) -> bool: ...
     def audit(self, event: AuditEvent, args: Mapping[str, Any]) -> None: ...
 
+class BatchedAuditer(Auditer):
+    dropped: int
+    failed: int
+
+    def __init__(
+        self,
+        maxlen: int = 65536,
+        batch_size: int = 512,
+        overflow: Literal["drop", "block"] = "drop",
+        flush_interval: float = 0.5,
+    ) -> None: ...
+    def add_sink(self, sink: AuditSinkType, on_events: AuditEvents = None) -> None: ...
+    def flush(self) -> None: ...
+    def start(self) -> None: ...
+    def start_task(self) -> asyncio.Task[None]: ...
+    def stop(self) -> None: ...
+
+class JSONLFileSink:
+    def __init__(self, path: Union[str, Path]) -> None: ...
+    def __call__(self, records: list[AuditRecord]) -> None: ...
+
 audit = Auditer()
 
 def register_audit_callback(callback: AuditCallableType, on_events: AuditEvents = None) -> None: ...
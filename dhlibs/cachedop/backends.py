@@ -0,0 +1,352 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.backends - storage backends for cached_opfunc"""
+
+from __future__ import annotations
+
+import atexit
+import pickle
+import sqlite3
+import struct
+import weakref
+from contextlib import AbstractContextManager, nullcontext
+from functools import partial
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from threading import RLock
+
+from typing_extensions import Any, Callable, Hashable, Iterator, MutableMapping, Optional, TypeAlias, Union, cast
+
+# any mutable mapping can store cache entries, a plain dict is the default backend
+BackendType: TypeAlias = Union[MutableMapping[Hashable, Any], Callable[[], MutableMapping[Hashable, Any]]]
+
+_deleted = object()
+
+
+def _dumps(obj: object) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _flush_at_exit(ref: weakref.ReferenceType[SQLiteBackend]) -> None:
+    backend = ref()
+    if backend is not None:
+        backend.close()
+
+
+class SQLiteBackend(MutableMapping[Hashable, Any]):
+    """
+    A persistent cache backend stored in a SQLite database.
+
+    Writes are buffered in memory and committed in batches of `flush_size`
+    entries, so cache misses do not wait for the disk. Buffered writes are
+    committed by `flush()`, `close()` and at interpreter exit.
+    Keys and values are stored pickled, so they must be picklable.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        table: str = "cachedop",
+        flush_size: int = 1024,
+    ) -> None:
+        if not table.isidentifier():
+            raise ValueError(f"invalid table name: {table!r}")
+        if flush_size <= 0:
+            raise ValueError("flush_size must be positive")
+        self._path = Path(path)
+        self._table = table
+        self._flush_size = flush_size
+        self._lock = RLock()
+        self._pending: dict[Hashable, object] = {}
+        # keys known to be missing from the database, so a miss then its store query it once
+        self._absent: set[Hashable] = set()
+        self._conn: Optional[sqlite3.Connection] = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key BLOB PRIMARY KEY, value BLOB NOT NULL)")
+        self._conn.commit()
+        (self._size,) = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        self._at_exit = partial(_flush_at_exit, weakref.ref(self))
+        atexit.register(self._at_exit)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise ValueError("backend is closed")
+        return self._conn
+
+    def _stored(self, key: Hashable) -> object:
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._absent:
+            return _deleted
+        row = self.conn.execute(f"SELECT value FROM {self._table} WHERE key = ?", (_dumps(key),)).fetchone()
+        if row is None:
+            if len(self._absent) >= self._flush_size:
+                self._absent.clear()
+            self._absent.add(key)
+            return _deleted
+        return pickle.loads(row[0])
+
+    def __getitem__(self, key: Hashable) -> Any:
+        with self._lock:
+            value = self._stored(key)
+        if value is _deleted:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            if self._stored(key) is _deleted:
+                self._size += 1
+                self._absent.discard(key)
+            self._pending[key] = value
+            if len(self._pending) >= self._flush_size:
+                self.flush()
+
+    def __delitem__(self, key: Hashable) -> None:
+        with self._lock:
+            if self._stored(key) is _deleted:
+                raise KeyError(key)
+            self._size -= 1
+            self._pending[key] = _deleted
+            if len(self._pending) >= self._flush_size:
+                self.flush()
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return self._stored(key) is not _deleted  # type: ignore[arg-type]
+
+    def __iter__(self) -> Iterator[Hashable]:
+        with self._lock:
+            self.flush()
+            keys = [pickle.loads(row[0]) for row in self.conn.execute(f"SELECT key FROM {self._table}")]
+        return iter(keys)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            self._absent.clear()
+            self.conn.execute(f"DELETE FROM {self._table}")
+            self.conn.commit()
+            self._size = 0
+
+    def flush(self) -> None:
+        """Commit buffered writes to the database in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            upserts = [(_dumps(key), _dumps(value)) for key, value in self._pending.items() if value is not _deleted]
+            deletes = [(_dumps(key),) for key, value in self._pending.items() if value is _deleted]
+            with self.conn:
+                self.conn.executemany(f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)", upserts)
+                self.conn.executemany(f"DELETE FROM {self._table} WHERE key = ?", deletes)
+            self._pending.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is None:
+                return
+            self.flush()
+            self._conn.close()
+            self._conn = None
+            atexit.unregister(self._at_exit)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {str(self._path)!r} table={self._table!r}>"
+
+
+class SharedMemoryBackend(MutableMapping[Hashable, int]):
+    """
+    A cache backend shared by every process on the host, stored in `multiprocessing.shared_memory`.
+
+    Entries live in a fixed-size open-addressing hash table with linear probing,
+    each slot holds a sequence number, a state, an int64 key and an int64 value.
+    A key is only looked for in the few slots after its own, when they are all taken
+    a new key overwrites the entry in its own slot, so a full table still answers in
+    constant time. Readers never lock: a slot is re-read if its sequence number changed
+    while reading it. Writers should share a `multiprocessing.Lock` passed as `lock`,
+    otherwise concurrent writers may overwrite each other's entries and `len()` may
+    drift from the number of entries.
+
+    Only int keys (the default `hash` keys) are supported. Values that are not ints
+    fitting in int64 are silently not stored.
+    Create the table in the parent process, then attach to it by `name`
+    (with `create=False`) or inherit it when forking workers.
+    Every process adds entries to the same table, so caches using it cannot be bounded
+    by `maxsize` or `max_bytes`, size the table with `slots` instead.
+    """
+
+    # entries are added and removed by other processes too
+    shared = True
+    _header = struct.Struct("<8sqq")
+    _slot = struct.Struct("<qqqq")
+    # the sequence number and the rest of a slot, written separately
+    _seq = struct.Struct("<q")
+    _data = struct.Struct("<qqq")
+    _magic = b"DHCOSHM1"
+    _empty, _used, _deleted = 0, 1, 2
+    # slots looked at for a key, starting from its own
+    _probes = 16
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        slots: int = 1 << 16,
+        create: bool = True,
+        lock: Optional[AbstractContextManager[Any]] = None,
+    ) -> None:
+        self._lock = lock
+        if create:
+            if slots <= 0 or slots & (slots - 1):
+                raise ValueError("slots must be a positive power of two")
+            self._shm = SharedMemory(name, create=True, size=self._header.size + self._slot.size * slots)
+            self._buf = cast(memoryview, self._shm.buf)
+            self._header.pack_into(self._buf, 0, self._magic, slots, 0)
+        else:
+            if name is None:
+                raise ValueError("name is required to attach to an existing table")
+            self._shm = SharedMemory(name)
+            # the creator owns the segment, attaching processes must not unlink it on exit
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # type: ignore[attr-defined]
+            self._buf = cast(memoryview, self._shm.buf)
+            magic, slots, _ = self._header.unpack_from(self._buf, 0)
+            if magic != self._magic:
+                raise ValueError(f"{name!r} is not a cachedop shared memory table")
+        self._slots = slots
+        self._mask = slots - 1
+        self._owner = create
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def _writing(self) -> AbstractContextManager[Any]:
+        return self._lock if self._lock is not None else nullcontext()
+
+    def _offset(self, index: int) -> int:
+        return self._header.size + self._slot.size * index
+
+    def _read(self, offset: int) -> tuple[int, int, int]:
+        unpack, buf = self._slot.unpack_from, self._buf
+        while True:
+            seq, state, key, value = unpack(buf, offset)
+            if not seq & 1 and unpack(buf, offset)[0] == seq:
+                return state, key, value
+
+    def _write(self, offset: int, state: int, key: int, value: int) -> None:
+        # odd while the data changes, the even number is only published after it
+        seq = self._seq.unpack_from(self._buf, offset)[0]
+        self._seq.pack_into(self._buf, offset, seq + 1)
+        self._data.pack_into(self._buf, offset + self._seq.size, state, key, value)
+        self._seq.pack_into(self._buf, offset, seq + 2)
+
+    def _count(self, delta: int) -> None:
+        _, slots, count = self._header.unpack_from(self._buf, 0)
+        self._header.pack_into(self._buf, 0, self._magic, slots, count + delta)
+
+    def _find(self, key: Hashable) -> tuple[int, Optional[int]]:
+        # returns (offset of the key or -1, offset of the first free slot for it or None)
+        if not isinstance(key, int):
+            raise TypeError(f"{self.__class__.__name__} only supports int keys, got {key!r}")
+        free: Optional[int] = None
+        index = key & self._mask
+        for _ in range(min(self._probes, self._slots)):
+            offset = self._offset(index)
+            state, skey, _ = self._read(offset)
+            if state == self._empty:
+                return -1, offset if free is None else free
+            if state == self._deleted:
+                if free is None:
+                    free = offset
+            elif skey == key:
+                return offset, None
+            index = (index + 1) & self._mask
+        return -1, free
+
+    def __getitem__(self, key: Hashable) -> int:
+        offset, _ = self._find(key)
+        if offset < 0:
+            raise KeyError(key)
+        state, skey, value = self._read(offset)
+        if state != self._used or skey != key:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: int) -> None:
+        if type(value) is not int or not -(1 << 63) <= value < (1 << 63):
+            return
+        with self._writing():
+            offset, free = self._find(key)
+            if offset >= 0:
+                self._write(offset, self._used, key, value)  # type: ignore[arg-type]
+            elif free is not None:
+                self._write(free, self._used, key, value)  # type: ignore[arg-type]
+                self._count(1)
+            else:
+                # every probed slot is taken, evict the entry in the key's own slot
+                self._write(self._offset(key & self._mask), self._used, key, value)  # type: ignore[operator]
+
+    def __delitem__(self, key: Hashable) -> None:
+        with self._writing():
+            offset, _ = self._find(key)
+            if offset < 0:
+                raise KeyError(key)
+            self._write(offset, self._deleted, 0, 0)
+            self._count(-1)
+
+    def __contains__(self, key: object) -> bool:
+        if not isinstance(key, int):
+            return False
+        return self._find(key)[0] >= 0
+
+    def __iter__(self) -> Iterator[Hashable]:
+        for index in range(self._slots):
+            state, key, _ = self._read(self._offset(index))
+            if state == self._used:
+                yield key
+
+    def __len__(self) -> int:
+        return self._header.unpack_from(self._buf, 0)[2]
+
+    def clear(self) -> None:
+        with self._writing():
+            for index in range(self._slots):
+                offset = self._offset(index)
+                if self._read(offset)[0] != self._empty:
+                    self._write(offset, self._empty, 0, 0)
+            _, slots, _ = self._header.unpack_from(self._buf, 0)
+            self._header.pack_into(self._buf, 0, self._magic, slots, 0)
+
+    def close(self) -> None:
+        """Detach from the table, the creator also frees it."""
+        self._buf.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # pickled copies (e.g. sent to spawned workers) attach to the same table
+        return (self.__class__, (self.name, self._slots, False, self._lock))
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.name!r} slots={self._slots}>"
+
+
+def resolve_backend(backend: Optional[BackendType]) -> MutableMapping[Hashable, Any]:
+    if backend is None:
+        return {}
+    if isinstance(backend, MutableMapping):
+        return cast("MutableMapping[Hashable, Any]", backend)
+    if callable(backend):
+        return backend()
+    raise TypeError(f"invalid cache backend: {backend!r}")
+
+
+__all__ = ["SQLiteBackend", "SharedMemoryBackend", "resolve_backend"]
@@ -4,17 +4,57 @@
 
 from __future__ import annotations
 
+import asyncio
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextvars import ContextVar
 from functools import partial, reduce
-from random import sample
+from heapq import heappop, heappush
+from inspect import iscoroutinefunction
+from sys import getsizeof
 from threading import RLock as Lock
+from threading import Thread
+from time import monotonic
 
-from typing_extensions import Hashable, Optional
+from typing_extensions import (
+    Any,
+    Callable,
+    Generic,
+    Hashable,
+    Iterable,
+    Literal,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+    cast,
+)
 
-from dhlibs.cachedop._typings import AuditEvent, CacheInfo, KeyCallableType, OperatorCallableType
+from dhlibs.cachedop._typings import (
+    MISSING,
+    AsyncOperatorCallableType,
+    AuditEvent,
+    CacheInfo,
+    KeyCallableType,
+    MissingType,
+    OperatorCallableType,
+    SizerCallableType,
+)
+from dhlibs.cachedop._utils import counter, densetable, errorcache, keymaker, singleflight, threadcache
 from dhlibs.cachedop._utils import determine_maxsize_args as _determine_maxsize_args
-from dhlibs.cachedop._utils import keymaker
+from dhlibs.cachedop.algebra import Algebra, NaryCallableType, nary_equivalent
 from dhlibs.cachedop.audit import Auditer
 from dhlibs.cachedop.audit import audit as global_audit
+from dhlibs.cachedop.backends import BackendType, resolve_backend
+from dhlibs.cachedop.metrics import WrapperMetrics, register_wrapper
+from dhlibs.cachedop.policies import EvictionPolicy, PolicyType, RandomPolicy, resolve_policy
+from dhlibs.cachedop.reducer import SegmentTreeReducer
+from dhlibs.cachedop.snapshot import dumps, frozentier
+from dhlibs.cachedop.tracing import TraceRecorder
+from dhlibs.cachedop.tuning import sizetuner
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+# looking up an Enum member is slow, the fast call path uses this instead
+_HIT = AuditEvent.HIT
 
 
 class _cachemap:
@@ -24,124 +64,1242 @@ class _cachemap:
         maxsize: Optional[int],
         removal_limit: Optional[int],
         auditer: Auditer,
+        policy: PolicyType = "random",
+        lockfree_reads: bool = False,
+        backend: Optional[BackendType] = None,
+        max_bytes: Optional[int] = None,
+        sizer: Optional[SizerCallableType[Hashable]] = None,
+        ttl: Optional[float] = None,
+        refresh_ahead: Optional[float] = None,
+        timer: Callable[[], float] = monotonic,
+        trace: Optional[TraceRecorder] = None,
+        adaptive: Optional[tuple[int, int]] = None,
     ) -> None:
         self._keymaker = keymaker
-        self._dcache: dict[Hashable, int] = {}
+        self._trace = trace
+        self._dcache = resolve_backend(backend)
+        if getattr(self._dcache, "shared", False) and (maxsize is not None or max_bytes is not None):
+            # other processes add and remove entries that the eviction policy of this one never sees
+            raise ValueError("maxsize and max_bytes cannot bound a backend shared between processes")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("ttl cannot be zero or negative")
+        if refresh_ahead is not None and (ttl is None or not 0 < refresh_ahead < ttl):
+            raise ValueError("refresh_ahead needs a ttl and must be between zero and ttl")
+        self._ttl = ttl
+        self._refresh_ahead = refresh_ahead
+        self._timer = timer
+        self._expires: dict[Hashable, float] = {}
+        # (expiry, sequence, key), the sequence keeps keys from being compared
+        self._expiry_heap: list[tuple[float, int, Hashable]] = []
+        self._expiry_seq = 0
+        self._refreshing: set[Hashable] = set()
         maxsize, removal_limit = _determine_maxsize_args(maxsize, removal_limit)
         self._maxsize = maxsize
         self._removal_limit = removal_limit
+        self._tuner: Optional[sizetuner] = None
+        if adaptive is not None:
+            if maxsize is None or not adaptive[0] <= maxsize <= adaptive[1]:
+                raise ValueError("adaptive caches need a maxsize within their bounds")
+            self._tuner = sizetuner(*adaptive)
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("max_bytes cannot be zero or negative")
+        self._max_bytes = max_bytes
+        # entry sizes are only tracked when asked for
+        self._sizer = sizer if sizer is not None else (getsizeof if max_bytes is not None else None)
+        self._sizes: dict[Hashable, int] = {}
+        self._bytes = 0
+        self._policy = resolve_policy(policy)
+        self._policy.setup(maxsize)
+        # a persistent backend may already hold entries
+        for key in self._dcache:
+            self._policy.insert(key)
+            if self._sizer is not None:
+                self._sizes[key] = size = self._sizer(self._dcache[key])
+                self._bytes += size
+            self._set_expiry(key)
         self._hits = 0
+        self._lockfree_hits = counter() if lockfree_reads and ttl is None and not self._policy.tracks_access else None
         self._misses = 0
         self._cleanup_count = 0
         self._thread_lock = Lock()
         self._auditer = auditer
+        # read-only entries consulted before the cache, see freeze()
+        self._frozen: Optional[frozentier] = None
+        self._frozen_hits = counter()
+
+    def _full(self, incoming: int = 0) -> bool:
+        if self._maxsize is not None and len(self._dcache) >= self._maxsize:
+            return True
+        return self._max_bytes is not None and self._bytes + incoming > self._max_bytes
+
+    def _victim(self, incoming: int = 0) -> Optional[Hashable]:
+        if not self._dcache or not self._full(incoming):
+            return None
+        return self._policy.victim()
+
+    def _remove(self, key: Hashable, removed: list[Hashable]) -> None:
+        self._policy.remove(key)
+        self._expires.pop(key, None)
+        try:
+            self._dcache.pop(key)
+        except KeyError:
+            pass
+        else:
+            self._cleanup_count += 1
+            self._bytes -= self._sizes.pop(key, 0)
+            self._keymaker.forget(key)
+            removed.append(key)
+
+    def _remove_victim(self, removed: list[Hashable]) -> None:
+        self._remove(self._policy.victim(), removed)
+
+    def _set_expiry(self, key: Hashable) -> None:
+        if self._ttl is None:
+            return
+        expiry = self._timer() + self._ttl
+        self._expires[key] = expiry
+        self._expiry_seq += 1
+        heappush(self._expiry_heap, (expiry, self._expiry_seq, key))
+
+    def _expired(self, key: Hashable, now: float) -> bool:
+        expiry = self._expires.get(key)
+        return expiry is not None and expiry <= now
+
+    def _sweep(self, removed: list[Hashable]) -> None:
+        # must be called with the lock held, only pops entries that already expired
+        heap = self._expiry_heap
+        if not heap:
+            return
+        now = self._timer()
+        while heap and heap[0][0] <= now:
+            expiry, _, key = heappop(heap)
+            # skip heap entries of keys that were stored again since
+            if self._expires.get(key) == expiry:
+                self._remove(key, removed)
+
+    def _evict(self, incoming: int = 0) -> list[Hashable]:
+        # must be called with the lock held, the removed keys are audited by the caller once it is released
+        removed: list[Hashable] = []
+        if self._maxsize is not None and self._removal_limit is not None and len(self._dcache) >= self._maxsize:
+            count = self._removal_limit if self._policy.batched else 1
+            for _ in range(min(count, len(self._dcache))):
+                self._remove_victim(removed)
+        while self._max_bytes is not None and self._dcache and self._bytes + incoming > self._max_bytes:
+            self._remove_victim(removed)
+        return removed
+
+    def _audit_removed(self, removed: list[Hashable]) -> None:
+        if not removed:
+            return
+        if self._auditer.enabled(AuditEvent.CLEAN):
+            count = self._removal_limit if self._policy.batched else 1
+            self._auditer.audit(AuditEvent.CLEAN, {"removal_limit": count})
+        for key in removed:
+            if self._auditer.enabled(AuditEvent.REMOVE_KEY):
+                self._auditer.audit(AuditEvent.REMOVE_KEY, {"key": key})
 
     def cleancache(self) -> None:
-        if self._maxsize is None or self._removal_limit is None or len(self._dcache) < self._maxsize:
+        if not self._full():
             return
         with self._thread_lock:
-            self._auditer.audit(AuditEvent.CLEAN, {"removal_limit": self._removal_limit})
-            history = tuple(self._dcache.keys())
-            for key in sample(history, self._removal_limit):
-                self._auditer.audit(AuditEvent.REMOVE_KEY, {"key": key})
-                try:
-                    self._dcache.pop(key)
-                except KeyError:
-                    pass
-                else:
-                    self._cleanup_count += 1
+            removed = self._evict()
+        self._audit_removed(removed)
 
-    def getcache(self, args: tuple[int, ...]) -> Optional[int]:
+    def expire(self) -> None:
+        removed: list[Hashable] = []
         with self._thread_lock:
-            key = self._keymaker.make_key(args)
-            cached = self._dcache.get(key)
-            if cached:
+            self._sweep(removed)
+        self._audit_removed(removed)
+
+    def _lookup_frozen(self, key: Hashable) -> Union[Hashable, MissingType]:
+        cached = cast(frozentier, self._frozen).get(key)
+        if cached is not MISSING:
+            self._frozen_hits.add()
+            if self._auditer.enabled(AuditEvent.HIT):
                 self._auditer.audit(AuditEvent.HIT, {"key": key, "value": cached})
-                self._hits += 1
         return cached
 
-    def setcache(self, args: tuple[int, ...], value: int) -> int:
-        self.cleancache()
+    def resize(self, maxsize: int) -> None:
+        """Change the maximum number of entries, evicting the entries above it."""
+        if maxsize < 0:
+            raise ValueError("maxsize cannot be negative")
+        removed: list[Hashable] = []
         with self._thread_lock:
-            key = self._keymaker.make_key(args)
-            self._auditer.audit(AuditEvent.MISS, {"key": key, "value": value})
+            previous, self._maxsize = self._maxsize, maxsize
+            # keep removal_limit the same share of maxsize
+            if previous and self._removal_limit is not None:
+                self._removal_limit = min(maxsize, max(1, self._removal_limit * maxsize // previous))
+            else:
+                self._removal_limit = maxsize // 3
+            while len(self._dcache) > maxsize:
+                self._remove_victim(removed)
+        self._audit_removed(removed)
+
+    def _retune(self) -> None:
+        tuner = cast(sizetuner, self._tuner)
+        previous, maxsize = self._maxsize, tuner.decide()
+        if maxsize != previous:
+            self.resize(maxsize)
+        if self._auditer.enabled(AuditEvent.TUNE):
+            rates = dict(zip(tuner.sizes, tuner.hitrates()))
+            self._auditer.audit(AuditEvent.TUNE, {"previous": previous, "maxsize": maxsize, "hit_rates": rates})
+
+    @property
+    def maxsize(self) -> Optional[int]:
+        return self._maxsize
+
+    def lookup(self, key: Hashable) -> Union[Hashable, MissingType]:
+        if self._trace is not None:
+            self._trace.record(key)
+        if self._tuner is not None and self._tuner.observe(key):
+            self._retune()
+        if self._frozen is not None:
+            cached = self._lookup_frozen(key)
+            if cached is not MISSING:
+                return cached
+        removed: list[Hashable] = []
+        if self._lockfree_hits is not None:
+            # the policy does not track hits, so a plain dict read is enough
+            cached = self._dcache.get(key, MISSING)
+            if cached is not MISSING:
+                self._lockfree_hits.add()
+        else:
+            with self._thread_lock:
+                cached = self._dcache.get(key, MISSING)
+                if cached is not MISSING and self._ttl is not None and self._expired(key, self._timer()):
+                    self._remove(key, removed)
+                    cached = MISSING
+                if cached is not MISSING:
+                    self._hits += 1
+                    self._policy.access(key)
+        if cached is not MISSING and self._auditer.enabled(AuditEvent.HIT):
+            self._auditer.audit(AuditEvent.HIT, {"key": key, "value": cached})
+        self._audit_removed(removed)
+        return cached
+
+    def hit_path(self) -> tuple[Callable[[Hashable, MissingType], Union[Hashable, MissingType]], Callable[[], None]]:
+        """Return the raw read of the cache and the hit counter, for callers that handle everything else of a hit."""
+        if self._lockfree_hits is None:
+            raise ValueError("hits of this cache need the lock")
+        return self._dcache.get, self._lockfree_hits.add
+
+    def claim_refresh(self, key: Hashable) -> bool:
+        """Tell if `key` is about to expire and nobody is refreshing it yet."""
+        if self._refresh_ahead is None:
+            return False
+        with self._thread_lock:
+            expiry = self._expires.get(key)
+            if expiry is None or key in self._refreshing or expiry - self._timer() > self._refresh_ahead:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def release_refresh(self, key: Hashable) -> None:
+        with self._thread_lock:
+            self._refreshing.discard(key)
+
+    def _store(self, key: Hashable, value: Hashable, removed: list[Hashable]) -> None:
+        # must be called with the lock held
+        size = 0
+        if self._sizer is not None:
+            size = self._sizer(value)
+            if self._max_bytes is not None and size > self._max_bytes:
+                return
+        present = key in self._dcache
+        if present:
+            self._bytes -= self._sizes.get(key, 0)
+        elif self._policy.admit(key, self._victim(size)):
+            removed.extend(self._evict(size))
+        else:
+            return
+        self._dcache[key] = value
+        self._policy.insert(key)
+        self._set_expiry(key)
+        if self._sizer is not None:
+            self._sizes[key] = size
+            self._bytes += size
+
+    def store(self, key: Hashable, value: Hashable) -> Hashable:
+        removed: list[Hashable] = []
+        with self._thread_lock:
+            self._sweep(removed)
             self._misses += 1
-            self._dcache[key] = value
+            self._store(key, value, removed)
+        if self._auditer.enabled(AuditEvent.MISS):
+            self._auditer.audit(AuditEvent.MISS, {"key": key, "value": value})
+        self._audit_removed(removed)
         return value
 
+    def _observemany(self, keys: Sequence[Hashable]) -> None:
+        if self._trace is not None:
+            for key in keys:
+                self._trace.record(key)
+        if self._tuner is not None:
+            for key in keys:
+                if self._tuner.observe(key):
+                    self._retune()
+
+    def lookupmany(self, keys: Sequence[Hashable]) -> list[Union[Hashable, MissingType]]:
+        if self._trace is not None or self._tuner is not None:
+            self._observemany(keys)
+        removed: list[Hashable] = []
+        with self._thread_lock:
+            dcache, policy = self._dcache, self._policy
+            self._sweep(removed)
+            results = [dcache.get(key, MISSING) for key in keys]
+            if self._frozen is not None:
+                frozen = self._frozen
+                results = [frozen.get(key) if cached is MISSING else cached for key, cached in zip(keys, results)]
+            hits = 0
+            for key, cached in zip(keys, results):
+                if cached is not MISSING:
+                    hits += 1
+                    policy.access(key)
+            self._hits += hits
+        if self._auditer.enabled(AuditEvent.HIT):
+            for key, cached in zip(keys, results):
+                if cached is not MISSING:
+                    self._auditer.audit(AuditEvent.HIT, {"key": key, "value": cached})
+        self._audit_removed(removed)
+        return results
+
+    def storemany(self, items: Sequence[tuple[Hashable, Hashable]]) -> None:
+        removed: list[Hashable] = []
+        with self._thread_lock:
+            self._sweep(removed)
+            self._misses += len(items)
+            for key, value in items:
+                self._store(key, value, removed)
+        if self._auditer.enabled(AuditEvent.MISS):
+            for key, value in items:
+                self._auditer.audit(AuditEvent.MISS, {"key": key, "value": value})
+        self._audit_removed(removed)
+
+    def load(self, items: Iterable[tuple[Hashable, Hashable]]) -> None:
+        """Store entries without counting them as misses or auditing them."""
+        removed: list[Hashable] = []
+        with self._thread_lock:
+            for key, value in items:
+                self._store(key, value, removed)
+        self._audit_removed(removed)
+
+    def items(self, frozen: bool = True) -> list[tuple[Hashable, Hashable]]:
+        with self._thread_lock:
+            now = self._timer() if self._ttl is not None else None
+            items = [item for item in self._dcache.items() if now is None or not self._expired(item[0], now)]
+        if frozen and self._frozen is not None:
+            items = self._frozen.items() + items
+        return items
+
+    @property
+    def frozen(self) -> Optional[frozentier]:
+        return self._frozen
+
+    def freeze(self, tier: Optional[frozentier]) -> None:
+        """Consult the read-only `tier` before the cache, `None` removes it."""
+        self._frozen = tier
+
+    def getcache(self, args: tuple[Hashable, ...]) -> Optional[Hashable]:
+        cached = self.lookup(self._keymaker.make_key(args))
+        return None if cached is MISSING else cached
+
+    def setcache(self, args: tuple[Hashable, ...], value: Hashable) -> Hashable:
+        return self.store(self._keymaker.make_key(args), value)
+
     def cacheinfo(self) -> CacheInfo:
-        return CacheInfo(len(self._dcache), self._hits, self._misses, self._cleanup_count)
+        hits = self._hits + self._frozen_hits.value()
+        if self._lockfree_hits is not None:
+            hits += self._lockfree_hits.value()
+        return CacheInfo(len(self._dcache), hits, self._misses, self._cleanup_count, 0, self._bytes)
 
     def clearcache(self) -> None:
         with self._thread_lock:
             self._dcache.clear()
+            self._policy.clear()
+            self._keymaker.clear()
+            self._sizes.clear()
+            self._bytes = 0
+            self._expires.clear()
+            self._expiry_heap.clear()
             self._hits = 0
+            if self._lockfree_hits is not None:
+                self._lockfree_hits.reset()
+            self._frozen = None
+            self._frozen_hits.reset()
+            if self._tuner is not None:
+                self._tuner.clear()
             self._misses = 0
             self._cleanup_count = 0
 
 
-class _cached_opfunc_wrapper:
+class _shardedcachemap:
     def __init__(
         self,
-        op: OperatorCallableType,
-        key: Optional[KeyCallableType],
+        keymaker: keymaker,
+        maxsize: Optional[int],
+        removal_limit: Optional[int],
+        auditer: Auditer,
+        policy: PolicyType = "random",
+        shards: int = 16,
+        max_bytes: Optional[int] = None,
+        adaptive: Optional[tuple[int, int]] = None,
+        **options: Any,
+    ) -> None:
+        if shards <= 0:
+            raise ValueError("shards cannot be zero or negative")
+        if isinstance(policy, EvictionPolicy):
+            raise ValueError("sharded caches need a policy name or factory, not a policy instance")
+        maxsize, removal_limit = _determine_maxsize_args(maxsize, removal_limit)
+        if maxsize is not None and removal_limit is not None:
+            maxsize = -(-maxsize // shards)
+            removal_limit = min(maxsize, -(-removal_limit // shards))
+        if max_bytes is not None:
+            max_bytes = -(-max_bytes // shards)
+        if adaptive is not None:
+            # every shard tunes its own share of the bounds
+            adaptive = (-(-adaptive[0] // shards), -(-adaptive[1] // shards))
+        self._keymaker = keymaker
+        self._shards = [
+            _cachemap(
+                keymaker,
+                maxsize,
+                removal_limit,
+                auditer,
+                policy,
+                lockfree_reads=True,
+                max_bytes=max_bytes,
+                adaptive=adaptive,
+                **options,
+            )
+            for _ in range(shards)
+        ]
+        self._frozen: Optional[frozentier] = None
+
+    def _shard(self, key: Hashable) -> _cachemap:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def cleancache(self) -> None:
+        for shard in self._shards:
+            shard.cleancache()
+
+    def expire(self) -> None:
+        for shard in self._shards:
+            shard.expire()
+
+    def resize(self, maxsize: int) -> None:
+        share = -(-maxsize // len(self._shards))
+        for shard in self._shards:
+            shard.resize(share)
+
+    @property
+    def maxsize(self) -> Optional[int]:
+        sizes = [shard.maxsize for shard in self._shards]
+        return None if None in sizes else sum(cast("list[int]", sizes))
+
+    def lookup(self, key: Hashable) -> Union[Hashable, MissingType]:
+        return self._shard(key).lookup(key)
+
+    def claim_refresh(self, key: Hashable) -> bool:
+        return self._shard(key).claim_refresh(key)
+
+    def release_refresh(self, key: Hashable) -> None:
+        self._shard(key).release_refresh(key)
+
+    def store(self, key: Hashable, value: Hashable) -> Hashable:
+        return self._shard(key).store(key, value)
+
+    def _group(self, keys: Iterable[Hashable]) -> dict[int, list[int]]:
+        # shard index -> positions of its keys
+        groups: dict[int, list[int]] = {}
+        nshards = len(self._shards)
+        for position, key in enumerate(keys):
+            groups.setdefault(hash(key) % nshards, []).append(position)
+        return groups
+
+    def lookupmany(self, keys: Sequence[Hashable]) -> list[Union[Hashable, MissingType]]:
+        results: list[Union[Hashable, MissingType]] = [MISSING] * len(keys)
+        for index, positions in self._group(keys).items():
+            found = self._shards[index].lookupmany([keys[position] for position in positions])
+            for position, cached in zip(positions, found):
+                results[position] = cached
+        return results
+
+    def storemany(self, items: Sequence[tuple[Hashable, Hashable]]) -> None:
+        for index, positions in self._group(key for key, _ in items).items():
+            self._shards[index].storemany([items[position] for position in positions])
+
+    def load(self, items: Iterable[tuple[Hashable, Hashable]]) -> None:
+        items = list(items)
+        for index, positions in self._group(key for key, _ in items).items():
+            self._shards[index].load([items[position] for position in positions])
+
+    def items(self) -> list[tuple[Hashable, Hashable]]:
+        # every shard shares the frozen tier, only report it once
+        items = [item for shard in self._shards for item in shard.items(frozen=False)]
+        return items if self._frozen is None else self._frozen.items() + items
+
+    @property
+    def frozen(self) -> Optional[frozentier]:
+        return self._frozen
+
+    def freeze(self, tier: Optional[frozentier]) -> None:
+        self._frozen = tier
+        for shard in self._shards:
+            shard.freeze(tier)
+
+    def getcache(self, args: tuple[Hashable, ...]) -> Optional[Hashable]:
+        cached = self.lookup(self._keymaker.make_key(args))
+        return None if cached is MISSING else cached
+
+    def setcache(self, args: tuple[Hashable, ...], value: Hashable) -> Hashable:
+        return self.store(self._keymaker.make_key(args), value)
+
+    def cacheinfo(self) -> CacheInfo:
+        infos = [shard.cacheinfo() for shard in self._shards]
+        return CacheInfo(*(sum(field) for field in zip(*infos)))
+
+    def clearcache(self) -> None:
+        self._frozen = None
+        for shard in self._shards:
+            shard.clearcache()
+
+
+def _makecache(
+    keys: keymaker,
+    maxsize: Optional[int],
+    removal_limit: Optional[int],
+    auditer: Auditer,
+    policy: PolicyType,
+    *,
+    concurrency: Literal["locked", "sharded"],
+    shards: int,
+    backend: Optional[BackendType],
+    lockfree_reads: bool,
+    options: dict[str, Any],
+) -> Union[_cachemap, _shardedcachemap]:
+    if concurrency == "sharded":
+        if backend is not None:
+            raise ValueError("sharded caches only support the default in-memory backend")
+        return _shardedcachemap(keys, maxsize, removal_limit, auditer, policy, shards, **options)
+    if concurrency == "locked":
+        return _cachemap(
+            keys,
+            maxsize,
+            removal_limit,
+            auditer,
+            policy,
+            lockfree_reads=lockfree_reads,
+            backend=backend,
+            **options,
+        )
+    raise ValueError(f"unknown concurrency mode: {concurrency!r}")
+
+
+def _makeerrors(
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]],
+    maxsize: Optional[int],
+    ttl: Optional[float],
+    timer: Callable[[], float],
+) -> Optional[errorcache]:
+    if cache_exceptions is True:
+        cache_exceptions = (Exception,)
+    if not cache_exceptions:
+        return None
+    types = cache_exceptions if isinstance(cache_exceptions, tuple) else (cache_exceptions,)
+    return errorcache(types, maxsize, ttl, timer)
+
+
+def _makelocal(thread_cache: Optional[int], ttl: Optional[float]) -> Optional[threadcache]:
+    if thread_cache is None:
+        return None
+    if ttl is not None:
+        raise ValueError("thread_cache cannot be combined with ttl")
+    return threadcache(thread_cache)
+
+
+def _reduce_halves(op: OperatorCallableType[Hashable], args: tuple[Hashable, ...]) -> Hashable:
+    # the same split as recursive calls of the wrapper, run by process workers which have no cache
+    if len(args) == 1:
+        return args[0]
+    mid = len(args) // 2
+    return op(_reduce_halves(op, args[:mid]), _reduce_halves(op, args[mid:]))
+
+
+class _cached_opfunc_base(Generic[_F]):
+    def __init__(
+        self,
+        op: _F,
+        key: Optional[KeyCallableType[Hashable]],
         maxsize: Optional[int],
         removal_limit: Optional[int],
         order_matters: bool,
         recursive: bool,
         auditer: Optional[Auditer],
+        policy: PolicyType,
+        concurrency: Literal["locked", "sharded"],
+        shards: int,
+        single_flight: bool,
+        backend: Optional[BackendType],
+        executor: Optional[Executor],
+        parallel_threshold: int,
+        max_bytes: Optional[int],
+        sizer: Optional[SizerCallableType[Hashable]],
+        ttl: Optional[float],
+        refresh_ahead: Optional[float],
+        timer: Callable[[], float],
+        algebra: Optional[Algebra],
+        domain: Optional[tuple[int, int]],
+        precompute: bool,
+        cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]],
+        trace: Optional[TraceRecorder],
+        metrics: bool,
+        adaptive: Optional[tuple[int, int]],
+        thread_cache: Optional[int],
+        nary: Union[bool, NaryCallableType],
+        nary_threshold: int,
+        lockfree_reads: bool = False,
     ) -> None:
         if auditer is None:
             auditer = global_audit
         self.__wrapped__ = op
-        self.__cache__ = _cachemap(keymaker(key, order_matters), maxsize, removal_limit, auditer)
+        # declared algebraic properties replace order_matters, the operands are already canonical
+        self._canonicalize = algebra.canonicalize if algebra is not None else None
+        self._keymaker = keymaker(key, order_matters if algebra is None else True, maxsize)
+        options: dict[str, Any] = {
+            "max_bytes": max_bytes,
+            "sizer": sizer,
+            "ttl": ttl,
+            "refresh_ahead": refresh_ahead,
+            "timer": timer,
+            "trace": trace,
+            "adaptive": adaptive,
+        }
+        self.__cache__ = _makecache(
+            self._keymaker,
+            maxsize,
+            removal_limit,
+            auditer,
+            policy,
+            concurrency=concurrency,
+            shards=shards,
+            backend=backend,
+            lockfree_reads=lockfree_reads,
+            options=options,
+        )
         self._recursive = recursive
         self._auditer = auditer
+        self._flights = singleflight() if single_flight else None
+        if parallel_threshold < 2:
+            raise ValueError("parallel_threshold must be at least 2")
+        self._executor = executor
+        self._parallel_threshold = parallel_threshold
+        self._refresh_ahead = refresh_ahead
+        self._dense: Optional[densetable] = None
+        if domain is not None:
+            if ttl is not None:
+                raise ValueError("domain cannot be combined with ttl")
+            symmetric = not order_matters if algebra is None else algebra.commutative
+            self._dense = densetable(*domain, symmetric=symmetric)
+        elif precompute:
+            raise ValueError("precompute needs a domain")
+        self._l1 = _makelocal(thread_cache, ttl)
+        self._errors = _makeerrors(cache_exceptions, maxsize, ttl, timer)
+        # calls of the operation and cache lookups go through these, timed if metrics are enabled
+        self._op: _F = op
+        self._lookup = self.__cache__.lookup
+        if nary_threshold < 3:
+            raise ValueError("nary_threshold must be at least 3")
+        self._nary_threshold = nary_threshold
+        self._nary = nary_equivalent(op) if nary is True else (nary or None)
+        self.metrics = WrapperMetrics() if metrics else None
+        if self.metrics is not None:
+            self._instrument(self.metrics)
+        # after the metrics, so only lookups of the shared cache are timed
+        self._shared_lookup = self._lookup
+        if self._l1 is not None:
+            self._lookup = self._local_lookup
+        register_wrapper(self)
+
+    def _local_lookup(self, key: Hashable) -> Union[Hashable, MissingType]:
+        # the per-thread cache first, hits of the shared cache are copied into it
+        l1 = cast(threadcache, self._l1)
+        cached = l1.get(key)
+        if cached is not MISSING:
+            if self._auditer.enabled(_HIT):
+                self._auditer.audit(_HIT, {"key": key, "value": cached})
+            return cached
+        cached = self._shared_lookup(key)
+        if cached is not MISSING:
+            l1.put(key, cached)
+        return cached
+
+    def _instrument(self, metrics: WrapperMetrics) -> None:
+        self._op = WrapperMetrics.timed(self._op, metrics.compute)
+        self._lookup = WrapperMetrics.timed(self._lookup, metrics.lookup)
+        if self._nary is not None:
+            self._nary = WrapperMetrics.timed(self._nary, metrics.compute)
+
+    def _coalesced(self) -> int:
+        return 0 if self._flights is None else self._flights.coalesced
 
     def cache_info(self) -> CacheInfo:
-        return self.__cache__.cacheinfo()
+        info = self.__cache__.cacheinfo()._replace(coalesced=self._coalesced())
+        frozen = self.__cache__.frozen
+        if frozen is not None:
+            info = info._replace(size=info.size + len(frozen))
+        if self._l1 is not None:
+            info = info._replace(hits=info.hits + self._l1.hits())
+        dense = self._dense
+        if dense is None:
+            return info
+        return info._replace(
+            size=info.size + dense.size(),
+            hits=info.hits + dense.hits.value(),
+            misses=info.misses + dense.misses.value(),
+        )
 
-    def __call__(self, *args: int) -> int:
+    def cache_clear(self):
+        self.__cache__.clearcache()
+        if self._dense is not None:
+            self._dense.clear()
+        if self._l1 is not None:
+            self._l1.invalidate()
+        if self._errors is not None:
+            self._errors.clear()
+        if self.metrics is not None:
+            self.metrics.clear()
+        if self._flights is not None:
+            self._flights.reset()
+
+    def cache_expire(self) -> None:
+        self.__cache__.expire()
+
+    def export_snapshot(self) -> bytes:
+        return dumps(self.__cache__.items())
+
+    def load_snapshot(self, data: bytes, frozen: bool = False) -> None:
+        tier = frozentier(data)
+        if frozen:
+            self.__cache__.freeze(tier)
+        else:
+            self.__cache__.load(tier.items())
+
+    def __repr__(self) -> str:
+        memid = f"0x{hex(id(self)).upper()[2:]}"
+        return f"<cachedop_callable of {self.__wrapped__!r} at {memid}>"
+
+
+class _cached_opfunc_wrapper(_cached_opfunc_base[OperatorCallableType[Hashable]]):
+    def __init__(self, op: OperatorCallableType[Hashable], **params: Any) -> None:
+        super().__init__(op, **params)
+        if self._dense is not None and params["precompute"]:
+            self._dense.fill(op)
+
+    def _dense_call(self, dense: densetable, args: tuple[Hashable, ...], index: int) -> Hashable:
+        value = dense.get(index)
+        if value is not MISSING:
+            dense.hits.add()
+            return value
+        dense.misses.add()
+        errors = self._errors
+        if errors is None:
+            return self._dense_compute(dense, args, index)
+        key = self._keymaker.make_key(args)
+        errors.check(key)
+        try:
+            return self._dense_compute(dense, args, index)
+        except BaseException as exc:
+            errors.add(key, exc)
+            raise
+
+    def _dense_compute(self, dense: densetable, args: tuple[Hashable, ...], index: int) -> Hashable:
+        if self._auditer.enabled(AuditEvent.CALL):
+            self._auditer.audit(AuditEvent.CALL, {"args": args})
+        value = self._op(*args)
+        dense.store(index, value)
+        return value
+
+    def _compute(self, args: tuple[Hashable, ...], key: Hashable) -> Hashable:
+        if len(args) == 2:
+            if self._auditer.enabled(AuditEvent.CALL):
+                self._auditer.audit(AuditEvent.CALL, {"args": args})
+            return self.__cache__.store(key, self._op(*args))
+        return self.__cache__.store(key, self._reduce(args))
+
+    def _reduce(self, args: tuple[Hashable, ...]) -> Hashable:
+        cachedop = self.__call__
+        if self._recursive is True and self._executor is not None and len(args) >= self._parallel_threshold:
+            return self._reduce_parallel(args, self._executor)
+        if self._nary is not None and len(args) >= self._nary_threshold:
+            # one call to the n-ary equivalent, only the whole result is cached
+            if self._auditer.enabled(AuditEvent.CALL):
+                self._auditer.audit(AuditEvent.CALL, {"args": args})
+            return self._nary(args)
+        if self._recursive is True:
+            mid = len(args) // 2
+            start, end = args[:mid], args[mid:]
+            return cachedop(cachedop(*start), cachedop(*end))
+        return reduce(cachedop, args)
+
+    def _dispatch_part(
+        self,
+        part: tuple[Hashable, ...],
+        executor: Executor,
+        parts: dict[tuple[Hashable, ...], Union[Hashable, Future[Hashable]]],
+    ) -> None:
+        if len(part) >= self._parallel_threshold:
+            mid = len(part) // 2
+            self._dispatch_part(part[:mid], executor, parts)
+            self._dispatch_part(part[mid:], executor, parts)
+        elif part not in parts:
+            cached = part[0] if len(part) == 1 else self.__cache__.lookup(self._keymaker.make_key(part))
+            if cached is not MISSING:
+                parts[part] = cached
+            elif isinstance(executor, ProcessPoolExecutor):
+                # the cache lives in this process, workers only reduce their part
+                parts[part] = executor.submit(_reduce_halves, self.__wrapped__, part)
+            else:
+                parts[part] = executor.submit(self, *part)
+
+    def _merge_part(
+        self,
+        part: tuple[Hashable, ...],
+        parts: dict[tuple[Hashable, ...], Union[Hashable, Future[Hashable]]],
+        inprocess: bool,
+    ) -> Hashable:
+        if len(part) < self._parallel_threshold:
+            result = parts[part]
+            if not isinstance(result, Future):
+                return result
+            value = cast("Future[Hashable]", result).result()
+            # thread workers already cached their part through the wrapper
+            return self.__cache__.store(self._keymaker.make_key(part), value) if inprocess else value
+        mid = len(part) // 2
+        value = self(self._merge_part(part[:mid], parts, inprocess), self._merge_part(part[mid:], parts, inprocess))
+        return self.__cache__.store(self._keymaker.make_key(part), value)
+
+    def _reduce_parallel(self, args: tuple[Hashable, ...], executor: Executor) -> Hashable:
+        # split the operands the same way as recursive calls do, until the parts are below the threshold,
+        # dispatch those parts to the executor and merge the results back in this thread
+        parts: dict[tuple[Hashable, ...], Union[Hashable, Future[Hashable]]] = {}
+        self._dispatch_part(args, executor, parts)
+        inprocess = isinstance(executor, ProcessPoolExecutor)
+        mid = len(args) // 2
+        return self(self._merge_part(args[:mid], parts, inprocess), self._merge_part(args[mid:], parts, inprocess))
+
+    def _compute_once(self, args: tuple[Hashable, ...], key: Hashable) -> Hashable:
+        # another leader may have filled the cache right before this one took over
+        cached = self.__cache__.lookup(key)
+        if cached is not MISSING:
+            return cached
+        return self._miss(args, key)
+
+    def _miss(self, args: tuple[Hashable, ...], key: Hashable) -> Hashable:
+        errors = self._errors
+        if errors is None:
+            return self._compute(args, key)
+        errors.check(key)
+        try:
+            return self._compute(args, key)
+        except BaseException as exc:
+            errors.add(key, exc)
+            raise
+
+    def __call__(self, *args: Hashable) -> Hashable:
         if not args:
             raise ValueError("no values were given")
-        elif len(args) == 1:
+        if self._canonicalize is not None:
+            args = self._canonicalize(args)
+        if len(args) == 1:
             return args[0]
-        cachedop = self.__call__
-        cached = self.__cache__.getcache(args)
-        if cached is not None:
+        dense = self._dense
+        if dense is not None and len(args) == 2:
+            index = dense.index(*args)
+            if index >= 0:
+                return self._dense_call(dense, args, index)
+        key = self._keymaker.make_key(args)
+        cached = self._lookup(key)
+        if cached is not MISSING:
+            if self._refresh_ahead is not None and self.__cache__.claim_refresh(key):
+                self._refresh(args, key)
             return cached
+        if self._flights is None:
+            return self._miss(args, key)
+        return self._flights.do(key, partial(self._compute_once, args, key))
+
+    def _refresh_now(self, args: tuple[Hashable, ...], key: Hashable) -> None:
+        try:
+            self._compute(args, key)
+        finally:
+            self.__cache__.release_refresh(key)
+
+    def _refresh(self, args: tuple[Hashable, ...], key: Hashable) -> None:
+        # recompute in the background, callers keep getting the current value meanwhile
+        if self._executor is not None:
+            self._executor.submit(self._refresh_now, args, key)
         else:
-            if len(args) == 2:
+            Thread(target=self._refresh_now, args=(args, key), daemon=True).start()
+
+    def batch(
+        self,
+        pairs: Iterable[Sequence[Hashable]],
+        vectorized: Optional[Callable[[list[Hashable], list[Hashable]], Any]] = None,
+    ) -> list[Hashable]:
+        if hasattr(pairs, "tolist"):
+            # NumPy arrays of shape (n, 2)
+            pairs = cast(Any, pairs).tolist()
+        argslist: list[tuple[Hashable, ...]] = [tuple(pair) for pair in pairs]
+        if any(len(args) != 2 for args in argslist):
+            raise ValueError("batch() only accepts pairs of operands")
+        if self._canonicalize is not None:
+            argslist = [self._canonicalize(args) for args in argslist]
+        make_key = self._keymaker.make_key
+        keys = [make_key(args) for args in argslist]
+        values = {} if self._dense is None else self._batch_dense(self._dense, keys, argslist)
+        # the operands of every distinct key, pairs reduced to a single operand need no call
+        unique = {key: args for key, args in zip(keys, argslist) if len(args) == 2 and key not in values}
+        ukeys = list(unique)
+        values.update(zip(ukeys, self.__cache__.lookupmany(ukeys)))
+        values.update((key, args[0]) for key, args in zip(keys, argslist) if len(args) == 1)
+        misses = [key for key in ukeys if values[key] is MISSING]
+        if misses:
+            items = list(zip(misses, self._batch_compute(misses, [unique[key] for key in misses], vectorized)))
+            self.__cache__.storemany(items)
+            values.update(items)
+        return [cast(Hashable, values[key]) for key in keys]
+
+    def _batch_dense(
+        self, dense: densetable, keys: list[Hashable], argslist: list[tuple[Hashable, ...]]
+    ) -> dict[Hashable, Union[Hashable, MissingType]]:
+        # pairs inside the domain take the same path as calls
+        values: dict[Hashable, Union[Hashable, MissingType]] = {}
+        for key, args in zip(keys, argslist):
+            if len(args) == 2 and key not in values:
+                index = dense.index(*args)
+                if index >= 0:
+                    values[key] = self._dense_call(dense, args, index)
+        return values
+
+    def _batch_compute(
+        self,
+        misses: list[Hashable],
+        margs: list[tuple[Hashable, ...]],
+        vectorized: Optional[Callable[[list[Hashable], list[Hashable]], Any]],
+    ) -> list[Hashable]:
+        errors = self._errors
+        if vectorized is not None:
+            if errors is not None:
+                for key in misses:
+                    errors.check(key)
+            return self._batch_vectorized(margs, vectorized)
+        op = self._op
+        results: list[Hashable] = []
+        for key, args in zip(misses, margs):
+            if errors is not None:
+                errors.check(key)
+            if self._auditer.enabled(AuditEvent.CALL):
                 self._auditer.audit(AuditEvent.CALL, {"args": args})
-                value = self.__cache__.setcache(args, self.__wrapped__(*args))
+            try:
+                results.append(op(*args))
+            except BaseException as exc:
+                if errors is not None:
+                    errors.add(key, exc)
+                raise
+        return results
+
+    @staticmethod
+    def _batch_vectorized(
+        margs: list[tuple[Hashable, ...]], vectorized: Callable[[list[Hashable], list[Hashable]], Any]
+    ) -> list[Hashable]:
+        computed = vectorized([args[0] for args in margs], [args[1] for args in margs])
+        if hasattr(computed, "tolist"):
+            computed = computed.tolist()
+        results: list[Hashable] = list(computed)
+        if len(results) != len(margs):
+            raise ValueError(f"vectorized returned {len(results)} results for {len(margs)} pairs")
+        return results
+
+    def map(
+        self,
+        xs: Iterable[Hashable],
+        ys: Iterable[Hashable],
+        vectorized: Optional[Callable[[list[Hashable], list[Hashable]], Any]] = None,
+    ) -> list[Hashable]:
+        if hasattr(xs, "tolist"):
+            xs = cast(Any, xs).tolist()
+        if hasattr(ys, "tolist"):
+            ys = cast(Any, ys).tolist()
+        xs, ys = list(xs), list(ys)
+        if len(xs) != len(ys):
+            raise ValueError("xs and ys must have the same length")
+        return self.batch(zip(xs, ys), vectorized)
+
+    def reducer(self, values: Iterable[Hashable]) -> SegmentTreeReducer[Hashable]:
+        return SegmentTreeReducer(self, values)
+
+
+class _fast_cached_opfunc_wrapper(_cached_opfunc_wrapper):
+    """
+    The wrapper of configurations where a hit only has to be counted:
+    an in-memory dict, a policy that ignores hits, no expiry, no coalescing and no operand rewriting.
+    Hits of two operands skip the generic checks and the cache lock, other calls take the generic path.
+    """
+
+    def __init__(self, op: OperatorCallableType[Hashable], **params: Any) -> None:
+        super().__init__(op, lockfree_reads=True, **params)
+        self._get, self._count_hit = cast(_cachemap, self.__cache__).hit_path()
+        self._make_key = self._keymaker.make_key
+        # the default key of unordered operands is inlined below
+        self._hash_sorted = params["key"] is None and not params["order_matters"]
+        self._audited = self._auditer.active
+
+    def __call__(self, *args: Any) -> Hashable:
+        if len(args) == 2 and _HIT not in self._audited:
+            if self._hash_sorted:
+                x, y = args
+                try:
+                    key = hash(args) if x <= y else hash((y, x))
+                except TypeError:
+                    # operands that cannot be compared are ordered by the generic path
+                    return super().__call__(*args)
+                cached = self._get(key, MISSING)
             else:
-                if self._recursive is True:
-                    mid = len(args) // 2
-                    start, end = args[:mid], args[mid:]
-                    value = cachedop(cachedop(*start), cachedop(*end))
-                else:
-                    value = reduce(cachedop, args)
-                value = self.__cache__.setcache(args, value)
+                cached = self._get(self._make_key(args), MISSING)
+            if cached is not MISSING:
+                self._count_hit()
+                return cached
+        return super().__call__(*args)
+
+
+def _plain_hits(params: dict[str, Any]) -> bool:
+    # tell if the options of cached_opfunc leave nothing to do on hits but counting them
+    policy = params["policy"]
+    return (
+        params["concurrency"] == "locked"
+        and params["backend"] is None
+        and params["ttl"] is None
+        and not params["single_flight"]
+        and params["algebra"] is None
+        and params["domain"] is None
+        and params["trace"] is None
+        and not params["metrics"]
+        and params["adaptive"] is None
+        and params["thread_cache"] is None
+        and (policy is RandomPolicy or isinstance(policy, RandomPolicy) or str(policy).lower() == "random")
+    )
+
+
+def _cancelling() -> bool:
+    # whether the current task itself is being cancelled, only known since Python 3.11
+    task = asyncio.current_task()
+    return task is not None and bool(getattr(task, "cancelling", lambda: 0)())
+
+
+class _async_cached_opfunc_wrapper(_cached_opfunc_base[AsyncOperatorCallableType[Hashable]]):
+    def __init__(self, op: AsyncOperatorCallableType[Hashable], **params: Any) -> None:
+        # pending results are always shared between awaiters, no need for thread coalescing
+        params["single_flight"] = False
+        if params["precompute"]:
+            raise ValueError("precompute is not supported by coroutine functions")
+        if params["thread_cache"] is not None:
+            raise ValueError("thread_cache is not supported by coroutine functions")
+        super().__init__(op, **params)
+        self._pending: dict[Hashable, asyncio.Future[Hashable]] = {}
+        # keys being computed by the current task and its parents,
+        # awaiting one of those again would wait forever
+        self._computing: ContextVar[frozenset[Hashable]] = ContextVar(
+            f"cachedop_computing_{id(self)}", default=frozenset()
+        )
+        self._shared = 0
+        # running refresh-ahead tasks, the event loop only keeps weak references to them
+        self._refreshes: set[asyncio.Task[None]] = set()
+
+    def _coalesced(self) -> int:
+        return self._shared
+
+    async def _refresh_now(self, args: tuple[Hashable, ...], key: Hashable) -> None:
+        try:
+            await self._compute(args, key)
+        finally:
+            self.__cache__.release_refresh(key)
+
+    def _refresh(self, args: tuple[Hashable, ...], key: Hashable) -> None:
+        task = asyncio.get_running_loop().create_task(self._refresh_now(args, key))
+        self._refreshes.add(task)
+        task.add_done_callback(self._refreshes.discard)
+
+    async def _dense_call(self, dense: densetable, args: tuple[Hashable, ...], index: int) -> Hashable:
+        value = dense.get(index)
+        if value is not MISSING:
+            dense.hits.add()
             return value
+        dense.misses.add()
+        errors = self._errors
+        if errors is None:
+            return await self._dense_compute(dense, args, index)
+        key = self._keymaker.make_key(args)
+        errors.check(key)
+        try:
+            return await self._dense_compute(dense, args, index)
+        except BaseException as exc:
+            errors.add(key, exc)
+            raise
+
+    async def _dense_compute(self, dense: densetable, args: tuple[Hashable, ...], index: int) -> Hashable:
+        if self._auditer.enabled(AuditEvent.CALL):
+            self._auditer.audit(AuditEvent.CALL, {"args": args})
+        value = await self._op(*args)
+        dense.store(index, value)
+        return value
+
+    async def _miss(self, args: tuple[Hashable, ...], key: Hashable) -> Hashable:
+        errors = self._errors
+        if errors is None:
+            return await self._compute(args, key)
+        errors.check(key)
+        try:
+            return await self._compute(args, key)
+        except BaseException as exc:
+            errors.add(key, exc)
+            raise
+
+    async def _compute(self, args: tuple[Hashable, ...], key: Hashable) -> Hashable:
+        cachedop = self.__call__
+        if len(args) == 2:
+            if self._auditer.enabled(AuditEvent.CALL):
+                self._auditer.audit(AuditEvent.CALL, {"args": args})
+            value = await self._op(*args)
+        elif self._nary is not None and len(args) >= self._nary_threshold:
+            if self._auditer.enabled(AuditEvent.CALL):
+                self._auditer.audit(AuditEvent.CALL, {"args": args})
+            value = self._nary(args)
+        elif self._recursive is True:
+            mid = len(args) // 2
+            start, end = args[:mid], args[mid:]
+            value = await cachedop(*await asyncio.gather(cachedop(*start), cachedop(*end)))
+        else:
+            value = args[0]
+            for arg in args[1:]:
+                value = await cachedop(value, arg)
+        return self.__cache__.store(key, value)
+
+    async def __call__(self, *args: Hashable) -> Hashable:
+        if not args:
+            raise ValueError("no values were given")
+        if self._canonicalize is not None:
+            args = self._canonicalize(args)
+        if len(args) == 1:
+            return args[0]
+        dense = self._dense
+        if dense is not None and len(args) == 2:
+            index = dense.index(*args)
+            if index >= 0:
+                return await self._dense_call(dense, args, index)
+        key = self._keymaker.make_key(args)
+        cached = self._lookup(key)
+        if cached is not MISSING:
+            if self._refresh_ahead is not None and self.__cache__.claim_refresh(key):
+                self._refresh(args, key)
+            return cached
+        computing = self._computing.get()
+        if key in computing:
+            return await self._miss(args, key)
+        return await self._join(args, key, computing)
+
+    async def _join(self, args: tuple[Hashable, ...], key: Hashable, computing: frozenset[Hashable]) -> Hashable:
+        # await the computation of the key in progress, or lead it if there is none
+        loop = asyncio.get_running_loop()
+        shared = False
+        while True:
+            pending = self._pending.get(key)
+            if pending is None or pending.get_loop() is not loop:
+                return await self._lead(args, key, loop.create_future(), computing)
+            if not shared:
+                shared = True
+                self._shared += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # only the leader was cancelled, not this awaiter: take over the computation
+                if not pending.cancelled() or _cancelling():
+                    raise
+
+    async def _lead(
+        self,
+        args: tuple[Hashable, ...],
+        key: Hashable,
+        future: asyncio.Future[Hashable],
+        computing: frozenset[Hashable],
+    ) -> Hashable:
+        # compute the result, sharing it with every awaiter of the same key
+        self._pending[key] = future
+        token = self._computing.set(computing | {key})
+        try:
+            value = await self._miss(args, key)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # the exception is raised here, do not let asyncio complain about it
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            self._computing.reset(token)
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        return value
 
     def cache_clear(self):
-        self.__cache__.clearcache()
+        super().cache_clear()
+        self._shared = 0
 
-    def __repr__(self) -> str:
-        memid = f"0x{hex(id(self)).upper()[2:]}"
-        return f"<cachedop_callable of {self.__wrapped__!r} at {memid}>"
+
+def _make_wrapper(
+    op: Union[OperatorCallableType[Hashable], AsyncOperatorCallableType[Hashable]], **params: Any
+) -> Union[_cached_opfunc_wrapper, _async_cached_opfunc_wrapper]:
+    if iscoroutinefunction(op):
+        return _async_cached_opfunc_wrapper(op, **params)
+    # pick the call path at decoration time, so the common configurations do not pay for the others
+    if _plain_hits(params):
+        return _fast_cached_opfunc_wrapper(cast(OperatorCallableType[Hashable], op), **params)
+    return _cached_opfunc_wrapper(cast(OperatorCallableType[Hashable], op), **params)
 
 
 def cached_opfunc(
-    op: Optional[OperatorCallableType] = None,
+    op: Optional[OperatorCallableType[Hashable]] = None,
     /,
     *,
-    key: Optional[KeyCallableType] = None,
+    key: Optional[KeyCallableType[Hashable]] = None,
     maxsize: Optional[int] = None,
     removal_limit: Optional[int] = None,
     order_matters: bool = False,
     recursive: bool = True,
     auditer: Optional[Auditer] = None,
+    policy: PolicyType = "random",
+    concurrency: Literal["locked", "sharded"] = "locked",
+    shards: int = 16,
+    single_flight: bool = False,
+    backend: Optional[BackendType] = None,
+    executor: Optional[Executor] = None,
+    parallel_threshold: int = 4096,
+    max_bytes: Optional[int] = None,
+    sizer: Optional[SizerCallableType[Hashable]] = None,
+    ttl: Optional[float] = None,
+    refresh_ahead: Optional[float] = None,
+    timer: Callable[[], float] = monotonic,
+    algebra: Optional[Algebra] = None,
+    domain: Optional[tuple[int, int]] = None,
+    precompute: bool = False,
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]] = False,
+    trace: Optional[TraceRecorder] = None,
+    metrics: bool = False,
+    adaptive: Optional[tuple[int, int]] = None,
+    thread_cache: Optional[int] = None,
+    nary: Union[bool, NaryCallableType] = True,
+    nary_threshold: int = 64,
 ):
     """
     Decorator to cache the results of binary operations.
@@ -150,11 +1308,18 @@ def cached_opfunc(
     ----------
     op : OperatorCallableType, optional
         The callable to be cached.
-        The callable must accept 2 positional arguments of `int` and return an `int`.
+        The callable must accept 2 positional operands and return a result of the same type,
+        e.g. `int`, `Fraction`, `Decimal` or tuples (such as small frozen matrices).
+        Operands must be hashable, and so must results since they become the operands of n-ary calls.
+        Operands comparing equal share cache entries, like `functools.lru_cache`.
+        With `order_matters=False`, operands that cannot be compared to each other are ordered by hash.
+        If it is a coroutine function, the returned wrapper is a coroutine function as well:
+        concurrent awaiters of the same key share one pending result and
+        both halves of recursive n-ary calls are awaited concurrently with `asyncio.gather`.
     key : KeyCallableType, optional
         A custom callable to generate cache keys.
         If not provided, a default key generation callable is used.
-        The callable must accept 2 positional arguments of `int` and return any object that is hashable (e.g. usable as dictionary keys).
+        The callable must accept a tuple of operands and return any object that is hashable (e.g. usable as dictionary keys).
     maxsize : int, optional
         The maximum number of entries allowed in the cache.
         If not specified, the cache size is unlimited.
@@ -173,6 +1338,117 @@ def cached_opfunc(
     auditer : Auditer, optional
         If passed, log the opreation to the auditer for debugging purposes.
         Otherwise, the global auditer will used.
+    policy : str, EvictionPolicy or callable, default="random"
+        The eviction policy used when the cache reaches `maxsize`.
+        Can be one of "random", "lru", "lfu" and "tinylfu", an `EvictionPolicy` instance
+        or a callable that returns one.
+        The "random" policy removes `removal_limit` random entries at once,
+        the other policies evict entries one by one in O(1) as new entries are stored.
+        "tinylfu" also refuses to store new entries that are seen less often than the entry they would evict.
+    concurrency : {"locked", "sharded"}, default="locked"
+        If "locked", the whole cache is guarded by a single lock.
+        If "sharded", the cache is split into `shards` segments by key hash, each with its own lock,
+        statistics and share of `maxsize`, so threads working on different keys do not wait on each other.
+        Cache hits of the "random" policy are served without taking any lock.
+    shards : int, default=16
+        The number of segments used by the "sharded" concurrency mode.
+    single_flight : bool, default=False
+        If `True`, concurrent calls that miss on the same key are coalesced:
+        the first caller computes the result while the others wait for it,
+        and an exception raised by the computation is raised in every waiting caller.
+        The number of avoided computations is reported as `coalesced` by `cache_info()`.
+    backend : MutableMapping or callable, optional
+        The mapping that stores cache entries, or a callable that returns one.
+        Defaults to a plain in-memory `dict`.
+        Use `SQLiteBackend` to keep cached results on disk across process restarts,
+        or `SharedMemoryBackend` to share int results between worker processes.
+        Only the "locked" concurrency mode supports custom backends.
+        `maxsize` and `max_bytes` cannot be used with backends shared between processes.
+    executor : Executor, optional
+        A `ThreadPoolExecutor` or `ProcessPoolExecutor` used by recursive calls with at least
+        `parallel_threshold` operands. The operands are split in halves until the parts are
+        below the threshold, the parts are reduced in parallel and their results are merged
+        and cached in the calling thread. With a `ProcessPoolExecutor`, the operation must be
+        picklable and workers reduce their part without caching it,
+        splitting it in halves the same way.
+        Ignored by coroutine functions.
+    parallel_threshold : int, default=4096
+        The minimum number of operands dispatched to `executor`.
+    max_bytes : int, optional
+        The maximum total size in bytes of the cached results, estimated by `sizer`.
+        Entries are evicted by the eviction policy until a new result fits,
+        results larger than `max_bytes` are never cached.
+        Can be combined with `maxsize`.
+    sizer : callable, optional
+        A callable that estimates the size in bytes of a cached result.
+        Defaults to `sys.getsizeof` when `max_bytes` is given.
+        The total is reported as `bytes` by `cache_info()`.
+    ttl : float, optional
+        The number of seconds a cached result stays valid.
+        Expired entries are dropped when they are accessed, and the entries that expired
+        in the meantime are swept from a heap of expiry times whenever a new result is stored.
+        If not specified, entries never expire.
+    refresh_ahead : float, optional
+        If a hit happens less than `refresh_ahead` seconds before the entry expires,
+        the result is recomputed in the background (in `executor` if given, otherwise in a daemon thread,
+        or in a task for coroutine functions) while callers keep getting the current one.
+        Must be lower than `ttl`.
+    timer : callable, default=time.monotonic
+        The clock used for `ttl`, in seconds.
+    algebra : Algebra, optional
+        The algebraic properties of the operation (associative, commutative, identity, idempotent).
+        Operands are rewritten into a canonical form before generating the cache key:
+        identity operands are dropped, the operands of commutative operations are sorted
+        and duplicates are collapsed for idempotent operations, so every grouping and ordering
+        of the same multiset shares one cache entry. Replaces `order_matters` when given.
+    domain : tuple[int, int], optional
+        The bounds `(lo, hi)` (inclusive) of the operands of most calls.
+        Results of pairs within the domain are stored in a flat int64 array of (hi - lo + 1) ** 2
+        cells indexed by the operands, so their hits need no hashing and no lock,
+        and are neither audited nor evicted. Only `int` operands are looked up in the array,
+        and results that are not `int` are kept aside in a dict. Other calls use the cache as usual.
+        Cannot be combined with `ttl`.
+    precompute : bool, default=False
+        If `True`, computes the result of every pair of the `domain` when decorating,
+        so every call within the domain is a hit. Not available for coroutine functions.
+    cache_exceptions : bool, exception type or tuple of exception types, default=False
+        If set, exceptions of the given types (any `Exception` if `True`) raised by the operation
+        are cached as well: later calls with the same operands raise the same exception again
+        without recomputing it, until `ttl` expires or `cache_clear()` is called.
+        At most `maxsize` exceptions are kept (65536 if the cache is unbounded).
+    trace : TraceRecorder, optional
+        Records every key looked up in the cache into a binary ring file,
+        to be replayed by `dhlibs.cachedop.tracing.simulate` against other sizes and policies:
+        `python -m dhlibs.cachedop trace.bin --sizes 100 1000 10000` prints their hit-rate curves.
+        Calls served by the `domain` table are not recorded.
+    metrics : bool, default=False
+        If `True`, the time spent looking up the cache and computing results is recorded
+        in fixed-bucket histograms, exported with the cache statistics of every live wrapper
+        by `dhlibs.cachedop.metrics.render_prometheus()` and `metrics_snapshot()`.
+    adaptive : tuple[int, int], optional
+        The `(min, max)` bounds of an adaptive `maxsize`, which must start within them.
+        Sampled shadow caches estimate the hit rate of sizes between the bounds,
+        and the cache is periodically resized to the smallest size whose hit rate
+        is within one percentage point of the largest one. Every decision is audited
+        as an `AuditEvent.TUNE` event. The shadow caches evict the least recently used keys,
+        whatever the `policy`. With `concurrency="sharded"`, every shard tunes its share of the bounds.
+    thread_cache : int, optional
+        The size of a per-thread cache in front of the shared one. Hits of the shared cache
+        are copied into the cache of the calling thread, which then serves them without any lock.
+        Each thread keeps up to `thread_cache` entries, dropping the oldest first, and `cache_clear()`
+        invalidates all of them. Entries evicted from the shared cache may still be served by
+        thread caches, and their hits are neither seen by the `policy` nor by `trace` and `adaptive`.
+        Not supported with `ttl` or coroutine functions.
+    nary : bool or callable, default=True
+        A callable reducing a whole sequence of operands at once, equivalent to folding `op` over them
+        (e.g. `sum` for addition). Calls with at least `nary_threshold` operands are computed
+        by a single call to it and only their result is cached, instead of splitting them
+        into cached pairs. If `True`, it is detected for known operations: `operator.add` (`sum`),
+        `operator.mul` (`math.prod`), `max`, `min`, `math.gcd`, `math.lcm`, `operator.xor`,
+        `operator.or_`, `operator.and_` and binary NumPy ufuncs (`ufunc.reduce`).
+        If `False`, large calls are always split. Calls reduced by the `executor` are not affected.
+    nary_threshold : int, default=64
+        The number of operands from which calls are reduced by `nary`, at least 3.
 
     Returns
     -------
@@ -181,14 +1457,45 @@ def cached_opfunc(
 
     Methods
     -------
-    __call__(*args: int) -> int
+    __call__(*args: T) -> T
         Executes the cached operation with the provided arguments.
         Retrieves the result from the cache if available;
         otherwise, computes the result, stores it in the cache, and returns it.
     cache_info() -> CacheInfo
-        Returns cache statistics, including the number of entries, hits, misses, and cleanup count.
+        Returns cache statistics, including the number of entries, hits, misses, cleanup count,
+        coalesced calls and bytes in use.
     cache_clear() -> None
         Clears all entries in the cache and resets the cache statistics.
+    cache_expire() -> None
+        Drops every expired entry now.
+    export_snapshot() -> bytes
+        Encodes the cached entries in a compact binary form.
+        Int keys (the default) and int64 results are stored as two flat arrays,
+        other entries are pickled.
+    load_snapshot(data: bytes, frozen: bool = False) -> None
+        Loads the entries of a snapshot, they are not counted as misses.
+        If `frozen` is `True`, the entries are kept in a read-only tier looked up before the cache
+        instead, which is never evicted nor expired and is dropped by `cache_clear()`.
+        The int arrays of a frozen tier are only read, so a pre-fork server can load it
+        in the parent (calling `gc.freeze()` before forking) and share its memory copy-on-write
+        with every worker. Only load snapshots from trusted sources, pickled entries may run code.
+    batch(pairs, vectorized=None) -> list[T]
+        Applies the operation to every pair of operands and returns the results in order.
+        Duplicate pairs are computed once, cache hits are looked up under a single lock acquisition
+        and only the missing pairs are computed. `pairs` may be a NumPy array of shape (n, 2).
+        If `vectorized` is given, it is called once with the lists of first and second operands
+        of the missing pairs (e.g. `numpy.add`) instead of calling the operation per pair,
+        and must return as many results. Pairs inside `domain` go through the dense table,
+        cached exceptions are raised again; exceptions of `vectorized` itself are not cached.
+        Not available for coroutine functions.
+    map(xs, ys, vectorized=None) -> list[T]
+        Same as `batch(zip(xs, ys), vectorized)`, `xs` and `ys` may be NumPy arrays.
+    reducer(values) -> SegmentTreeReducer[T]
+        Holds `values` in a segment tree built with the cached operation,
+        supporting O(log n) point updates, range queries and sliding-window reductions.
+        The operation must be associative. It must also be commutative unless `order_matters=True`
+        or an `algebra` is given, since the default keys cache `op(a, b)` and `op(b, a)` as one entry.
+        Not available for coroutine functions.
 
     Examples
     --------
@@ -238,6 +1545,44 @@ def cached_opfunc(
     >>>     expensive_operation(i, i+1)
     >>>
     >>> print(expensive_operation.cache_info())  # Outputs cache statistics after multiple calls
+    >>> expensive_operation.map(range(20), range(1, 21))  # Hits only, looked up in bulk
+
+    >>> window = add.reducer([5, 1, 4, 2, 3])
+    >>> window.query(1, 4)  # 1 + 4 + 2
+    >>> window[2] = 10  # Only recomputes the path to the root
+    >>> list(window.sliding(2))  # [6, 11, 12, 5]
+
+    >>> @cached_opfunc
+    >>> async def remote_add(x: int, y: int) -> int:
+    >>>     await asyncio.sleep(1)
+    >>>     return x + y
+    >>>
+    >>> result = await remote_add(1, 2, 3, 4)  # (1, 2) and (3, 4) are awaited concurrently
+
+    >>> @cached_opfunc(backend=SQLiteBackend("cache.sqlite3"))
+    >>> def slow_pow(x: int, y: int) -> int:
+    >>>     return x**y
+    >>>
+    >>> result = slow_pow(3, 100_000)  # Computed once, then read from disk by later processes
+
+    >>> @cached_opfunc(algebra=Algebra(associative=True, commutative=True, idempotent=True))
+    >>> def gcd(x: int, y: int) -> int:
+    >>>     return math.gcd(x, y)
+    >>>
+    >>> gcd(12, 18, 12, 30)  # Computes gcd(12, 18, 30)
+    >>> gcd(30, 18, 18, 12)  # Same multiset, retrieved from the cache
+
+    >>> @cached_opfunc(domain=(0, 255), precompute=True)
+    >>> def mul_mod(x: int, y: int) -> int:
+    >>>     return x * y % 257
+    >>>
+    >>> mul_mod(12, 200)  # A single array lookup
+
+    >>> @cached_opfunc(algebra=Algebra(associative=True, identity=((1, 0), (0, 1))))
+    >>> def matmul(a: Matrix, b: Matrix) -> Matrix:
+    >>>     return tuple(tuple(sum(x * y for x, y in zip(row, col)) for col in zip(*b)) for row in a)
+    >>>
+    >>> matmul(m, ((1, 0), (0, 1)), m)  # The identity is dropped, computes matmul(m, m)
     """
 
     params = {
@@ -247,8 +1592,30 @@ def cached_opfunc(
         "order_matters": order_matters,
         "recursive": recursive,
         "auditer": auditer,
+        "policy": policy,
+        "concurrency": concurrency,
+        "shards": shards,
+        "single_flight": single_flight,
+        "backend": backend,
+        "executor": executor,
+        "parallel_threshold": parallel_threshold,
+        "max_bytes": max_bytes,
+        "sizer": sizer,
+        "ttl": ttl,
+        "refresh_ahead": refresh_ahead,
+        "timer": timer,
+        "algebra": algebra,
+        "domain": domain,
+        "precompute": precompute,
+        "cache_exceptions": cache_exceptions,
+        "trace": trace,
+        "metrics": metrics,
+        "adaptive": adaptive,
+        "thread_cache": thread_cache,
+        "nary": nary,
+        "nary_threshold": nary_threshold,
     }
-    callback = partial(_cached_opfunc_wrapper, **params)
+    callback = partial(_make_wrapper, **params)
     if op is None:
         # @cached_opfunc(...)
         return callback
@@ -22,56 +22,261 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing_extensions import Callable, Optional, Protocol, overload, type_check_only
+from concurrent.futures import Executor
 
-from dhlibs.cachedop._typings import CacheInfo, KeyCallableType, OperatorCallableType
+from typing_extensions import (
+    Any,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    Literal,
+    Optional,
+    Protocol,
+    Sequence,
+    TypeVar,
+    Union,
+    overload,
+    type_check_only,
+)
+
+from dhlibs.cachedop._typings import (
+    AsyncOperatorCallableType,
+    CacheInfo,
+    KeyCallableType,
+    MissingType,
+    OperatorCallableType,
+    SizerCallableType,
+)
 from dhlibs.cachedop._utils import keymaker
+from dhlibs.cachedop.algebra import Algebra
 from dhlibs.cachedop.audit import Auditer
+from dhlibs.cachedop.backends import BackendType
+from dhlibs.cachedop.metrics import WrapperMetrics
+from dhlibs.cachedop.policies import PolicyType
+from dhlibs.cachedop.reducer import SegmentTreeReducer
+from dhlibs.cachedop.tracing import TraceRecorder
 
 __all__ = ["cached_opfunc"]
 
+_T = TypeVar("_T", bound=Hashable)
+
 @type_check_only
 class _cachemap_protocol(Protocol):
-    def __init__(self, keymaker: keymaker, maxsize: Optional[int], removal_limit: Optional[int]) -> None: ...
+    def __init__(
+        self,
+        keymaker: keymaker,
+        maxsize: Optional[int],
+        removal_limit: Optional[int],
+        auditer: Auditer,
+        policy: PolicyType = "random",
+    ) -> None: ...
     def cleancache(self) -> None: ...
-    def getcache(self, args: tuple[int, ...]) -> Optional[int]: ...
-    def setcache(self, args: tuple[int, ...], value: int) -> int: ...
+    def lookup(self, key: Hashable) -> Union[Hashable, MissingType]: ...
+    def store(self, key: Hashable, value: Hashable) -> Hashable: ...
+    def getcache(self, args: tuple[Hashable, ...]) -> Optional[Hashable]: ...
+    def setcache(self, args: tuple[Hashable, ...], value: Hashable) -> Hashable: ...
+    def lookupmany(self, keys: Sequence[Hashable]) -> list[Union[Hashable, MissingType]]: ...
+    def storemany(self, items: Sequence[tuple[Hashable, Hashable]]) -> None: ...
     def cacheinfo(self) -> CacheInfo: ...
     def clearcache(self) -> None: ...
+    def expire(self) -> None: ...
+    def resize(self, maxsize: int) -> None: ...
+    @property
+    def maxsize(self) -> Optional[int]: ...
+    def claim_refresh(self, key: Hashable) -> bool: ...
+    def release_refresh(self, key: Hashable) -> None: ...
+    def load(self, items: Iterable[tuple[Hashable, Hashable]]) -> None: ...
+    def items(self) -> list[tuple[Hashable, Hashable]]: ...
+
+@type_check_only
+class _cached_opfunc_protocol(Protocol[_T]):
+    __wrapped__: OperatorCallableType[_T]
+    __cache__: _cachemap_protocol
+    metrics: Optional[WrapperMetrics]
+
+    def cache_info(self) -> CacheInfo: ...
+    def __call__(self, *args: _T) -> _T: ...
+    def batch(
+        self,
+        pairs: Iterable[Sequence[_T]],
+        vectorized: Optional[Callable[[list[_T], list[_T]], Any]] = None,
+    ) -> list[_T]: ...
+    def map(
+        self,
+        xs: Iterable[_T],
+        ys: Iterable[_T],
+        vectorized: Optional[Callable[[list[_T], list[_T]], Any]] = None,
+    ) -> list[_T]: ...
+    def reducer(self, values: Iterable[_T]) -> SegmentTreeReducer[_T]: ...
+    def cache_clear(self) -> None: ...
+    def cache_expire(self) -> None: ...
+    def export_snapshot(self) -> bytes: ...
+    def load_snapshot(self, data: bytes, frozen: bool = False) -> None: ...
+    def __repr__(self) -> str: ...
 
 @type_check_only
-class _cached_opfunc_protocol(Protocol):
-    __wrapped__: OperatorCallableType
+class _async_cached_opfunc_protocol(Protocol[_T]):
+    __wrapped__: AsyncOperatorCallableType[_T]
     __cache__: _cachemap_protocol
+    metrics: Optional[WrapperMetrics]
 
     def cache_info(self) -> CacheInfo: ...
-    def __call__(self, *args: int) -> int: ...
+    def __call__(self, *args: _T) -> Awaitable[_T]: ...
     def cache_clear(self) -> None: ...
+    def cache_expire(self) -> None: ...
+    def export_snapshot(self) -> bytes: ...
+    def load_snapshot(self, data: bytes, frozen: bool = False) -> None: ...
     def __repr__(self) -> str: ...
 
+@type_check_only
+class _cached_opfunc_decorator(Protocol):
+    @overload
+    def __call__(self, op: AsyncOperatorCallableType[_T], /) -> _async_cached_opfunc_protocol[_T]: ...
+    @overload
+    def __call__(self, op: OperatorCallableType[_T], /) -> _cached_opfunc_protocol[_T]: ...
+    @overload
+    def __call__(self, op: Callable[[Any, Any], Any], /) -> _cached_opfunc_protocol[Any]: ...
+
+@overload
+def cached_opfunc(op: AsyncOperatorCallableType[_T], /) -> _async_cached_opfunc_protocol[_T]: ...
 @overload
-def cached_opfunc(op: OperatorCallableType, /) -> _cached_opfunc_protocol: ...
+def cached_opfunc(op: OperatorCallableType[_T], /) -> _cached_opfunc_protocol[_T]: ...
+@overload
+def cached_opfunc(op: Callable[[Any, Any], Any], /) -> _cached_opfunc_protocol[Any]: ...
+@overload
+def cached_opfunc(
+    op: AsyncOperatorCallableType[_T],
+    /,
+    *,
+    key: Optional[KeyCallableType[_T]] = None,
+    maxsize: Optional[int] = None,
+    removal_limit: Optional[int] = None,
+    order_matters: bool = False,
+    recursive: bool = True,
+    auditer: Optional[Auditer] = None,
+    policy: PolicyType = "random",
+    concurrency: Literal["locked", "sharded"] = "locked",
+    shards: int = 16,
+    single_flight: bool = False,
+    backend: Optional[BackendType] = None,
+    executor: Optional[Executor] = None,
+    parallel_threshold: int = 4096,
+    max_bytes: Optional[int] = None,
+    sizer: Optional[SizerCallableType[_T]] = None,
+    ttl: Optional[float] = None,
+    refresh_ahead: Optional[float] = None,
+    timer: Callable[[], float] = ...,
+    algebra: Optional[Algebra] = None,
+    domain: Optional[tuple[int, int]] = None,
+    precompute: bool = False,
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]] = False,
+    trace: Optional[TraceRecorder] = None,
+    metrics: bool = False,
+    adaptive: Optional[tuple[int, int]] = None,
+    thread_cache: Optional[int] = None,
+    nary: Union[bool, Callable[[Sequence[_T]], _T]] = True,
+    nary_threshold: int = 64,
+) -> _async_cached_opfunc_protocol[_T]: ...
+@overload
+def cached_opfunc(
+    op: OperatorCallableType[_T],
+    /,
+    *,
+    key: Optional[KeyCallableType[_T]] = None,
+    maxsize: Optional[int] = None,
+    removal_limit: Optional[int] = None,
+    order_matters: bool = False,
+    recursive: bool = True,
+    auditer: Optional[Auditer] = None,
+    policy: PolicyType = "random",
+    concurrency: Literal["locked", "sharded"] = "locked",
+    shards: int = 16,
+    single_flight: bool = False,
+    backend: Optional[BackendType] = None,
+    executor: Optional[Executor] = None,
+    parallel_threshold: int = 4096,
+    max_bytes: Optional[int] = None,
+    sizer: Optional[SizerCallableType[_T]] = None,
+    ttl: Optional[float] = None,
+    refresh_ahead: Optional[float] = None,
+    timer: Callable[[], float] = ...,
+    algebra: Optional[Algebra] = None,
+    domain: Optional[tuple[int, int]] = None,
+    precompute: bool = False,
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]] = False,
+    trace: Optional[TraceRecorder] = None,
+    metrics: bool = False,
+    adaptive: Optional[tuple[int, int]] = None,
+    thread_cache: Optional[int] = None,
+    nary: Union[bool, Callable[[Sequence[_T]], _T]] = True,
+    nary_threshold: int = 64,
+) -> _cached_opfunc_protocol[_T]: ...
 @overload
 def cached_opfunc(
-    op: OperatorCallableType,
+    op: Callable[[Any, Any], Any],
     /,
     *,
-    key: Optional[KeyCallableType] = None,
+    key: Optional[KeyCallableType[Any]] = None,
     maxsize: Optional[int] = None,
     removal_limit: Optional[int] = None,
     order_matters: bool = False,
     recursive: bool = True,
     auditer: Optional[Auditer] = None,
-) -> _cached_opfunc_protocol: ...
+    policy: PolicyType = "random",
+    concurrency: Literal["locked", "sharded"] = "locked",
+    shards: int = 16,
+    single_flight: bool = False,
+    backend: Optional[BackendType] = None,
+    executor: Optional[Executor] = None,
+    parallel_threshold: int = 4096,
+    max_bytes: Optional[int] = None,
+    sizer: Optional[SizerCallableType[Any]] = None,
+    ttl: Optional[float] = None,
+    refresh_ahead: Optional[float] = None,
+    timer: Callable[[], float] = ...,
+    algebra: Optional[Algebra] = None,
+    domain: Optional[tuple[int, int]] = None,
+    precompute: bool = False,
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]] = False,
+    trace: Optional[TraceRecorder] = None,
+    metrics: bool = False,
+    adaptive: Optional[tuple[int, int]] = None,
+    thread_cache: Optional[int] = None,
+    nary: Union[bool, Callable[[Sequence[Any]], Any]] = True,
+    nary_threshold: int = 64,
+) -> _cached_opfunc_protocol[Any]: ...
 @overload
 def cached_opfunc(
     op: None = None,
     /,
     *,
-    key: Optional[KeyCallableType] = None,
+    key: Optional[KeyCallableType[Any]] = None,
     maxsize: Optional[int] = None,
     removal_limit: Optional[int] = None,
     order_matters: bool = False,
     recursive: bool = True,
     auditer: Optional[Auditer] = None,
-) -> Callable[[OperatorCallableType], _cached_opfunc_protocol]: ...
+    policy: PolicyType = "random",
+    concurrency: Literal["locked", "sharded"] = "locked",
+    shards: int = 16,
+    single_flight: bool = False,
+    backend: Optional[BackendType] = None,
+    executor: Optional[Executor] = None,
+    parallel_threshold: int = 4096,
+    max_bytes: Optional[int] = None,
+    sizer: Optional[SizerCallableType[Any]] = None,
+    ttl: Optional[float] = None,
+    refresh_ahead: Optional[float] = None,
+    timer: Callable[[], float] = ...,
+    algebra: Optional[Algebra] = None,
+    domain: Optional[tuple[int, int]] = None,
+    precompute: bool = False,
+    cache_exceptions: Union[bool, type[BaseException], tuple[type[BaseException], ...]] = False,
+    trace: Optional[TraceRecorder] = None,
+    metrics: bool = False,
+    adaptive: Optional[tuple[int, int]] = None,
+    thread_cache: Optional[int] = None,
+    nary: Union[bool, Callable[[Sequence[Any]], Any]] = True,
+    nary_threshold: int = 64,
+) -> _cached_opfunc_decorator: ...
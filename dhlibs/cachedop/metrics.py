@@ -0,0 +1,196 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.metrics - latency histograms and exporters of cached operations"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock
+from time import perf_counter
+from weakref import WeakSet
+
+from typing_extensions import Any, Awaitable, Callable, Optional, Protocol, TypeVar, cast
+
+from dhlibs.cachedop._typings import CacheInfo
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+
+class Histogram:
+    """Counts of durations (in seconds) in fixed buckets, like Prometheus histograms."""
+
+    bounds = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self) -> None:
+        # the last count is the +Inf bucket
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+
+    def snapshot(self) -> dict[str, Any]:
+        """Return the cumulative count of every bucket upper bound, the count and the sum."""
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        buckets: dict[float, int] = {}
+        cumulative = 0
+        for bound, count in zip((*self.bounds, float("inf")), counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": total}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts = [0] * (len(self.bounds) + 1)
+            self._sum = 0.0
+
+
+class WrapperMetrics:
+    """The lookup and compute time histograms of a cached operation."""
+
+    def __init__(self) -> None:
+        self.lookup = Histogram()
+        self.compute = Histogram()
+
+    @staticmethod
+    def timed(func: _F, histogram: Histogram) -> _F:
+        """Wrap `func` (a function or a coroutine function) to observe its duration in `histogram`."""
+        if iscoroutinefunction(func):
+            afunc = cast(Callable[..., Awaitable[Any]], func)
+
+            @wraps(func)
+            async def atimed(*args: Any) -> Any:
+                start = perf_counter()
+                try:
+                    return await afunc(*args)
+                finally:
+                    histogram.observe(perf_counter() - start)
+
+            return cast(_F, atimed)
+
+        @wraps(func)
+        def timed(*args: Any) -> Any:
+            start = perf_counter()
+            try:
+                return func(*args)
+            finally:
+                histogram.observe(perf_counter() - start)
+
+        return cast(_F, timed)
+
+    def clear(self) -> None:
+        self.lookup.clear()
+        self.compute.clear()
+
+
+class _measured(Protocol):
+    @property
+    def __wrapped__(self) -> Callable[..., Any]: ...
+    @property
+    def metrics(self) -> Optional[WrapperMetrics]: ...
+
+    def cache_info(self) -> CacheInfo: ...
+
+
+_wrappers: WeakSet[_measured] = WeakSet()
+
+
+def register_wrapper(wrapper: _measured) -> None:
+    """Called by every cached operation when it is created."""
+    _wrappers.add(wrapper)
+
+
+def live_wrappers() -> list[_measured]:
+    """Return every cached operation that is still alive."""
+    return list(_wrappers)
+
+
+def _name(wrapper: _measured) -> str:
+    op = wrapper.__wrapped__
+    module = getattr(op, "__module__", None)
+    qualname = getattr(op, "__qualname__", None) or repr(op)
+    return f"{module}.{qualname}" if module else qualname
+
+
+def metrics_snapshot() -> list[dict[str, Any]]:
+    """Return the statistics of every live cached operation as dicts."""
+    snapshot: list[dict[str, Any]] = []
+    for wrapper in live_wrappers():
+        info = wrapper.cache_info()
+        metrics = wrapper.metrics
+        snapshot.append(
+            {
+                "op": _name(wrapper),
+                "id": hex(id(wrapper)),
+                "size": info.size,
+                "hits": info.hits,
+                "misses": info.misses,
+                "evictions": info.cleanup_count,
+                "coalesced": info.coalesced,
+                "bytes": info.bytes,
+                "lookup_seconds": metrics.lookup.snapshot() if metrics is not None else None,
+                "compute_seconds": metrics.compute.snapshot() if metrics is not None else None,
+            }
+        )
+    return snapshot
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_counters = (
+    ("size", "gauge", "cachedop_entries", "Number of cached results."),
+    ("bytes", "gauge", "cachedop_bytes", "Estimated size in bytes of the cached results."),
+    ("hits", "counter", "cachedop_hits_total", "Cache hits."),
+    ("misses", "counter", "cachedop_misses_total", "Cache misses."),
+    ("evictions", "counter", "cachedop_evictions_total", "Cached results evicted or expired."),
+    ("coalesced", "counter", "cachedop_coalesced_total", "Computations avoided by coalescing concurrent calls."),
+)
+_histograms = (
+    ("lookup_seconds", "cachedop_lookup_seconds", "Time spent looking up the cache."),
+    ("compute_seconds", "cachedop_compute_seconds", "Time spent computing results."),
+)
+
+
+def render_prometheus() -> str:
+    """Render the statistics of every live cached operation in the Prometheus text format."""
+    snapshot = metrics_snapshot()
+    lines: list[str] = []
+    for field, kind, metric, description in _counters:
+        lines.extend((f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"))
+        for entry in snapshot:
+            labels = f'op="{_escape(entry["op"])}",id="{entry["id"]}"'
+            lines.append(f"{metric}{{{labels}}} {entry[field]}")
+    for field, metric, description in _histograms:
+        lines.extend((f"# HELP {metric} {description}", f"# TYPE {metric} histogram"))
+        for entry in snapshot:
+            histogram = entry[field]
+            if histogram is None:
+                continue
+            labels = f'op="{_escape(entry["op"])}",id="{entry["id"]}"'
+            for bound, count in histogram["buckets"].items():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"{metric}_sum{{{labels}}} {histogram['sum']}")
+            lines.append(f"{metric}_count{{{labels}}} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+__all__ = [
+    "Histogram",
+    "WrapperMetrics",
+    "register_wrapper",
+    "live_wrappers",
+    "metrics_snapshot",
+    "render_prometheus",
+]
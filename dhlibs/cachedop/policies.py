@@ -0,0 +1,281 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.policies - eviction policies for cached_opfunc"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from random import randrange
+
+from typing_extensions import Callable, Hashable, Optional, Union
+
+
+class EvictionPolicy:
+    """
+    Base class of eviction policies.
+
+    A policy only tracks cache keys, the cache itself owns the values.
+    Every method is called with the cache lock held.
+    """
+
+    name = "base"
+    # if True, the cache evicts `removal_limit` keys at once when full,
+    # otherwise keys are evicted one by one as new keys are stored.
+    batched = False
+    # if False, the policy does not care about hits and
+    # the cache may skip `access` (and its lock) on the hit path.
+    tracks_access = True
+
+    def setup(self, maxsize: Optional[int]) -> None:
+        """Called once by the cache that owns this policy."""
+
+    def access(self, key: Hashable) -> None:
+        """Record a cache hit of `key`."""
+
+    def insert(self, key: Hashable) -> None:
+        """Record that `key` was stored into the cache."""
+        raise NotImplementedError
+
+    def remove(self, key: Hashable) -> None:
+        """Record that `key` was removed from the cache."""
+        raise NotImplementedError
+
+    def victim(self) -> Hashable:
+        """Return the next key to evict, without removing it."""
+        raise NotImplementedError
+
+    def admit(self, key: Hashable, victim: Optional[Hashable]) -> bool:  # noqa: ARG002
+        """
+        Decide if `key` should be stored.
+        `victim` is the key that would be evicted for it, or `None` if the cache has room.
+        """
+        return True
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__}>"
+
+
+class RandomPolicy(EvictionPolicy):
+    """Evict random keys in batches of `removal_limit`, the original cachedop behavior."""
+
+    name = "random"
+    batched = True
+    tracks_access = False
+
+    def __init__(self) -> None:
+        self._keys: list[Hashable] = []
+        self._index: dict[Hashable, int] = {}
+
+    def insert(self, key: Hashable) -> None:
+        if key in self._index:
+            return
+        self._index[key] = len(self._keys)
+        self._keys.append(key)
+
+    def remove(self, key: Hashable) -> None:
+        index = self._index.pop(key, None)
+        if index is None:
+            return
+        # swap with the last key so removal stays O(1)
+        last = self._keys.pop()
+        if index < len(self._keys):
+            self._keys[index] = last
+            self._index[last] = index
+
+    def victim(self) -> Hashable:
+        return self._keys[randrange(len(self._keys))]
+
+    def clear(self) -> None:
+        self._keys.clear()
+        self._index.clear()
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used key."""
+
+    name = "lru"
+
+    def __init__(self) -> None:
+        self._order: OrderedDict[Hashable, None] = OrderedDict()
+
+    def access(self, key: Hashable) -> None:
+        if key in self._order:
+            self._order.move_to_end(key)
+
+    def insert(self, key: Hashable) -> None:
+        self._order[key] = None
+        self._order.move_to_end(key)
+
+    def remove(self, key: Hashable) -> None:
+        self._order.pop(key, None)
+
+    def victim(self) -> Hashable:
+        return next(iter(self._order))
+
+    def clear(self) -> None:
+        self._order.clear()
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used key, ties are broken by recency."""
+
+    name = "lfu"
+
+    def __init__(self) -> None:
+        self._freqs: dict[Hashable, int] = {}
+        # frequency -> keys in insertion order (dicts used as ordered sets)
+        self._buckets: dict[int, dict[Hashable, None]] = {}
+        self._minfreq = 0
+
+    def _bump(self, key: Hashable, freq: int) -> None:
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._minfreq == freq:
+                self._minfreq = freq + 1
+        self._freqs[key] = freq + 1
+        self._buckets.setdefault(freq + 1, {})[key] = None
+
+    def access(self, key: Hashable) -> None:
+        freq = self._freqs.get(key)
+        if freq is not None:
+            self._bump(key, freq)
+
+    def insert(self, key: Hashable) -> None:
+        freq = self._freqs.get(key)
+        if freq is not None:
+            self._bump(key, freq)
+            return
+        self._freqs[key] = 1
+        self._buckets.setdefault(1, {})[key] = None
+        self._minfreq = 1
+
+    def remove(self, key: Hashable) -> None:
+        freq = self._freqs.pop(key, None)
+        if freq is None:
+            return
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if self._minfreq == freq:
+                self._minfreq = min(self._buckets, default=0)
+
+    def victim(self) -> Hashable:
+        return next(iter(self._buckets[self._minfreq]))
+
+    def clear(self) -> None:
+        self._freqs.clear()
+        self._buckets.clear()
+        self._minfreq = 0
+
+
+class _countminsketch:
+    _depth = 4
+    _seeds = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)
+
+    def __init__(self, width: int) -> None:
+        size = 16
+        while size < width:
+            size <<= 1
+        self._mask = size - 1
+        self._table = bytearray(size * self._depth)
+        self._width = size
+        self._additions = 0
+        self._sample_size = size * 10
+
+    def _indexes(self, key: Hashable) -> list[int]:
+        h = hash(key)
+        width, mask = self._width, self._mask
+        return [row * width + (((h ^ seed) * 0x9E3779B1) >> 16 & mask) for row, seed in enumerate(self._seeds)]
+
+    def increment(self, key: Hashable) -> None:
+        table = self._table
+        for index in self._indexes(key):
+            if table[index] < 15:
+                table[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._age()
+
+    def estimate(self, key: Hashable) -> int:
+        table = self._table
+        return min(table[index] for index in self._indexes(key))
+
+    def _age(self) -> None:
+        # halve every counter so old popularity fades out
+        self._table = bytearray(count >> 1 for count in self._table)
+        self._additions //= 2
+
+    def clear(self) -> None:
+        self._table = bytearray(len(self._table))
+        self._additions = 0
+
+
+class TinyLFUPolicy(LRUPolicy):
+    """
+    LRU eviction guarded by a TinyLFU admission filter.
+
+    Access frequencies are estimated with a small count-min sketch that is
+    periodically aged. When the cache is full, a new key is only stored if it
+    was seen more often than the LRU victim it would replace, so one-off keys
+    cannot flush hot entries out.
+    """
+
+    name = "tinylfu"
+
+    def __init__(self, width: Optional[int] = None) -> None:
+        super().__init__()
+        self._width = width
+        self._sketch = _countminsketch(width or 1024)
+
+    def setup(self, maxsize: Optional[int]) -> None:
+        if self._width is None and maxsize is not None:
+            self._sketch = _countminsketch(maxsize)
+
+    def access(self, key: Hashable) -> None:
+        self._sketch.increment(key)
+        super().access(key)
+
+    def admit(self, key: Hashable, victim: Optional[Hashable]) -> bool:
+        self._sketch.increment(key)
+        if victim is None:
+            return True
+        return self._sketch.estimate(key) > self._sketch.estimate(victim)
+
+    def clear(self) -> None:
+        super().clear()
+        self._sketch.clear()
+
+
+PolicyType = Union[str, EvictionPolicy, Callable[[], EvictionPolicy]]
+
+_policies: dict[str, Callable[[], EvictionPolicy]] = {
+    RandomPolicy.name: RandomPolicy,
+    LRUPolicy.name: LRUPolicy,
+    LFUPolicy.name: LFUPolicy,
+    TinyLFUPolicy.name: TinyLFUPolicy,
+}
+
+
+def resolve_policy(policy: PolicyType) -> EvictionPolicy:
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    if isinstance(policy, str):
+        try:
+            factory = _policies[policy.lower()]
+        except KeyError:
+            raise ValueError(f"unknown eviction policy: {policy!r}") from None
+        return factory()
+    if callable(policy):
+        return policy()
+    raise TypeError(f"invalid eviction policy: {policy!r}")
+
+
+__all__ = ["EvictionPolicy", "RandomPolicy", "LRUPolicy", "LFUPolicy", "TinyLFUPolicy", "resolve_policy"]
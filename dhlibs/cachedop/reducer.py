@@ -0,0 +1,101 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.reducer - segment tree reductions over a binary operation"""
+
+from __future__ import annotations
+
+from typing_extensions import Generic, Iterable, Iterator, Optional
+
+from dhlibs.cachedop._typings import OperandT, OperatorCallableType
+
+
+class SegmentTreeReducer(Generic[OperandT]):
+    """
+    Hold a sequence in a segment tree to reduce any of its ranges with `op`.
+
+    `op` must be associative, it does not need to be commutative. The `reducer()` method
+    of cached operations is the exception: their default keys do not tell `op(a, b)`
+    from `op(b, a)`, so use `order_matters=True` or an `Algebra` for non-commutative ones.
+    Point updates and range queries take O(log n) calls of `op`,
+    instead of re-reducing the whole range after every change.
+    Usually created by the `reducer()` method of a cached operation,
+    so the partial results are cached as well.
+    """
+
+    def __init__(self, op: OperatorCallableType[OperandT], values: Iterable[OperandT]) -> None:
+        values = list(values)
+        if not values:
+            raise ValueError("no values were given")
+        self._op = op
+        self._size = size = len(values)
+        # the inner nodes are filled below, any value can hold their place meanwhile
+        self._tree = values[:1] * size + values
+        for index in range(size - 1, 0, -1):
+            self._tree[index] = op(self._tree[2 * index], self._tree[2 * index + 1])
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("reducer index out of range")
+        return index
+
+    def __getitem__(self, index: int) -> OperandT:
+        return self._tree[self._index(index) + self._size]
+
+    def __setitem__(self, index: int, value: OperandT) -> None:
+        op, tree = self._op, self._tree
+        position = self._index(index) + self._size
+        tree[position] = value
+        position //= 2
+        while position >= 1:
+            tree[position] = op(tree[2 * position], tree[2 * position + 1])
+            position //= 2
+
+    def __iter__(self) -> Iterator[OperandT]:
+        return iter(self._tree[self._size :])
+
+    def query(self, start: int = 0, stop: Optional[int] = None) -> OperandT:
+        """Reduce `values[start:stop]`, the range must not be empty."""
+        start, stop, _ = slice(start, stop).indices(self._size)
+        if start >= stop:
+            raise ValueError("cannot reduce an empty range")
+        op, tree = self._op, self._tree
+        left: Optional[OperandT] = None
+        right: Optional[OperandT] = None
+        lo, hi = start + self._size, stop + self._size
+        while lo < hi:
+            if lo & 1:
+                left = tree[lo] if left is None else op(left, tree[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                right = tree[hi] if right is None else op(tree[hi], right)
+            lo //= 2
+            hi //= 2
+        if left is None:
+            return right  # type: ignore[return-value]
+        if right is None:
+            return left
+        return op(left, right)
+
+    def total(self) -> OperandT:
+        return self.query()
+
+    def sliding(self, window: int) -> Iterator[OperandT]:
+        """Yield the reduction of every window of `window` consecutive values."""
+        if window <= 0:
+            raise ValueError("window must be positive")
+        for start in range(self._size - window + 1):
+            yield self.query(start, start + window)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} of {self._op!r} with {self._size} values>"
+
+
+__all__ = ["SegmentTreeReducer"]
@@ -0,0 +1,90 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.snapshot - binary snapshots and frozen tiers of cache entries"""
+
+from __future__ import annotations
+
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+
+from typing_extensions import Hashable, Iterable, Union, cast
+
+from dhlibs.cachedop._typings import MISSING, MissingType
+
+_header = struct.Struct("<8sBq")
+_magic = b"DHCOSNAP"
+# entries are either two int64 arrays (keys sorted, then values), or a pickled list of (key, value)
+_int64, _pickled = 0, 1
+_min, _max = -(1 << 63), 1 << 63
+
+
+def _isint64(value: object) -> bool:
+    # not bools, they would come back as ints
+    return type(value) is int and _min <= value < _max
+
+
+def dumps(items: Iterable[tuple[Hashable, Hashable]]) -> bytes:
+    """Encode cache entries, int keys and values are stored as raw int64 arrays."""
+    entries = list(items)
+    if all(_isint64(key) and _isint64(value) for key, value in entries):
+        ints = sorted(cast("list[tuple[int, int]]", entries))
+        keys = array("q", [key for key, _ in ints])
+        values = array("q", [value for _, value in ints])
+        return _header.pack(_magic, _int64, len(ints)) + keys.tobytes() + values.tobytes()
+    return _header.pack(_magic, _pickled, len(entries)) + pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class frozentier:
+    """
+    A read-only table of cache entries.
+
+    Int entries are kept in two flat int64 arrays sorted by key and found by binary search.
+    Reading them never writes to the arrays, so a tier loaded before forking stays shared
+    copy-on-write between the children. Other entries are kept in a plain dict.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        if len(data) < _header.size:
+            raise ValueError("not a cachedop snapshot")
+        magic, kind, count = _header.unpack_from(data)
+        if magic != _magic or kind not in (_int64, _pickled):
+            raise ValueError("not a cachedop snapshot")
+        self._keys = array("q")
+        self._values = array("q")
+        self._entries: dict[Hashable, Hashable] = {}
+        body = memoryview(data)[_header.size :]
+        if kind == _pickled:
+            # only load snapshots from trusted sources, like pickles
+            self._entries = dict(pickle.loads(body))
+            return
+        size = count * self._keys.itemsize
+        if len(body) != 2 * size:
+            raise ValueError("truncated cachedop snapshot")
+        self._keys.frombytes(body[:size])
+        self._values.frombytes(body[size:])
+
+    def get(self, key: Hashable) -> Union[Hashable, MissingType]:
+        if self._entries:
+            return self._entries.get(key, MISSING)
+        if not isinstance(key, int):
+            return MISSING
+        keys = self._keys
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return self._values[index]
+        return MISSING
+
+    def items(self) -> list[tuple[Hashable, Hashable]]:
+        if self._entries:
+            return list(self._entries.items())
+        return list(zip(self._keys, self._values))
+
+    def __len__(self) -> int:
+        return len(self._entries) or len(self._keys)
+
+
+__all__ = ["dumps", "frozentier"]
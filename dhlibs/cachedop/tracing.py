@@ -0,0 +1,175 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.tracing - key access traces and an offline cache simulator"""
+
+from __future__ import annotations
+
+import argparse
+import struct
+from array import array
+from pathlib import Path
+from threading import Lock
+
+from typing_extensions import Hashable, Iterable, Optional, Sequence, Union
+
+from dhlibs.cachedop._typings import MISSING
+from dhlibs.cachedop.audit import Auditer
+from dhlibs.cachedop.policies import PolicyType
+
+_header = struct.Struct("<8sqq")
+_magic = b"DHCOTRC1"
+
+
+class TraceRecorder:
+    """
+    Record the stream of keys looked up by caches into a binary ring file.
+
+    The file holds a header and `capacity` int64 slots, once it is full the oldest keys
+    are overwritten. Each key is recorded as its hash. Keys are buffered in memory
+    and written `chunk` at a time, call `close()` (or use the recorder as a context manager)
+    to write the rest. Pass the recorder as `trace` to `cached_opfunc`.
+    """
+
+    def __init__(self, path: Union[str, Path], capacity: int = 1 << 20, chunk: int = 4096) -> None:
+        if capacity <= 0 or chunk <= 0:
+            raise ValueError("capacity and chunk must be positive")
+        self._path = Path(path)
+        self._capacity = capacity
+        self._chunk = chunk
+        self._count = 0
+        self._buffer = array("q")
+        self._lock = Lock()
+        self._file = self._path.open("w+b")  # noqa: SIM115
+        self._file.write(_header.pack(_magic, capacity, 0))
+        self._file.truncate(_header.size + capacity * 8)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def record(self, key: Hashable) -> None:
+        # under the lock, flush() swaps the buffer out from under concurrent appends
+        with self._lock:
+            buffer = self._buffer
+            buffer.append(hash(key))
+            full = len(buffer) >= self._chunk
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            buffer, self._buffer = self._buffer, array("q")
+            if not buffer or self._file.closed:
+                return
+            # only the last `capacity` keys of the buffer can survive
+            data = buffer[-self._capacity :]
+            position = (self._count + len(buffer) - len(data)) % self._capacity
+            head = data[: self._capacity - position]
+            self._file.seek(_header.size + position * 8)
+            self._file.write(head.tobytes())
+            if len(head) < len(data):
+                self._file.seek(_header.size)
+                self._file.write(data[len(head) :].tobytes())
+            self._count += len(buffer)
+            self._file.seek(0)
+            self._file.write(_header.pack(_magic, self._capacity, self._count))
+            self._file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> TraceRecorder:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {str(self._path)!r} capacity={self._capacity}>"
+
+
+def read_trace(path: Union[str, Path]) -> array[int]:
+    """Return the recorded keys of a trace file, oldest first."""
+    data = Path(path).read_bytes()
+    if len(data) < _header.size:
+        raise ValueError("not a cachedop trace")
+    magic, capacity, count = _header.unpack_from(data)
+    if magic != _magic:
+        raise ValueError("not a cachedop trace")
+    slots = array("q")
+    slots.frombytes(data[_header.size : _header.size + capacity * 8])
+    if count <= capacity:
+        return slots[:count]
+    position = count % capacity
+    return slots[position:] + slots[:position]
+
+
+def _noop(_x: int, _y: int) -> int:
+    return 0
+
+
+def simulate(
+    trace: Sequence[int],
+    sizes: Iterable[int],
+    policies: Iterable[PolicyType] = ("random", "lru", "lfu", "tinylfu"),
+    removal_limit: Optional[int] = None,
+) -> dict[str, list[tuple[int, float]]]:
+    """
+    Replay `trace` against caches of every size and policy.
+
+    Return the hit rate of every size, by policy name.
+    The caches are the ones used by `cached_opfunc`, so `removal_limit`
+    has the same meaning and default.
+    """
+    # imported here, the core module imports this one
+    from dhlibs.cachedop.core import cached_opfunc  # noqa: PLC0415
+
+    curves: dict[str, list[tuple[int, float]]] = {}
+    sizes = sorted(sizes)
+    for policy in policies:
+        curve: list[tuple[int, float]] = []
+        name = policy if isinstance(policy, str) else getattr(policy, "name", repr(policy))
+        for size in sizes:
+            limit = None if removal_limit is None else min(removal_limit, size)
+            cache = cached_opfunc(_noop, maxsize=size, removal_limit=limit, policy=policy, auditer=Auditer()).__cache__
+            lookup, store = cache.lookup, cache.store
+            for key in trace:
+                if lookup(key) is MISSING:
+                    store(key, 0)
+            curve.append((size, cache.cacheinfo().hits / len(trace) if trace else 0.0))
+        curves[name] = curve
+    return curves
+
+
+def format_curves(curves: dict[str, list[tuple[int, float]]], width: int = 40) -> str:
+    """Render hit-rate curves as a text table with a bar per size."""
+    lines: list[str] = []
+    for name, curve in curves.items():
+        lines.append(f"{name}:")
+        for size, rate in curve:
+            lines.append(f"  {size:>10}  {rate:7.2%}  {'#' * round(rate * width)}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m dhlibs.cachedop",
+        description="print the hit-rate curves of a cachedop trace",
+    )
+    parser.add_argument("trace", type=Path, help="a trace file written by TraceRecorder")
+    parser.add_argument("--sizes", type=int, nargs="+", required=True, help="the maxsize values to simulate")
+    parser.add_argument(
+        "--policies", nargs="+", default=["random", "lru", "lfu", "tinylfu"], help="the eviction policies to simulate"
+    )
+    parser.add_argument("--removal-limit", type=int, default=None, help="removal_limit of the simulated caches")
+    args = parser.parse_args(argv)
+    trace = read_trace(args.trace)
+    print(f"{len(trace)} keys, {len(set(trace))} distinct")
+    print(format_curves(simulate(trace, args.sizes, args.policies, args.removal_limit)))
+
+
+__all__ = ["TraceRecorder", "read_trace", "simulate", "format_curves", "main"]
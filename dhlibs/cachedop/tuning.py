@@ -0,0 +1,98 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+"""dhlibs.cachedop.tuning - runtime estimation of the best cache size"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from threading import Lock
+
+from typing_extensions import Hashable
+
+# spreads the bits of hashes before sampling, sharded caches already use the low bits
+_golden = 0x9E3779B97F4A7C15
+_mask = (1 << 64) - 1
+
+
+class sizetuner:
+    """
+    Estimate the hit rates of cache sizes between `lo` and `hi` with sampled shadow caches.
+
+    The candidate sizes double from `lo` up to `hi`. Keys are sampled by hash, so a key is
+    either always or never sampled, at the rate giving the smallest candidate `minimum` shadow
+    entries. Every candidate has a shadow LRU cache of its size scaled down by that rate,
+    which only holds sampled keys, so its hit rate estimates the one of a full cache of that size.
+
+    Once `window` sampled keys were seen, `decide()` picks the smallest candidate whose hit rate
+    is within `gain` of the largest one, growing past it would not pay for the memory.
+    """
+
+    def __init__(self, lo: int, hi: int, window: int = 4096, gain: float = 0.01, minimum: int = 32) -> None:
+        if not 0 < lo <= hi:
+            raise ValueError("adaptive bounds must be positive, the lower one first")
+        sizes: list[int] = []
+        size = lo
+        while size < hi:
+            sizes.append(size)
+            size *= 2
+        sizes.append(hi)
+        self.sizes = sizes
+        rate = min(1.0, minimum / lo)
+        self._threshold = int(rate * (1 << 64))
+        self._capacities = [max(1, round(size * rate)) for size in sizes]
+        self._shadows: list[OrderedDict[Hashable, None]] = [OrderedDict() for _ in sizes]
+        self._hits = [0.0] * len(sizes)
+        self._accesses = 0.0
+        self._sampled = 0
+        self._window = window
+        self._gain = gain
+        self._lock = Lock()
+
+    def observe(self, key: Hashable) -> bool:
+        """Record a lookup of `key`, tell if a decision is due."""
+        if (hash(key) * _golden) & _mask >= self._threshold:
+            return False
+        with self._lock:
+            for index, shadow in enumerate(self._shadows):
+                if key in shadow:
+                    shadow.move_to_end(key)
+                    self._hits[index] += 1
+                else:
+                    shadow[key] = None
+                    if len(shadow) > self._capacities[index]:
+                        shadow.popitem(last=False)
+            self._accesses += 1
+            self._sampled += 1
+            if self._sampled < self._window:
+                return False
+            self._sampled = 0
+            return True
+
+    def hitrates(self) -> list[float]:
+        """Return the estimated hit rate of every candidate size."""
+        with self._lock:
+            accesses = self._accesses
+            return [hits / accesses if accesses else 0.0 for hits in self._hits]
+
+    def decide(self) -> int:
+        """Return the size to use and forget half of the history, so estimates follow traffic shifts."""
+        rates = self.hitrates()
+        best = rates[-1]
+        choice = next(size for size, rate in zip(self.sizes, rates) if best - rate <= self._gain)
+        with self._lock:
+            self._hits = [hits / 2 for hits in self._hits]
+            self._accesses /= 2
+        return choice
+
+    def clear(self) -> None:
+        with self._lock:
+            for shadow in self._shadows:
+                shadow.clear()
+            self._hits = [0.0] * len(self.sizes)
+            self._accesses = 0.0
+            self._sampled = 0
+
+
+__all__ = ["sizetuner"]
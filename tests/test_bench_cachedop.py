@@ -0,0 +1,26 @@
+# This file is part of dhlibs (https://github.com/DinhHuy2010/dhlibs)
+# Copyright (c) 2024 DinhHuy2010 (https://github.com/DinhHuy2010)
+# SPDX-License-Identifier: MIT OR Apache-2.0 OR MPL-2.0
+
+# pyright: basic
+from __future__ import annotations
+
+import json
+
+from benchmarks import bench_cachedop
+
+
+def test_benchmark_runner(tmp_path):
+    selected = [s for s in bench_cachedop.scenarios() if s.name in ("hit/fast", "nary/builtin", "contention/4/lru")]
+    results = bench_cachedop.run(selected, repeat=1, min_time=0)
+    assert list(results["results"]) == ["hit/fast", "nary/builtin", "contention/4/lru"]
+    assert all(result["ns_per_op"] > 0 for result in results["results"].values())
+    path = tmp_path / "base.json"
+    path.write_text(json.dumps(results))
+    base = json.loads(path.read_text())
+    slower = json.loads(path.read_text())
+    slower["results"]["hit/fast"]["ns_per_op"] *= 2
+    table, regressions = bench_cachedop.compare(base, slower)
+    assert regressions == ["hit/fast"]
+    assert "+100.0%" in table
+    assert bench_cachedop.main(["--compare", str(path), str(path)]) == 0
@@ -5,14 +5,25 @@
 # pyright: basic
 from __future__ import annotations
 
+import asyncio
+import atexit
+import json
+import math
+import multiprocessing
 import operator
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from decimal import Decimal
+from fractions import Fraction
 
 import pytest
 import typing_extensions
 
 from dhlibs import cachedop
 from dhlibs.cachedop._typings import AuditEvent
-from dhlibs.cachedop._utils import keymaker
+from dhlibs.cachedop._utils import counter, keymaker
+from dhlibs.cachedop.algebra import Algebra
 from dhlibs.cachedop.audit import Auditer
 
 
@@ -62,6 +73,40 @@ def test_keymaker_order_is_not_matter():
     assert maker.make_key((1, 2)) == maker.make_key((2, 1)) == str((1, 2))
 
 
+def test_keymaker_memo_is_bounded():
+    calls = 0
+
+    def falsy(args: tuple[int, ...]) -> int:
+        nonlocal calls
+        calls += 1
+        return 0 if args == (0, 0) else sum(args)
+
+    maker = keymaker(falsy, memo_size=4)
+    for _ in range(3):
+        assert maker.make_key((0, 0)) == 0
+    assert calls == 1
+    for i in range(1, 10):
+        maker.make_key((i, i))
+    assert len(maker._memo) == 4
+    maker.forget(18)
+    assert (9, 9) not in maker._memo
+    hashed = keymaker()
+    assert hashed.make_key((1, 2)) == hash((1, 2))
+    assert not hashed._memo
+
+
+def test_key_memo_follows_eviction():
+    @cachedop.cached_opfunc(key=str, maxsize=4, removal_limit=1, policy="lru")
+    def add(x: int, y: int) -> int:
+        return x + y
+
+    for i in range(1, 20):
+        add(i, i)
+    assert len(add._keymaker._memo) == 4  # type: ignore[attr-defined]
+    add.cache_clear()
+    assert not add._keymaker._memo  # type: ignore[attr-defined]
+
+
 def test_auditer(auditer):
     calls = 0
     cached_called = 0
@@ -81,3 +126,1160 @@ def test_auditer(auditer):
     cached_add(1, 2)
     assert calls == 1
     assert cached_called == 2
+
+
+def test_random_policy_cleanup():
+    cached_mul = cachedop.cached_opfunc(operator.mul, maxsize=30, removal_limit=10)
+    for i in range(40):
+        cached_mul(i, i + 1)
+    info = cached_mul.cache_info()
+    assert info.size <= 30
+    assert info.cleanup_count == 10
+
+
+def test_lru_policy():
+    cached_add = cachedop.cached_opfunc(operator.add, maxsize=3, policy="lru")
+    cached_add(1, 1)
+    cached_add(2, 2)
+    cached_add(3, 3)
+    cached_add(1, 1)  # (1, 1) is now the most recently used
+    cached_add(4, 4)  # evicts (2, 2)
+    info = cached_add.cache_info()
+    assert info.size == 3
+    assert info.cleanup_count == 1
+    cached_add(1, 1)
+    assert cached_add.cache_info().hits == 2
+    cached_add(2, 2)
+    assert cached_add.cache_info().misses == 5
+
+
+def test_lfu_policy():
+    cached_add = cachedop.cached_opfunc(operator.add, maxsize=2, policy=cachedop.LFUPolicy)
+    cached_add(1, 1)
+    cached_add(1, 1)
+    cached_add(2, 2)
+    cached_add(3, 3)  # evicts (2, 2), the least frequently used
+    cached_add(1, 1)
+    assert cached_add.cache_info().hits == 2
+    cached_add(2, 2)
+    assert cached_add.cache_info().misses == 4
+
+
+def test_tinylfu_policy_admission():
+    cached_add = cachedop.cached_opfunc(operator.add, maxsize=2, policy="tinylfu")
+    for _ in range(5):
+        cached_add(1, 1)
+        cached_add(2, 2)
+    # one-off keys are not admitted over hot entries
+    for i in range(10, 20):
+        cached_add(i, i)
+    info = cached_add.cache_info()
+    assert info.size == 2
+    cached_add(1, 1)
+    cached_add(2, 2)
+    assert cached_add.cache_info().hits == info.hits + 2
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, policy="fifo")
+
+
+def test_sharded_cache():
+    cached_add = cachedop.cached_opfunc(operator.add, concurrency="sharded", shards=4)
+    assert len(cached_add.__cache__._shards) == 4
+    for i in range(50):
+        assert cached_add(i, 1) == i + 1
+    for i in range(50):
+        assert cached_add(i, 1) == i + 1
+    info = cached_add.cache_info()
+    assert info.size == 50
+    assert info.misses == 50
+    assert info.hits == 50
+    cached_add.cache_clear()
+    assert cached_add.cache_info() == (0, 0, 0, 0, 0, 0)
+
+
+def test_sharded_cache_threads():
+    cached_mul = cachedop.cached_opfunc(operator.mul, concurrency="sharded", maxsize=64, policy="lru")
+
+    def work(n: int) -> int:
+        return sum(cached_mul(i, n) for i in range(100))
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(work, [3] * 16))
+    assert results == [sum(i * 3 for i in range(100))] * 16
+    assert cached_mul.cache_info().size <= 64
+
+
+def test_sharded_cache_rejects_policy_instance():
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, concurrency="sharded", policy=cachedop.LRUPolicy())
+
+
+def test_single_flight():
+    calls = 0
+
+    def slow_add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        time.sleep(0.05)
+        return x + y
+
+    cached_add = cachedop.cached_opfunc(slow_add, single_flight=True)
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: cached_add(2, 3), range(4)))
+    assert results == [5] * 4
+    assert calls == 1
+    assert cached_add.cache_info().coalesced == 3
+
+
+def test_single_flight_errors():
+    def failing(x: int, y: int) -> int:  # noqa: ARG001
+        time.sleep(0.05)
+        raise ArithmeticError("nope")
+
+    cached_fail = cachedop.cached_opfunc(failing, single_flight=True)
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(cached_fail, 1, 2) for _ in range(3)]
+    for future in futures:
+        assert isinstance(future.exception(), ArithmeticError)
+
+
+def test_single_flight_reentrant():
+    @cachedop.cached_opfunc(single_flight=True)
+    def gcd(x: int, y: int) -> int:
+        if y == 0:
+            return x
+        return gcd(y, x % y)
+
+    assert gcd(0, 6) == 6
+    assert gcd(48, 18) == 6
+
+
+def test_async_cached_opfunc():
+    calls = 0
+
+    @cachedop.cached_opfunc
+    async def slow_add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return x + y
+
+    async def main():
+        assert await slow_add(1, 2, 3, 4) == 10
+        results = await asyncio.gather(*(slow_add(5, 6) for _ in range(5)))
+        assert results == [11] * 5
+        assert await slow_add(5, 6) == 11
+
+    asyncio.run(main())
+    assert calls == 4
+    info = slow_add.cache_info()
+    assert info.coalesced == 4
+    assert info.hits == 1
+
+
+def test_async_cached_opfunc_errors_and_recursion():
+    @cachedop.cached_opfunc
+    async def gcd(x: int, y: int) -> int:
+        if y == 0:
+            return x
+        return await gcd(y, x % y)
+
+    @cachedop.cached_opfunc
+    async def failing(x: int, y: int) -> int:  # noqa: ARG001
+        await asyncio.sleep(0.01)
+        raise ArithmeticError("nope")
+
+    async def main():
+        assert await gcd(0, 6) == 6
+        assert await gcd(48, 18, 30) == 6
+        results = await asyncio.gather(*(failing(1, 2) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ArithmeticError) for result in results)
+
+    asyncio.run(main())
+
+
+def test_async_cancelled_leader():
+    calls = 0
+
+    @cachedop.cached_opfunc
+    async def slow_add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        return x + y
+
+    async def main():
+        leader = asyncio.ensure_future(slow_add(1, 2))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(slow_add(1, 2))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await waiter == 3
+
+    asyncio.run(main())
+    assert calls == 2
+    assert slow_add.cache_info().size == 1
+
+
+def test_auditer_enabled(auditer):
+    assert not auditer.enabled(AuditEvent.HIT)
+    auditer.register(lambda event, args: None, AuditEvent.HIT)  # noqa: ARG005
+    assert auditer.enabled(AuditEvent.HIT)
+    assert not auditer.enabled(AuditEvent.MISS)
+    auditer.clear(AuditEvent.HIT)
+    assert not auditer.enabled(AuditEvent.HIT)
+
+
+def test_auditer_sample_rate(auditer):
+    hits = 0
+
+    def on_hit(event: AuditEvent, args: typing_extensions.Mapping[str, typing_extensions.Any]) -> None:  # noqa: ARG001
+        nonlocal hits
+        hits += 1
+
+    auditer.register(on_hit, AuditEvent.HIT)
+    auditer.set_sample_rate(0, AuditEvent.HIT)
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+    for _ in range(10):
+        cached_add(1, 2)
+    assert hits == 0
+    auditer.set_sample_rate(1, AuditEvent.HIT)
+    cached_add(1, 2)
+    assert hits == 1
+    with pytest.raises(ValueError):
+        auditer.set_sample_rate(1.5)
+
+
+def test_batched_auditer(tmp_path):
+    auditer = cachedop.BatchedAuditer(batch_size=4)
+    batches: list[list[cachedop.AuditRecord]] = []
+    auditer.add_sink(batches.append, [AuditEvent.HIT, AuditEvent.MISS])
+    auditer.add_sink(cachedop.JSONLFileSink(tmp_path / "audit.jsonl"), AuditEvent.MISS)
+    auditer.start()
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+    for i in range(1, 11):
+        cached_add(i, i)
+        cached_add(i, i)
+    auditer.stop()
+    records = [record for batch in batches for record in batch]
+    assert len(records) == 20
+    assert all(len(batch) <= 4 for batch in batches)
+    assert [record.event for record in records].count(AuditEvent.HIT) == 10
+    lines = (tmp_path / "audit.jsonl").read_text().splitlines()
+    assert len(lines) == 10
+    assert json.loads(lines[0])["event"] == "MISS"
+
+
+def test_batched_auditer_overflow():
+    auditer = cachedop.BatchedAuditer(maxlen=5)
+    batches: list[list[cachedop.AuditRecord]] = []
+    auditer.add_sink(batches.append)
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+    for i in range(10):
+        cached_add(i, i)
+    assert auditer.dropped > 0
+    auditer.flush()
+    assert sum(len(batch) for batch in batches) == 5
+
+
+def test_batched_auditer_failing_callbacks(capsys):
+    auditer = cachedop.BatchedAuditer(maxlen=4, batch_size=2, overflow="block", flush_interval=0.01)
+    seen: list[AuditEvent] = []
+
+    def failing(event, args):  # noqa: ARG001
+        raise RuntimeError("callback failed")
+
+    def failing_sink(records):  # noqa: ARG001
+        raise RuntimeError("sink failed")
+
+    auditer.register(failing, AuditEvent.MISS)
+    auditer.add_sink(failing_sink, AuditEvent.MISS)
+    auditer.register(lambda event, args: seen.append(event), AuditEvent.MISS)  # noqa: ARG005
+    auditer.start()
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+    worker = threading.Thread(target=lambda: [cached_add(i, i) for i in range(20)], daemon=True)
+    worker.start()
+    worker.join(5)
+    assert not worker.is_alive()
+    auditer.stop()
+    assert seen == [AuditEvent.MISS] * 20
+    assert auditer.failed >= 20
+    assert "callback failed" in capsys.readouterr().err
+
+
+def test_batched_auditer_task():
+    auditer = cachedop.BatchedAuditer(flush_interval=0.01)
+    seen: list[AuditEvent] = []
+    auditer.register(lambda event, args: seen.append(event), AuditEvent.CALL)  # noqa: ARG005
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+
+    async def main():
+        auditer.start_task()
+        cached_add(1, 2)
+        await asyncio.sleep(0.05)
+        assert seen == [AuditEvent.CALL]
+        auditer.stop()
+
+    asyncio.run(main())
+
+
+def test_sqlite_backend(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    calls = 0
+
+    def add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x + y
+
+    backend = cachedop.SQLiteBackend(path, flush_size=4)
+    cached_add = cachedop.cached_opfunc(add, backend=backend)
+    for i in range(1, 11):
+        assert cached_add(i, 2**100) == i + 2**100
+    assert len(backend) == 10
+    backend.close()
+
+    # a new process would start with the stored results
+    backend = cachedop.SQLiteBackend(path)
+    cached_add = cachedop.cached_opfunc(add, backend=backend, maxsize=20, policy="lru")
+    for i in range(1, 11):
+        assert cached_add(i, 2**100) == i + 2**100
+    assert calls == 10
+    assert cached_add.cache_info().hits == 10
+    cached_add.cache_clear()
+    assert len(backend) == 0
+    backend.close()
+
+
+def test_sqlite_backend_mapping(tmp_path):
+    backend = cachedop.SQLiteBackend(tmp_path / "cache.sqlite3")
+    backend[1] = 2
+    backend[(1, 2)] = 3
+    assert backend[1] == 2
+    assert (1, 2) in backend
+    del backend[1]
+    assert 1 not in backend
+    with pytest.raises(KeyError):
+        del backend[1]
+    backend.flush()
+    assert list(backend) == [(1, 2)]
+    assert len(backend) == 1
+    backend.close()
+
+
+def test_sqlite_backend_miss_queries(tmp_path, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", registered.append)
+    monkeypatch.setattr(atexit, "unregister", registered.remove)
+    backend = cachedop.SQLiteBackend(tmp_path / "cache.sqlite3")
+    assert len(registered) == 1
+    queries: list[str] = []
+    backend.conn.set_trace_callback(queries.append)
+    cached_add = cachedop.cached_opfunc(operator.add, backend=backend, maxsize=8, policy="lru")
+    assert cached_add(1, 2) == 3
+    assert sum(query.startswith("SELECT value") for query in queries) == 1
+    assert len(backend) == 1
+    assert cached_add(1, 2) == 3
+    backend.close()
+    assert registered == []
+
+
+def _shm_worker(backend: cachedop.SharedMemoryBackend, start: int) -> None:
+    cached_mul = cachedop.cached_opfunc(operator.mul, backend=backend)
+    for i in range(start, start + 50):
+        cached_mul(i, 3)
+
+
+def test_shared_memory_backend():
+    backend = cachedop.SharedMemoryBackend(slots=256)
+    try:
+        backend[5] = 10
+        backend[5 + 256] = 20  # same slot, probes to the next one
+        assert backend[5] == 10
+        assert backend[5 + 256] == 20
+        del backend[5]
+        assert 5 not in backend
+        assert backend[5 + 256] == 20
+        backend[-1] = 2**70  # too large, not stored
+        assert -1 not in backend
+        assert len(backend) == 1
+        with pytest.raises(TypeError):
+            backend["key"] = 1
+        backend.clear()
+        assert len(backend) == 0
+        assert list(backend) == []
+        # once the probed slots are all taken, a key takes over its own slot
+        colliding = [7 + 256 * i for i in range(backend._probes + 1)]
+        for key in colliding:
+            backend[key] = key
+        assert len(backend) == backend._probes
+        assert colliding[0] not in backend
+        assert backend[colliding[-1]] == colliding[-1]
+        assert backend[colliding[1]] == colliding[1]
+        assert 7 + 256 * 100 not in backend
+    finally:
+        backend.close()
+
+
+def test_shared_memory_backend_write_order():
+    backend = cachedop.SharedMemoryBackend(slots=16)
+    seq = backend._seq
+    published = []
+
+    class recorder:
+        size = seq.size
+
+        @staticmethod
+        def unpack_from(buf, offset):
+            return seq.unpack_from(buf, offset)
+
+        @staticmethod
+        def pack_into(buf, offset, number):
+            if not number & 1:
+                # the data is complete once the even sequence number is written
+                published.append(backend._data.unpack_from(buf, offset + seq.size))
+            seq.pack_into(buf, offset, number)
+
+    try:
+        backend._seq = recorder
+        backend[3] = 42
+        del backend[3]
+        assert published == [(1, 3, 42), (2, 0, 0)]
+    finally:
+        backend.close()
+
+
+def test_shared_memory_backend_maxsize():
+    backend = cachedop.SharedMemoryBackend(slots=16)
+    try:
+        with pytest.raises(ValueError):
+            cachedop.cached_opfunc(operator.mul, maxsize=4, backend=backend)
+        with pytest.raises(ValueError):
+            cachedop.cached_opfunc(operator.mul, max_bytes=64, sizer=lambda _: 8, backend=backend)
+        first = cachedop.cached_opfunc(operator.mul, backend=backend)
+        second = cachedop.cached_opfunc(operator.mul, backend=backend, policy="lru")
+        for i in range(8):
+            first(i, i)
+        assert second(7, 7) == 49
+        assert second(8, 8) == 64
+        assert second.cache_info().hits == 1
+        assert len(backend) == 9
+    finally:
+        backend.close()
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_shared_memory_backend_processes():
+    ctx = multiprocessing.get_context("fork")
+    backend = cachedop.SharedMemoryBackend(slots=1024, lock=ctx.Lock())
+    try:
+        workers = [ctx.Process(target=_shm_worker, args=(backend, start)) for start in (0, 25)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+        assert len(backend) == 75
+        cached_mul = cachedop.cached_opfunc(operator.mul, backend=backend)
+        assert cached_mul(10, 3) == 30
+        assert cached_mul.cache_info().hits == 1
+    finally:
+        backend.close()
+
+
+def test_batch_and_map():
+    calls = 0
+
+    def add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x + y
+
+    cached_add = cachedop.cached_opfunc(add)
+    assert cached_add.batch([(1, 2), (2, 1), (3, 4), (1, 2)]) == [3, 3, 7, 3]
+    assert calls == 2
+    info = cached_add.cache_info()
+    assert info.misses == 2
+    assert cached_add.map([1, 3, 5], [2, 4, 6]) == [3, 7, 11]
+    assert calls == 3
+    assert cached_add.cache_info().hits == 2
+    with pytest.raises(ValueError):
+        cached_add.map([1], [2, 3])
+    with pytest.raises(ValueError):
+        cached_add.batch([(1, 2, 3)])
+
+
+def test_batch_vectorized():
+    calls = 0
+
+    def vectorized_add(xs: list[int], ys: list[int]) -> list[int]:
+        nonlocal calls
+        calls += 1
+        return [x + y for x, y in zip(xs, ys)]
+
+    cached_add = cachedop.cached_opfunc(operator.add, maxsize=100, policy="lru")
+    assert cached_add.map(range(10), range(10), vectorized=vectorized_add) == [2 * i for i in range(10)]
+    assert cached_add.map(range(12), range(12), vectorized=vectorized_add) == [2 * i for i in range(12)]
+    assert calls == 2
+    assert cached_add.cache_info().size == 12
+    with pytest.raises(ValueError):
+        cached_add.map([20, 21], [1, 1], vectorized=lambda xs, ys: [xs[0] + ys[0]])
+    assert cached_add.cache_info().size == 12
+
+
+def test_batch_dense_and_exceptions():
+    calls = []
+
+    def div(x: int, y: int) -> float:
+        calls.append((x, y))
+        return x / y
+
+    cached_div = cachedop.cached_opfunc(div, order_matters=True, domain=(0, 10), cache_exceptions=True)
+    assert cached_div.batch([(6, 3), (20, 4), (6, 3)]) == [2, 5, 2]
+    # (6, 3) lives in the dense table, only (20, 4) in the cache
+    assert cached_div.__cache__.cacheinfo().size == 1
+    assert cached_div(6, 3) == 2
+    assert calls == [(6, 3), (20, 4)]
+    for pairs in ([(1, 0)], [(1, 0)], [(20, 0)], [(20, 0)]):
+        with pytest.raises(ZeroDivisionError):
+            cached_div.batch(pairs)
+    assert calls == [(6, 3), (20, 4), (1, 0), (20, 0)]
+    with pytest.raises(ZeroDivisionError):
+        cached_div.batch([(30, 0)], vectorized=lambda xs, ys: [x / y for x, y in zip(xs, ys)])
+    with pytest.raises(ZeroDivisionError):
+        cached_div.batch([(20, 0)], vectorized=lambda xs, ys: pytest.fail("cached exception not raised"))  # noqa: ARG005
+
+
+def test_batch_numpy():
+    np = pytest.importorskip("numpy")
+    cached_mul = cachedop.cached_opfunc(operator.mul, concurrency="sharded", shards=4)
+    xs = np.arange(1, 100, dtype=np.int64)
+    ys = np.arange(2, 101, dtype=np.int64)
+    expected = (xs * ys).tolist()
+    assert cached_mul.map(xs, ys, vectorized=np.multiply) == expected
+    assert cached_mul.batch(np.stack([xs, ys], axis=1)) == expected
+    assert cached_mul.cache_info().hits == 99
+
+
+def test_segment_tree_reducer(cached_add):
+    values = [5, 1, 4, 2, 3, 8, 7]
+    tree = cached_add.reducer(values)
+    assert len(tree) == 7
+    assert tree.total() == sum(values)
+    assert tree.query(1, 4) == 1 + 4 + 2
+    assert tree.query(-2) == 8 + 7
+    tree[2] = 10
+    values[2] = 10
+    assert tree[2] == 10
+    assert list(tree) == values
+    assert tree.query(0, 3) == 16
+    assert list(tree.sliding(3)) == [sum(values[i : i + 3]) for i in range(5)]
+    with pytest.raises(ValueError):
+        tree.query(3, 3)
+    with pytest.raises(IndexError):
+        tree[7] = 1
+
+
+def test_segment_tree_reducer_not_commutative():
+    @cachedop.cached_opfunc(order_matters=True)
+    def concat(x: int, y: int) -> int:
+        return int(f"{x}{y}")
+
+    tree = concat.reducer([1, 2, 3, 4, 5])
+    assert tree.total() == 12345
+    assert tree.query(1, 4) == 234
+    tree[0] = 9
+    assert list(tree.sliding(4)) == [9234, 2345]
+
+
+def test_parallel_reduction_threads():
+    values = tuple(range(1, 1001))
+    with ThreadPoolExecutor(4) as pool:
+        cached_add = cachedop.cached_opfunc(operator.add, executor=pool, parallel_threshold=64)
+        assert cached_add(*values) == sum(values)
+        size = cached_add.cache_info().size
+        assert cached_add(*values) == sum(values)
+    assert cached_add.cache_info().size == size
+    assert cached_add.cache_info().hits == 1
+    # the parts are cached as well
+    assert cached_add(*values[:500]) == sum(values[:500])
+    assert cached_add.cache_info().hits == 2
+
+
+def test_parallel_reduction_processes():
+    values = tuple(range(1, 2001))
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as pool:
+        cached_add = cachedop.cached_opfunc(operator.add, executor=pool, parallel_threshold=300)
+        assert cached_add(*values) == sum(values)
+        # workers split their part in halves like recursive calls, not in a left fold
+        operands = tuple(range(100, 0, -1))[:12]
+        cached_sub = cachedop.cached_opfunc(operator.sub, order_matters=True, executor=pool, parallel_threshold=8)
+        assert cached_sub(*operands) == cachedop.cached_opfunc(operator.sub, order_matters=True)(*operands)
+    assert cached_add(*values[:250]) == sum(values[:250])
+    assert cached_add.cache_info().hits == 1
+
+
+def test_max_bytes():
+    cached_pow = cachedop.cached_opfunc(operator.pow, max_bytes=2000, policy="lru")
+    for i in range(2, 50):
+        cached_pow(i, 200)
+    info = cached_pow.cache_info()
+    assert 0 < info.bytes <= 2000
+    assert info.cleanup_count > 0
+    assert info.size < 48
+    # results larger than max_bytes are never cached
+    cached_pow(2, 100_000)
+    assert cached_pow.cache_info().bytes <= 2000
+    cached_pow.cache_clear()
+    assert cached_pow.cache_info().bytes == 0
+
+
+def test_custom_sizer():
+    cached_add = cachedop.cached_opfunc(operator.add, sizer=lambda value: 10)  # noqa: ARG005
+    for i in range(1, 6):
+        cached_add(i, i)
+    assert cached_add.cache_info().bytes == 50
+    cached_add = cachedop.cached_opfunc(operator.add, max_bytes=30, sizer=lambda value: 10)  # noqa: ARG005
+    for i in range(1, 6):
+        cached_add(i, i)
+    info = cached_add.cache_info()
+    assert info.size == 3
+    assert info.bytes == 30
+
+
+class _fakeclock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_ttl():
+    clock = _fakeclock()
+    calls = 0
+
+    def add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x + y
+
+    cached_add = cachedop.cached_opfunc(add, ttl=10, timer=clock)
+    cached_add(1, 2)
+    clock.now = 5
+    cached_add(1, 2)
+    assert calls == 1
+    clock.now = 11
+    cached_add(1, 2)  # expired, computed again
+    assert calls == 2
+    cached_add(3, 4)
+    clock.now = 30
+    cached_add.cache_expire()
+    info = cached_add.cache_info()
+    assert info.size == 0
+    assert info.cleanup_count == 3
+
+
+def test_ttl_sweep_on_store():
+    clock = _fakeclock()
+    cached_add = cachedop.cached_opfunc(operator.add, ttl=10, timer=clock)
+    for i in range(1, 6):
+        cached_add(i, i)
+    clock.now = 20
+    cached_add(100, 100)
+    assert cached_add.cache_info().size == 1
+
+
+def test_refresh_ahead():
+    clock = _fakeclock()
+    calls = 0
+
+    def add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x + y
+
+    with ThreadPoolExecutor(1) as pool:
+        cached_add = cachedop.cached_opfunc(add, ttl=10, refresh_ahead=2, timer=clock, executor=pool)
+        cached_add(1, 2)
+        clock.now = 5
+        cached_add(1, 2)  # not close to expiry yet
+        clock.now = 9
+        assert cached_add(1, 2) == 3  # served from the cache, refreshed in the background
+    assert calls == 2
+    clock.now = 15
+    cached_add(1, 2)  # the refreshed entry expires at 19
+    assert calls == 2
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(add, refresh_ahead=2)
+
+
+def test_refresh_ahead_async():
+    clock = _fakeclock()
+    calls = 0
+
+    @cachedop.cached_opfunc(ttl=10, refresh_ahead=2, timer=clock)
+    async def add(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x + y
+
+    async def main():
+        await add(1, 2)
+        clock.now = 9
+        assert await add(1, 2) == 3
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert calls == 2
+
+
+def test_algebra_canonicalize():
+    assert Algebra().canonicalize((3, 1, 2)) == (3, 1, 2)
+    assert Algebra(commutative=True).canonicalize((3, 1, 2)) == (3, 1, 2)
+    assert Algebra(associative=True, commutative=True).canonicalize((3, 1, 2, 1)) == (1, 1, 2, 3)
+    assert Algebra(associative=True, identity=0).canonicalize((0, 4, 0, 5)) == (4, 5)
+    assert Algebra(associative=True, identity=0).canonicalize((0, 0)) == (0,)
+    assert Algebra(associative=True, idempotent=True).canonicalize((2, 2, 3, 3, 2)) == (2, 3, 2)
+    full = Algebra(associative=True, commutative=True, identity=0, idempotent=True)
+    assert full.canonicalize((6, 0, 4, 6, 4)) == (4, 6)
+
+
+def test_algebra_shares_groupings():
+    calls = 0
+
+    @cachedop.cached_opfunc(algebra=Algebra(associative=True, commutative=True, identity=0, idempotent=True))
+    def gcd(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return math.gcd(x, y)
+
+    assert gcd(12, 18, 0, 12, 30) == 6
+    misses = gcd.cache_info().misses
+    assert gcd(30, 18, 18, 12, 0) == 6
+    assert gcd.cache_info().misses == misses
+    assert gcd(0, 9) == 9
+    assert gcd(9, 9) == 9
+    assert gcd.cache_info().misses == misses
+    assert gcd.batch([(4, 6), (6, 4), (0, 5), (7, 7)]) == [2, 2, 5, 7]
+    assert gcd.cache_info().misses == misses + 1
+
+
+def test_algebra_keeps_order_of_noncommutative_ops():
+    concat = cachedop.cached_opfunc(lambda x, y: int(f"{x}{y}"), algebra=Algebra(associative=True))
+    assert concat(1, 2) == 12
+    assert concat(2, 1) == 21
+    assert concat(1, 2, 3) == 123
+
+
+def test_dense_domain():
+    calls = 0
+
+    def sub(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x - y
+
+    cached_sub = cachedop.cached_opfunc(sub, domain=(-4, 4), order_matters=True)
+    assert cached_sub(3, -4) == 7
+    assert cached_sub(3, -4) == 7
+    assert cached_sub(-4, 3) == -7
+    assert cached_sub(10, 3) == 7  # outside the domain, cached as usual
+    assert cached_sub(10, 3) == 7
+    assert calls == 3
+    info = cached_sub.cache_info()
+    assert (info.size, info.hits, info.misses) == (3, 2, 3)
+    cached_sub.cache_clear()
+    assert cached_sub.cache_info().size == 0
+    # a symmetric store fills both cells, the diagonal only one
+    cached_add = cachedop.cached_opfunc(operator.add, domain=(0, 3))
+    cached_add(1, 2)
+    assert cached_add.cache_info().size == 2
+    cached_add(2, 1)
+    cached_add(2, 2)
+    assert cached_add.cache_info().size == 3
+
+
+def test_dense_domain_precompute():
+    cached_mul = cachedop.cached_opfunc(operator.mul, domain=(0, 15), precompute=True)
+    assert cached_mul.cache_info().size == 16 * 16
+    assert cached_mul(3, 5, 7) == 105
+    assert cached_mul(15, 15) == 225
+    big = cachedop.cached_opfunc(operator.pow, domain=(0, 70), order_matters=True)
+    assert big(2, 70) == 2**70
+    assert big(2, 70) == 2**70
+    assert (big.cache_info().hits, big.cache_info().size) == (1, 1)
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, precompute=True)
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, domain=(0, 3), ttl=1.0)
+
+
+def test_fast_call_path():
+    auditer = Auditer()
+    cached_add = cachedop.cached_opfunc(operator.add, auditer=auditer)
+    assert type(cached_add).__name__ == "_fast_cached_opfunc_wrapper"
+    assert type(cachedop.cached_opfunc(operator.add, policy="lru")).__name__ == "_cached_opfunc_wrapper"
+    assert cached_add(2, 5) == cached_add(5, 2) == 7
+    assert cached_add(1, 2, 3) == 6
+    info = cached_add.cache_info()
+    assert (info.hits, info.misses) == (1, 4)
+    hits = []
+    auditer.register(lambda event, args: hits.append(args["key"]), AuditEvent.HIT)  # noqa: ARG005
+    assert cached_add(5, 2) == 7
+    assert len(hits) == 1
+    auditer.clear(AuditEvent.HIT)
+    assert cached_add(5, 2) == 7
+    assert len(hits) == 1
+    assert cached_add.cache_info().hits == 3
+
+
+def test_zero_results_are_hits():
+    cached_mod = cachedop.cached_opfunc(operator.mod, order_matters=True)
+    for _ in range(3):
+        assert cached_mod(10, 5) == 0
+    info = cached_mod.cache_info()
+    assert (info.hits, info.misses) == (2, 1)
+    assert cached_mod.batch([(10, 5), (9, 3)]) == [0, 0]
+    assert cached_mod.cache_info().hits == 3
+    locked = cachedop.cached_opfunc(operator.sub, policy="lru")
+    locked(4, 4)
+    locked(4, 4)
+    assert locked.cache_info().hits == 1
+
+
+def test_cache_exceptions():
+    calls = 0
+
+    def div(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x // y
+
+    cached_div = cachedop.cached_opfunc(div, order_matters=True, cache_exceptions=ZeroDivisionError)
+    for _ in range(3):
+        with pytest.raises(ZeroDivisionError):
+            cached_div(1, 0)
+    assert calls == 1
+    cached_div.cache_clear()
+    with pytest.raises(ZeroDivisionError):
+        cached_div(1, 0)
+    assert calls == 2
+    plain = cachedop.cached_opfunc(div, order_matters=True)
+    for _ in range(2):
+        with pytest.raises(ZeroDivisionError):
+            plain(1, 0)
+    assert calls == 4
+    dense_div = cachedop.cached_opfunc(div, order_matters=True, domain=(0, 10), cache_exceptions=True)
+    for _ in range(3):
+        with pytest.raises(ZeroDivisionError):
+            dense_div(1, 0)
+    assert calls == 5
+    assert dense_div(6, 3) == 2
+
+    @cachedop.cached_opfunc(order_matters=True, domain=(0, 10), cache_exceptions=True)
+    async def async_div(x: int, y: int) -> int:
+        nonlocal calls
+        calls += 1
+        return x // y
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(ZeroDivisionError):
+                await async_div(1, 0)
+
+    asyncio.run(main())
+    assert calls == 7
+
+
+def test_cache_exceptions_ttl():
+    clock = _fakeclock()
+    calls = 0
+
+    def fail(x: int, y: int) -> int:  # noqa: ARG001
+        nonlocal calls
+        calls += 1
+        raise KeyError(x)
+
+    cached_fail = cachedop.cached_opfunc(fail, cache_exceptions=True, ttl=10, timer=clock)
+    with pytest.raises(KeyError):
+        cached_fail(1, 2)
+    with pytest.raises(KeyError):
+        cached_fail(1, 2)
+    assert calls == 1
+    clock.now += 11
+    with pytest.raises(KeyError):
+        cached_fail(1, 2)
+    assert calls == 2
+
+
+def test_snapshot_roundtrip():
+    cached_add = cachedop.cached_opfunc(operator.add)
+    for i in range(20):
+        cached_add(i, 2**70 if i == 3 else i)
+    data = cached_add.export_snapshot()
+    restored = cachedop.cached_opfunc(operator.add)
+    restored.load_snapshot(data)
+    info = restored.cache_info()
+    assert (info.size, info.misses) == (20, 0)
+    assert restored(3, 2**70) == 3 + 2**70
+    assert restored.cache_info().hits == 1
+    keyed = cachedop.cached_opfunc(operator.mul, key=str)
+    keyed(6, 7)
+    other = cachedop.cached_opfunc(operator.mul, key=str)
+    other.load_snapshot(keyed.export_snapshot())
+    assert other(6, 7) == 42
+    assert other.cache_info().hits == 1
+    with pytest.raises(ValueError):
+        restored.load_snapshot(b"nope")
+
+
+def test_frozen_snapshot_tier():
+    warm = cachedop.cached_opfunc(operator.mul)
+    for i in range(100):
+        warm(i, i + 1)
+    data = warm.export_snapshot()
+    assert len(data) < 24 + 100 * 16 + 1
+    for concurrency in ("locked", "sharded"):
+        worker = cachedop.cached_opfunc(operator.mul, concurrency=concurrency)
+        worker.load_snapshot(data, frozen=True)
+        assert worker.cache_info().size == 100
+        assert worker(5, 6) == 30
+        assert worker(0, 1) == 0
+        assert worker(200, 2) == 400
+        info = worker.cache_info()
+        assert (info.size, info.hits, info.misses) == (101, 2, 1)
+        assert len(worker.export_snapshot()) == len(data) + 16
+        worker.cache_clear()
+        assert worker.cache_info().size == 0
+
+
+def test_trace_ring_and_simulate(tmp_path):
+    path = tmp_path / "keys.trace"
+    with cachedop.TraceRecorder(path, capacity=8, chunk=3) as recorder:
+        cached_add = cachedop.cached_opfunc(operator.add, trace=recorder)
+        for i in range(10):
+            cached_add(i, 1)
+    make_key = keymaker(order_matters=False).make_key
+    assert list(cachedop.read_trace(path)) == [hash(make_key((i, 1))) for i in range(2, 10)]
+    (tmp_path / "bad.trace").write_bytes(b"nope")
+    with pytest.raises(ValueError):
+        cachedop.read_trace(tmp_path / "bad.trace")
+    trace = [i % 4 for i in range(100)]
+    curves = cachedop.simulate(trace, [2, 4], policies=["lru"])
+    assert curves == {"lru": [(2, 0.0), (4, 0.96)]}
+
+
+def test_trace_threads(tmp_path):
+    path = tmp_path / "keys.trace"
+    with cachedop.TraceRecorder(path, capacity=1 << 16, chunk=7) as recorder:
+
+        def work(start: int) -> None:
+            for i in range(start, start + 5000):
+                recorder.record(i)
+
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(work, range(0, 20000, 5000)))
+    assert sorted(cachedop.read_trace(path)) == list(range(20000))
+
+
+def test_metrics_export():
+    cached_mul = cachedop.cached_opfunc(operator.mul, metrics=True)
+    cached_mul(3, 4)
+    cached_mul(3, 4)
+    entry = next(entry for entry in cachedop.metrics_snapshot() if entry["id"] == hex(id(cached_mul)))
+    assert (entry["size"], entry["hits"], entry["misses"], entry["evictions"]) == (1, 1, 1, 0)
+    assert entry["op"] == "_operator.mul"
+    assert entry["lookup_seconds"]["count"] == 2
+    assert entry["compute_seconds"]["count"] == 1
+    assert entry["compute_seconds"]["buckets"][float("inf")] == 1
+    text = cachedop.render_prometheus()
+    labels = f'op="_operator.mul",id="{hex(id(cached_mul))}"'
+    assert f"cachedop_hits_total{{{labels}}} 1" in text
+    assert f'cachedop_compute_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+    assert "# TYPE cachedop_lookup_seconds histogram" in text
+    del cached_mul
+    assert all(
+        entry["op"] != "_operator.mul" or entry["lookup_seconds"] is None for entry in cachedop.metrics_snapshot()
+    )
+
+
+def test_adaptive_maxsize():
+    auditer = Auditer()
+    decisions = []
+    auditer.register(lambda _event, args: decisions.append(args), AuditEvent.TUNE)
+    cached_add = cachedop.cached_opfunc(operator.add, maxsize=1024, adaptive=(16, 1024), auditer=auditer)
+    for i in range(20000):
+        cached_add(i % 20, 0)
+    assert cached_add.__cache__.maxsize == 32
+    assert decisions[0]["previous"] == 1024
+    assert decisions[-1]["maxsize"] == 32
+    assert set(decisions[-1]["hit_rates"]) == {16, 32, 64, 128, 256, 512, 1024}
+    assert cached_add.cache_info().size <= 32
+    # the traffic shifts to a larger working set
+    for i in range(60000):
+        cached_add(i % 300, 1)
+    assert cached_add.__cache__.maxsize == 512
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, maxsize=8, adaptive=(16, 1024))
+    sharded = cachedop.cached_opfunc(operator.add, maxsize=1024, adaptive=(64, 1024), concurrency="sharded", shards=4)
+    assert sharded.__cache__.maxsize == 1024
+    sharded.__cache__.resize(100)
+    assert sharded.__cache__.maxsize == 100
+
+
+def test_thread_cache():
+    calls = []
+
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+
+    cached_add = cachedop.cached_opfunc(add, policy="lru", thread_cache=4)
+    assert cached_add(1, 2) == 3
+    assert cached_add(1, 2) == 3
+    # promoted on the shared hit, this one never reaches the shared cache
+    assert cached_add(1, 2) == 3
+    info = cached_add.cache_info()
+    assert (info.size, info.hits, info.misses) == (1, 2, 1)
+    assert cached_add.__cache__.cacheinfo().hits == 1
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(lambda _: cached_add(1, 2), range(100))) == [3] * 100
+    assert calls == [(1, 2)]
+    assert cached_add.cache_info().hits == 102
+    cached_add.cache_clear()
+    assert cached_add.cache_info().hits == 0
+    assert cached_add(1, 2) == 3
+    assert calls == [(1, 2), (1, 2)]
+    for i in range(10):
+        cached_add(i, 0)
+        cached_add(i, 0)
+    auditer = Auditer()
+    hits = []
+    auditer.register(lambda _event, args: hits.append(args), AuditEvent.HIT)
+    sampled = cachedop.cached_opfunc(operator.add, policy="lru", thread_cache=4, auditer=auditer)
+    sampled(1, 2)
+    sampled(1, 2)
+    sampled(1, 2)
+    assert len(hits) == 2
+    auditer.set_sample_rate(0, AuditEvent.HIT)
+    sampled(1, 2)
+    assert len(hits) == 2
+    workers = [threading.Thread(target=lambda i=i: [cached_add(i, 0), cached_add(i, 0)]) for i in range(20)]
+    for worker in workers:
+        worker.start()
+        worker.join()
+    # the entries of finished threads are gone, their hits are kept
+    assert cached_add.cache_info().hits == 40
+    assert len(cached_add._l1._hits._cells) == 1
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, thread_cache=4, ttl=1.0)
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, thread_cache=0)
+
+
+def test_counter_finished_threads():
+    hits = counter()
+    hits.add(2)
+    for _ in range(50):
+        thread = threading.Thread(target=hits.add, args=(3,))
+        thread.start()
+        thread.join()
+    assert hits.value() == 152
+    # only the cell of the main thread is left
+    assert len(hits._cells) == 1
+    hits.reset()
+    assert hits.value() == 0
+
+
+def test_generic_operands():
+    cached_add = cachedop.cached_opfunc(operator.add)
+    assert cached_add(Fraction(1, 2), Fraction(1, 3)) == Fraction(5, 6)
+    assert cached_add(Fraction(1, 3), Fraction(1, 2)) == Fraction(5, 6)
+    assert cached_add(Fraction(1, 2), Fraction(1, 3), Fraction(1, 6), Fraction(0)) == 1
+    assert cached_add(Decimal("0.1"), Decimal("0.2")) == Decimal("0.3")
+    info = cached_add.cache_info()
+    assert (info.hits, info.misses) == (2, 5)
+
+    def matmul(a, b):
+        return tuple(tuple(sum(x * y for x, y in zip(row, col)) for col in zip(*b)) for row in a)
+
+    identity = ((1, 0), (0, 1))
+    cached_matmul = cachedop.cached_opfunc(matmul, algebra=Algebra(associative=True, identity=identity))
+    m = ((1, 1), (1, 0))
+    assert cached_matmul(m, identity, m, m) == ((3, 2), (2, 1))
+    assert cached_matmul(identity, identity) == identity
+    assert cached_matmul.reducer([m, m, m, m]).total() == ((5, 3), (3, 2))
+
+    # complex numbers cannot be ordered, unordered keys sort them by hash instead
+    cached_cadd = cachedop.cached_opfunc(operator.add)
+    assert cached_cadd(1j, 2 + 0j) == 2 + 1j
+    assert cached_cadd(2 + 0j, 1j) == 2 + 1j
+    assert cached_cadd(1j, 2j, 3 + 0j) == 3 + 3j
+    assert cached_cadd.cache_info().hits == 1
+    commutative = Algebra(associative=True, commutative=True)
+    assert cachedop.cached_opfunc(operator.add, algebra=commutative)(1j, 2j, 3 + 0j) == 3 + 3j
+
+    cached_div = cachedop.cached_opfunc(operator.truediv, order_matters=True, domain=(0, 15))
+    assert cached_div(1, 4) == 0.25
+    assert cached_div(1, 4) == 0.25
+    assert cached_div(Fraction(1), Fraction(4)) == Fraction(1, 4)
+    assert cached_div(3, 3) == 1.0
+    assert isinstance(cached_div(3, 3), float)
+    cached_and = cachedop.cached_opfunc(operator.and_, domain=(0, 1))
+    assert cached_and(True, True) is True
+    assert cached_and(1, 1) == 1
+
+    data = cached_add.export_snapshot()
+    restored = cachedop.cached_opfunc(operator.add)
+    restored.load_snapshot(data, frozen=True)
+    assert restored(Fraction(1, 3), Fraction(1, 2)) == Fraction(5, 6)
+    assert restored.cache_info().misses == 0
+
+
+def test_nary_equivalents():
+    values = list(range(1, 201))
+    cached_add = cachedop.cached_opfunc(operator.add)
+    assert cached_add(*values) == sum(values)
+    assert cached_add.cache_info().size == 1
+    assert cached_add(*values[:10]) == 55
+    assert cached_add.cache_info().size > 2
+    words = [chr(ord("a") + i % 26) for i in range(100)]
+    assert cachedop.cached_opfunc(operator.add, order_matters=True)(*words) == "".join(words)
+    assert cachedop.cached_opfunc(operator.add, order_matters=True)(*[b"ab"] * 64) == b"ab" * 64
+    assert cachedop.cached_opfunc(operator.add, nary=False)(*values) == sum(values)
+    assert cachedop.cached_opfunc(operator.add, nary=False)(*values) == sum(values)
+    tuples = [(i,) for i in range(100)]
+    assert cachedop.cached_opfunc(operator.add, order_matters=True)(*tuples) == tuple(range(100))
+    assert cachedop.cached_opfunc(operator.mul)(*[2] * 100) == 2**100
+    assert cachedop.cached_opfunc(max)(*values) == 200
+    assert cachedop.cached_opfunc(math.gcd)(*[6 * v for v in values]) == 6
+    assert cachedop.cached_opfunc(operator.xor)(*values) == 200
+
+    calls = []
+
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+
+    declared = cachedop.cached_opfunc(add, nary=sum, nary_threshold=3)
+    assert declared(1, 2, 3) == 6
+    assert calls == []
+    assert declared(1, 2) == 3
+    assert calls == [(1, 2)]
+    with pytest.raises(ValueError):
+        cachedop.cached_opfunc(operator.add, nary_threshold=2)
+
+
+def test_nary_numpy_ufunc():
+    np = pytest.importorskip("numpy")
+    cached_add = cachedop.cached_opfunc(np.add)
+    assert cached_add(*range(1000)) == 499500
+    assert cached_add.cache_info().size == 1
+    assert cachedop.algebra.nary_equivalent(np.negative) is None